@@ -3,8 +3,30 @@ __email__ = 'arve.seljebu@gmail.com'
 from os.path import join, dirname
 __version__ = open(join(dirname(__file__), 'VERSION')).read().strip()
 
-__all__ = ['Experiment', 'compress', 'decompress',
-            'attribute', 'attribute_as_str', 'attributes']
+__all__ = ['Experiment', 'compress', 'decompress', 'iter_decompressed',
+            'attribute', 'attribute_as_str', 'attributes', 'Stats',
+            'WorkQueue', 'ExperimentCatalog']
 
-from .experiment import (Experiment, compress, decompress,
+from .experiment import (Experiment, compress, decompress, iter_decompressed,
                             attribute, attribute_as_str, attributes)
+from .stats import Stats
+
+# WorkQueue and ExperimentCatalog need sqlite3 and socket, import on first use
+_lazy = {'WorkQueue': 'workqueue', 'ExperimentCatalog': 'catalog'}
+
+
+def __getattr__(name):
+    if name not in _lazy:
+        raise AttributeError("module {!r} has no attribute {!r}"
+                             .format(__name__, name))
+    from importlib import import_module
+    value = getattr(import_module('.' + _lazy[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+import sys as _sys
+if _sys.version_info < (3, 7):
+    # no module __getattr__
+    from .workqueue import WorkQueue
+    from .catalog import ExperimentCatalog
@@ -0,0 +1,284 @@
+# encoding: utf-8
+"""
+Archive experiment to a storage target in one pass. TIFFs are read once,
+compressed in memory and written as PNG and json directly to the
+destination. Other files are streamed as they are. Each written file is
+checksummed and recorded in ``archive.jsonl`` in the destination, so an
+interrupted archive resumes with the files which are missing or have
+changed, and sources are only deleted after their copy is verified.
+"""
+import hashlib, json, os, threading, time
+from .stats import Stats
+
+# manifest in destination, one JSON line per archived source file
+manifest_name = 'archive.jsonl'
+
+# bytes per write
+_chunk_size = 1 << 20
+
+
+def archive(path, dest, compress=True, delete=False, verify=True, writers=4,
+            bandwidth=None, stats=None):
+    """Copy experiment to `dest`, compressing TIFFs on the way.
+
+    Parameters
+    ----------
+    path : string
+        Experiment folder.
+    dest : string
+        Destination folder, like a mounted share. Created if missing.
+    compress : bool
+        Write TIFFs as PNG and json, like ``leicaexperiment.compress``.
+        TIFFs which are already compressed in `path` are not archived.
+    delete : bool
+        Delete source files when their copy is verified.
+    verify : bool
+        Read back written files and compare checksums. Always done if
+        `delete` is set.
+    writers : int
+        Number of files read, compressed and written in parallel.
+    bandwidth : float
+        Max bytes per second written, shared by all writers.
+    stats : leicaexperiment.Stats
+        Where to record timings of read, encode, write and verify.
+
+    Returns
+    -------
+    list of strings
+        Files in destination, including those archived before resuming.
+    """
+    from multiprocessing.pool import ThreadPool
+    from .experiment import _compressed_filename
+    if stats is None:
+        stats = Stats()
+    path = os.path.abspath(path)
+    dest = os.path.abspath(dest)
+    if (dest + os.sep).startswith(path + os.sep):
+        raise ValueError('Destination {} is inside experiment'.format(dest))
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    manifest = Manifest(os.path.join(dest, manifest_name))
+    sources = _walk(path)
+    present = set(sources)
+    tasks = []
+    for relative in sources:
+        if compress and relative.endswith('.tif'):
+            png = _compressed_filename(relative)
+            if png in present:
+                # already compressed, PNG and json are copied instead
+                continue
+        tasks.append(relative)
+
+    throttle = _Throttle(bandwidth) if bandwidth else None
+    lock = threading.Lock()
+    all_stats = []
+
+    def run(relative):
+        worker_stats = Stats()
+        entry = manifest.get(relative)
+        source = os.path.join(path, relative)
+        with lock:
+            all_stats.append(worker_stats)
+        if entry is None or not _unchanged(entry, source, dest):
+            try:
+                entry = _archive_file(source, relative, dest, compress,
+                                      throttle, worker_stats)
+            except Exception as e:
+                # print error - continue, archived again on resume
+                print('leicaexperiment Could not archive {}: {}'.format(
+                    source, e))
+                worker_stats.add('failed', 0)
+                return []
+            manifest.add(entry)
+        else:
+            worker_stats.add('resumed', 0)
+        if verify or delete:
+            try:
+                with worker_stats.timer('verify'):
+                    _verify(entry, dest)
+            except IOError as e:
+                # print error - continue, written again on resume
+                print('leicaexperiment {}'.format(e))
+                return []
+            if delete:
+                os.remove(source)
+        return [os.path.join(dest, f) for f in sorted(entry['files'])]
+
+    pool = ThreadPool(writers)
+    try:
+        written = pool.map(run, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for s in all_stats:
+        stats.merge(s)
+    return [f for list_ in written for f in list_]
+
+
+
+class Manifest:
+    def __init__(self, filename):
+        """Append only record of archived files, safe to use from several
+        threads. The last record of a source wins.
+
+        Parameters
+        ----------
+        filename : string
+            JSON lines file.
+        """
+        self.filename = filename
+        self._entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted archive
+                        continue
+                    self._entries[entry['source']] = entry
+
+
+    def get(self, source):
+        "Record of source, None if not archived."
+        return self._entries.get(source)
+
+
+    def add(self, entry):
+        "Record archived source and flush it to disk."
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        with self._lock:
+            with open(self.filename, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._entries[entry['source']] = entry
+
+
+
+class _Throttle:
+    def __init__(self, rate):
+        "Limit rate of bytes, shared by threads."
+        self.rate = float(rate)
+        self._next = time.time()
+        self._lock = threading.Lock()
+
+
+    def wait(self, n):
+        "Sleep until `n` more bytes can be written."
+        with self._lock:
+            now = time.time()
+            start = max(self._next, now)
+            self._next = start + n / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+
+def _walk(path):
+    "Relative paths of all files in folder, sorted."
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in names:
+            files.append(os.path.relpath(os.path.join(root, name), path))
+    return sorted(files)
+
+
+def _unchanged(entry, source, dest):
+    "Whether source is as archived and its copies are in place."
+    st = os.stat(source)
+    if entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+        return False
+    for name, (_, size) in entry['files'].items():
+        filename = os.path.join(dest, name)
+        if not os.path.isfile(filename) or os.path.getsize(filename) != size:
+            return False
+    return True
+
+
+def _archive_file(source, relative, dest, compress, throttle, stats):
+    """Write source to destination, compressed if it is a TIFF.
+
+    Returns
+    -------
+    dict
+        Manifest record, with checksum and size of each written file.
+    """
+    from .experiment import _compressed_filename, _encode_png
+    st = os.stat(source)
+    files = {}
+    if compress and relative.endswith('.tif'):
+        with stats.timer('read'):
+            with open(source, 'rb') as f:
+                data = f.read()
+        png, tags, _ = _encode_png(data, stats)
+        name = _compressed_filename(relative)
+        for name, content in [(name, png),
+                              (name[:-4] + '.json', tags.encode('utf-8'))]:
+            files[name] = _write(iter([content]), os.path.join(dest, name),
+                                 throttle, stats)
+    else:
+        with open(source, 'rb') as f:
+            chunks = iter(lambda: f.read(_chunk_size), b'')
+            files[relative] = _write(chunks, os.path.join(dest, relative),
+                                     throttle, stats)
+    return {'source': relative, 'size': st.st_size, 'mtime': st.st_mtime,
+            'files': files}
+
+
+def _write(chunks, filename, throttle, stats):
+    """Write chunks to a temporary file, renamed when complete.
+
+    Returns
+    -------
+    [sha256, size] : list
+    """
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by other writer
+            if not os.path.isdir(folder):
+                raise
+    sha = hashlib.sha256()
+    size = 0
+    tmp = '{}.{}.tmp'.format(filename, threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb') as f:
+            for chunk in chunks:
+                for i in range(0, len(chunk), _chunk_size):
+                    part = chunk[i:i + _chunk_size]
+                    if throttle is not None:
+                        with stats.timer('throttle'):
+                            throttle.wait(len(part))
+                    with stats.timer('write'):
+                        f.write(part)
+                    sha.update(part)
+                    size += len(part)
+    except BaseException:
+        # do not leave partial copies in destination
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    if os.path.isfile(filename):
+        os.remove(filename)
+    os.rename(tmp, filename)
+    return [sha.hexdigest(), size]
+
+
+def _verify(entry, dest):
+    """Read back archived files. Raise IOError if a checksum differs, after
+    removing the file so it is written again on resume."""
+    for name, (digest, _) in entry['files'].items():
+        sha = hashlib.sha256()
+        with open(os.path.join(dest, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(_chunk_size), b''):
+                sha.update(chunk)
+        if sha.hexdigest() != digest:
+            os.remove(os.path.join(dest, name))
+            raise IOError('Checksum of {} differs from {}, removed'.format(
+                os.path.join(dest, name), entry['source']))
@@ -0,0 +1,198 @@
+# encoding: utf-8
+"""
+Structured results of batch operations. Each image of ``compress`` and
+``decompress`` gives a ``Result`` with status, error, duration and bytes in
+and out. I/O errors which may pass, like a network share timing out, are
+retried with exponential backoff in the worker, so one hiccup does not leave
+a gap in a plate-wide run.
+
+Images which still fail are recorded in a ``FailureManifest``, JSON lines
+with the operation and its options. ``replay`` runs them again, without
+listing or checking the rest of the experiment.
+"""
+import errno, json, os, threading, time
+from collections import namedtuple
+
+# errno of errors which may succeed when tried again
+transient_errors = set(getattr(errno, name) for name in [
+    'EIO', 'EAGAIN', 'EBUSY', 'EINTR', 'ETIMEDOUT', 'ESTALE', 'ECONNRESET',
+    'ECONNABORTED', 'ENETUNREACH', 'EHOSTUNREACH', 'EREMOTEIO']
+    if hasattr(errno, name))
+
+
+class Result(namedtuple('Result', 'operation item output status error '
+                                  'attempts seconds bytes_in bytes_out')):
+    """Outcome of one image in a batch operation.
+
+    Attributes
+    ----------
+    operation : string
+        ``compress`` or ``decompress``.
+    item : string
+        Input filename.
+    output : string
+        Output filename, empty string if failed.
+    status : string
+        ``ok``, ``skipped`` if output already existed or there is nothing
+        to do, or ``failed``.
+    error : string
+        Type and message of last error, None if not failed.
+    attempts : int
+        Number of tries, more than one if transient errors were retried.
+    seconds : float
+        Wall time of all tries.
+    bytes_in, bytes_out : int
+        Size of input and output files.
+    """
+    __slots__ = ()
+
+
+
+def is_transient(error):
+    "Whether `error` is an I/O error which may pass if tried again."
+    return isinstance(error, EnvironmentError) and \
+        error.errno in transient_errors
+
+
+def run(operation, item, func, retries=2, backoff=0.5, stats=None):
+    """Call ``func(item)``, and retry transient I/O errors.
+
+    Parameters
+    ----------
+    operation : string
+        Name of operation, for the result.
+    item : string
+        Input filename.
+    func : callable
+        Returns ``(status, output, bytes_in, bytes_out)``. Raises IOError or
+        AssertionError if it fails.
+    retries : int
+        Max number of tries after the first one.
+    backoff : float
+        Seconds to wait before first retry, doubled for each retry.
+    stats : leicaexperiment.Stats
+        Counts ``retry`` and ``failed``.
+
+    Returns
+    -------
+    Result
+    """
+    start = time.time()
+    attempts = 0
+    while True:
+        attempts += 1
+        try:
+            status, output, bytes_in, bytes_out = func(item)
+            error = None
+            break
+        except (IOError, AssertionError) as e:
+            if attempts <= retries and is_transient(e):
+                if stats is not None:
+                    stats.add('retry', 0)
+                time.sleep(backoff * 2 ** (attempts - 1))
+                continue
+            # print error - continue
+            print('leicaexperiment {}'.format(e))
+            if stats is not None:
+                stats.add('failed', 0)
+            status, output, bytes_in, bytes_out = 'failed', '', 0, 0
+            error = '{}: {}'.format(type(e).__name__, e)
+            break
+    return Result(operation, item, output, status, error, attempts,
+                  time.time() - start, bytes_in, bytes_out)
+
+
+
+class FailureManifest:
+    def __init__(self, filename):
+        """Record of failed images, appended to as batches finish. The last
+        record of an image wins, so images which succeed on replay are not
+        replayed again.
+
+        Parameters
+        ----------
+        filename : string
+            JSON lines file, created on first failure.
+        """
+        self.filename = filename
+        self._entries = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line of an interrupted write
+                        continue
+                    self._entries[(entry['operation'], entry['item'])] = entry
+
+
+    def failed(self):
+        "Records of images which have not succeeded since they failed."
+        return [e for _, e in sorted(self._entries.items())
+                if e['status'] == 'failed']
+
+
+    def record(self, results, options):
+        """Add failed results, and successes of images which have failed
+        before.
+
+        Parameters
+        ----------
+        results : list of Result
+        options : dict
+            Keyword arguments of operation, used on replay.
+        """
+        lines = []
+        with self._lock:
+            for result in results:
+                key = (result.operation, result.item)
+                if result.status != 'failed' and key not in self._entries:
+                    continue
+                entry = dict(result._asdict(), options=options,
+                             time=time.time())
+                self._entries[key] = entry
+                lines.append(json.dumps(entry, sort_keys=True) + '\n')
+            if not lines:
+                return
+            folder = os.path.dirname(self.filename)
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            with open(self.filename, 'a') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+
+def replay(filename, retries=2, stats=None):
+    """Run failed images in manifest again, with the options they failed
+    with. Outcomes are recorded in the same manifest.
+
+    Parameters
+    ----------
+    filename : string
+        Failure manifest.
+    retries : int
+        Max number of retries of transient errors per image.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    list of Result
+    """
+    from .experiment import compress, decompress
+    operations = {'compress': compress, 'decompress': decompress}
+    batches = {}
+    for entry in FailureManifest(filename).failed():
+        key = (entry['operation'], json.dumps(entry['options'],
+                                              sort_keys=True))
+        batches.setdefault(key, []).append(entry['item'])
+    results = []
+    for (operation, options), items in sorted(batches.items()):
+        results.extend(operations[operation](
+            items, stats=stats, retries=retries, manifest=filename,
+            results=True, **json.loads(options)))
+    return results
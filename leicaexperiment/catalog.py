@@ -0,0 +1,308 @@
+# encoding: utf-8
+"""
+Catalog of images in many experiments, in one SQLite database. Images are
+indexed by experiment, attributes, size, modification time and whether they
+are compressed, so queries across experiments do not list any folders.
+
+Updates are incremental: a field folder is only listed again when its
+modification time has changed, which happens when images are added,
+removed or compressed in it.
+"""
+import os, sqlite3, time
+from .utils import range_type, range_bounds
+
+_columns = ['experiment', 'path', 's', 'u', 'v', 'x', 'y', 'z', 'c', 't',
+            'size', 'mtime', 'compressed']
+
+_schema = """
+CREATE TABLE IF NOT EXISTS experiments (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    name TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    path TEXT PRIMARY KEY,
+    experiment INTEGER,
+    mtime REAL
+);
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    experiment INTEGER,
+    field TEXT,
+    s INTEGER, u INTEGER, v INTEGER, x INTEGER, y INTEGER,
+    z INTEGER, c INTEGER, t INTEGER,
+    size INTEGER,
+    mtime REAL,
+    compressed INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_well ON images (u, v, c);
+CREATE INDEX IF NOT EXISTS images_experiment ON images (experiment);
+CREATE INDEX IF NOT EXISTS images_field ON images (field);
+CREATE INDEX IF NOT EXISTS images_mtime ON images (mtime);
+"""
+
+
+class ExperimentCatalog:
+    def __init__(self, path):
+        """Catalog of experiments in SQLite database `path`.
+
+            >>> catalog = ExperimentCatalog('catalog.db')
+            >>> catalog.discover('/data')
+            >>> catalog.query(C=1, U=3, V=5, since=time.time() - 30 * 86400)
+
+        Parameters
+        ----------
+        path : string
+            Filename of database. Folder is created if missing.
+        """
+        self.path = os.path.abspath(path)
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        db = self._connect()
+        with db:
+            db.executescript(_schema)
+        db.close()
+
+
+    def _connect(self):
+        "Connection which commits on success."
+        return sqlite3.connect(self.path, timeout=60)
+
+
+    @property
+    def experiments(self):
+        "Paths of experiments in catalog."
+        db = self._connect()
+        rows = db.execute('SELECT path FROM experiments '
+                          'ORDER BY path').fetchall()
+        db.close()
+        return [row[0] for row in rows]
+
+
+    def discover(self, root, pattern='experiment--*'):
+        """Add and update experiments in `root` which match `pattern`.
+
+        Returns
+        -------
+        int
+            Number of images added, changed or removed.
+        """
+        from .experiment import glob
+        paths = [p for p in glob(os.path.join(root, pattern))
+                 if os.path.isdir(p)]
+        return self.add(*paths)
+
+
+    def add(self, *paths):
+        """Add and update experiments.
+
+        Returns
+        -------
+        int
+            Number of images added, changed or removed.
+        """
+        db = self._connect()
+        with db:
+            for path in paths:
+                path = os.path.abspath(path)
+                db.execute('INSERT OR IGNORE INTO experiments (path, name) '
+                           'VALUES (?, ?)', (path, os.path.basename(path)))
+        db.close()
+        return self.update(paths)
+
+
+    def remove(self, path):
+        "Remove experiment and its images from catalog."
+        path = os.path.abspath(path)
+        db = self._connect()
+        with db:
+            row = db.execute('SELECT id FROM experiments WHERE path = ?',
+                             (path,)).fetchone()
+            if row is not None:
+                for table in ['images', 'fields']:
+                    db.execute('DELETE FROM {} WHERE experiment = ?'
+                               .format(table), row)
+                db.execute('DELETE FROM experiments WHERE id = ?', row)
+        db.close()
+
+
+    def update(self, paths=None, force=False):
+        """List fields which have changed since last update, and update
+        their images. Experiments which no longer exist are removed. Raises
+        ValueError if a path is not in catalog, see ``add``.
+
+        Parameters
+        ----------
+        paths : list of strings
+            Experiments to update, all in catalog if not given.
+        force : bool
+            List all fields, also those with same modification time. Needed
+            if images are rewritten in place.
+
+        Returns
+        -------
+        int
+            Number of images added, changed or removed.
+        """
+        known = self.experiments
+        if paths is None:
+            paths = known
+        paths = [os.path.abspath(p) for p in paths]
+        for path in paths:
+            if path not in known:
+                raise ValueError('{} is not in catalog, add it with '
+                                 'add()'.format(path))
+        changes = 0
+        for path in paths:
+            if not os.path.isdir(path):
+                self.remove(path)
+                continue
+            changes += self._update_experiment(path, force)
+        return changes
+
+
+    def _update_experiment(self, path, force):
+        from .scan import _dirs, scandir
+        from .experiment import _slide, _chamber, _field
+        db = self._connect()
+        with db:
+            id_ = db.execute('SELECT id FROM experiments WHERE path = ?',
+                             (path,)).fetchone()[0]
+            known = dict(db.execute('SELECT path, mtime FROM fields WHERE '
+                                    'experiment = ?', (id_,)).fetchall())
+            changes = 0
+            seen = set()
+            for slide in _dirs(path, _slide + '--'):
+                for well in _dirs(slide, _chamber + '--'):
+                    for field in _dirs(well, _field + '--'):
+                        seen.add(field)
+                        mtime = os.stat(field).st_mtime
+                        if not force and known.get(field) == mtime:
+                            continue
+                        changes += self._update_field(db, id_, field,
+                                                      scandir)
+                        db.execute('INSERT OR REPLACE INTO fields (path, '
+                                   'experiment, mtime) VALUES (?, ?, ?)',
+                                   (field, id_, mtime))
+            for field in set(known) - seen:
+                changes += db.execute('DELETE FROM images WHERE field = ?',
+                                      (field,)).rowcount
+                db.execute('DELETE FROM fields WHERE path = ?', (field,))
+            db.execute('UPDATE experiments SET updated = ? WHERE id = ?',
+                       (time.time(), id_))
+        db.close()
+        return changes
+
+
+    def _update_field(self, db, id_, field, scandir):
+        "Replace images of field, returns number of changed images."
+        from .experiment import _image
+        from .index import ImageTable
+        images = {}
+        for e in scandir(field):
+            name = e.name
+            if name.startswith(_image + '--') and (name.endswith('.tif') or
+                                                   name.endswith('.png')):
+                st = e.stat()
+                images[e.path] = (st.st_size, st.st_mtime)
+        old = dict(((row[0], (row[1], row[2])) for row in db.execute(
+            'SELECT path, size, mtime FROM images WHERE field = ?',
+            (field,))))
+        changed = set(p for p in images if old.get(p) != images[p])
+        removed = set(old) - set(images)
+        for p in removed:
+            db.execute('DELETE FROM images WHERE path = ?', (p,))
+        if changed:
+            table = ImageTable(sorted(changed))
+            columns = dict((k, v.tolist()) for k, v in table.columns.items())
+            rows = []
+            for i, p in enumerate(table.paths):
+                size, mtime = images[p]
+                attrs = [columns[k][i] for k in 'SUVXYZCT']
+                attrs = [None if a < 0 else a for a in attrs]
+                rows.append([id_, p, field] + attrs +
+                            [size, mtime, int(p.endswith('.png'))])
+            db.executemany('INSERT OR REPLACE INTO images (experiment, path, '
+                           'field, s, u, v, x, y, z, c, t, size, mtime, '
+                           'compressed) VALUES ({})'.format(
+                               ', '.join('?' * 14)), rows)
+        return len(changed) + len(removed)
+
+
+    def query(self, experiment=None, since=None, until=None, compressed=None,
+              **criteria):
+        """Images matching all criteria, in all experiments.
+
+            >>> catalog.query(C=1, U=3, V=5, since=time.time() - 30 * 86400)
+
+        Parameters
+        ----------
+        experiment : string
+            Glob pattern of experiment folder name, like
+            ``experiment--2024-05*``.
+        since, until : float
+            Range of modification time of images, seconds since epoch.
+        compressed : bool
+            Only PNGs if true, only TIFFs if false.
+        criteria : keyword arguments
+            Attributes S, U, V, X, Y, Z, C or T with an int, a list of ints
+            or a ``range``.
+
+        Returns
+        -------
+        list of dicts
+            ``experiment`` (path), ``path``, attributes, ``size``, ``mtime``
+            and ``compressed`` of each image, ordered by path.
+        """
+        where, args = [], []
+        for key, value in sorted(criteria.items()):
+            key = key.lower()
+            if len(key) != 1 or key not in 'suvxyzct':
+                raise ValueError('Unknown attribute {}'.format(key))
+            bounds = range_bounds(value)
+            if bounds is not None:
+                where.append('i.{0} >= ? AND i.{0} < ?'.format(key))
+                args.extend(bounds)
+            elif isinstance(value, (list, tuple, set, range_type)):
+                value = list(value)
+                where.append('i.{} IN ({})'.format(key, ', '.join('?' *
+                                                                  len(value))))
+                args.extend(value)
+            else:
+                where.append('i.{} = ?'.format(key))
+                args.append(value)
+        if experiment is not None:
+            where.append('e.name GLOB ?')
+            args.append(experiment)
+        if since is not None:
+            where.append('i.mtime >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('i.mtime < ?')
+            args.append(until)
+        if compressed is not None:
+            where.append('i.compressed = ?')
+            args.append(int(bool(compressed)))
+
+        sql = ('SELECT e.path, {} FROM images i JOIN experiments e ON '
+               'i.experiment = e.id'.format(', '.join('i.' + c for c in
+                                                      _columns[1:])))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        db = self._connect()
+        rows = db.execute(sql + ' ORDER BY i.path', args).fetchall()
+        db.close()
+        records = [dict(zip(_columns, row)) for row in rows]
+        for record in records:
+            record['compressed'] = bool(record['compressed'])
+        return records
+
+
+    def __str__(self):
+        return 'leicaexperiment.ExperimentCatalog({})'.format(self.path)
+
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,93 @@
+# encoding: utf-8
+"""
+Command line interface, ``leicaexperiment COMMAND``. Run
+``leicaexperiment --help`` for commands.
+"""
+import argparse, sys
+
+
+def main(argv=None):
+    "Entry point of ``leicaexperiment`` command."
+    parser = argparse.ArgumentParser(prog='leicaexperiment',
+        description='Read, stitch and compress Leica LAS Matrix Screener '
+                    'experiments.')
+    commands = parser.add_subparsers(dest='command')
+
+    serve = commands.add_parser('serve',
+        help='serve tiles of fields and stitched wells over HTTP')
+    serve.add_argument('path', help='path to experiment')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--tile-size', type=int, default=256)
+    serve.add_argument('--cache-size', type=int, default=512,
+                       help='number of decoded images and tiles in memory')
+    serve.add_argument('--refresh', type=float, default=10,
+                       help='seconds before experiment is listed again')
+
+    work = commands.add_parser('work',
+        help='process units from a distributed work queue')
+    work.add_argument('queue', help='filename of queue database')
+    work.add_argument('--lease', type=float, default=600)
+    work.add_argument('--poll', type=float, default=None,
+                      help='wait for units held by other workers')
+
+    for name, help in [('compress', 'lossless compress images to PNG'),
+                       ('stitch', 'stitch wells with ImageJ')]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument('path', help='path to experiment')
+        command.add_argument('--folder', help='where to save output')
+        command.add_argument('--timepoint', type=int, default=None)
+        command.add_argument('--workers', type=int, default=None,
+                             help='number of workers, defaults to CPUs')
+        command.add_argument('--dry-run', action='store_true',
+                             help='estimate time, output size and memory '
+                                  'instead of running')
+        command.add_argument('--sample', type=int, default=4,
+                             help='images compressed to calibrate dry run, '
+                                  '0 to skip stitch calibration')
+
+    replay = commands.add_parser('replay',
+        help='run images which failed in compress or decompress again')
+    replay.add_argument('manifest', help='failure manifest, like '
+                        'experiment/AdditionalData/failed.jsonl')
+    replay.add_argument('--retries', type=int, default=2)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        from .server import serve
+        serve(args.path, args.host, args.port, args.tile_size,
+              args.cache_size, args.refresh)
+    elif args.command == 'work':
+        from .workqueue import work
+        processed = work(args.queue, args.lease, args.poll)
+        print('leicaexperiment processed {} units'.format(len(processed)))
+    elif args.command in ('compress', 'stitch'):
+        from . import experiment
+        if args.workers:
+            experiment._pools = args.workers
+        e = experiment.Experiment(args.path)
+        if args.dry_run:
+            print(e.plan(args.command, args.folder, args.timepoint,
+                         args.sample))
+        elif args.command == 'compress':
+            pngs = e.compress(folder=args.folder, timepoint=args.timepoint)
+            print('leicaexperiment compressed {} images'.format(len(pngs)))
+        else:
+            stitched = e.stitch(args.folder, timepoint=args.timepoint)
+            print('leicaexperiment stitched {} images'.format(len(stitched)))
+    elif args.command == 'replay':
+        from .batch import replay
+        results = replay(args.manifest, args.retries)
+        failed = [r for r in results if r.status == 'failed']
+        print('leicaexperiment replayed {} images, {} failed'.format(
+            len(results), len(failed)))
+        return 1 if failed else 0
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# encoding: utf-8
+"""
+Content addressed store for deduplicated compression. Each unique pixel
+plane is encoded and written once as ``{sha1}.png``, and compressed images
+are hard links to it. Large TIFF tag values, like OME-XML which is mostly
+the same in all images, are written once as ``{sha1}.json`` and referenced
+from the json of each image as ``{"blob": sha1}``.
+"""
+import hashlib, json, os, shutil, uuid
+
+
+class BlobStore:
+    def __init__(self, path, min_size=256):
+        """Folder of blobs named by content hash.
+
+        Parameters
+        ----------
+        path : string
+            Folder of blobs, created if missing. Should be on the same
+            filesystem as the compressed images, or blobs are copied
+            instead of linked.
+        min_size : int
+            Tag values shorter than this, as JSON, are kept in the json of
+            each image.
+        """
+        self.path = path
+        self.min_size = min_size
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # created by other worker
+                if not os.path.isdir(path):
+                    raise
+
+
+    def filename(self, digest, extension):
+        "Path of blob."
+        return os.path.join(self.path, digest + extension)
+
+
+    def write(self, filename, data):
+        """Write blob atomically, workers writing the same blob at the same
+        time will not see partial files."""
+        tmp = '{}.{}.tmp'.format(filename, uuid.uuid4().hex)
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+
+
+    def link(self, blob, filename):
+        "Hard link `filename` to `blob`, copy if links are not supported."
+        if os.path.isfile(filename):
+            os.remove(filename)
+        try:
+            os.link(blob, filename)
+        except (OSError, AttributeError):
+            shutil.copyfile(blob, filename)
+
+
+    def deduplicate_tags(self, tags):
+        """Replace large tag values with references to blobs.
+
+        Parameters
+        ----------
+        tags : dict
+            TIFF tags, values must be JSON serializable.
+
+        Returns
+        -------
+        dict
+            Tags with values of at least `min_size` replaced by
+            ``{"blob": sha1}``.
+        """
+        deduplicated = {}
+        for key, value in tags.items():
+            data = json.dumps(value).encode('utf-8')
+            if len(data) < self.min_size:
+                deduplicated[key] = value
+                continue
+            digest = hashlib.sha1(data).hexdigest()
+            filename = self.filename(digest, '.json')
+            if not os.path.isfile(filename):
+                self.write(filename, data)
+            deduplicated[key] = {'blob': digest}
+        return deduplicated
+
+
+    def resolve_tags(self, tags):
+        "Reverse ``deduplicate_tags``."
+        resolved = {}
+        for key, value in tags.items():
+            if isinstance(value, dict) and 'blob' in value:
+                with open(self.filename(value['blob'], '.json')) as f:
+                    value = json.load(f)
+            resolved[key] = value
+        return resolved
+
+
+
+def pixel_digest(img):
+    """SHA1 of decoded pixel plane, including its mode and size.
+
+    Parameters
+    ----------
+    img : PIL.Image.Image
+        Loaded image.
+
+    Returns
+    -------
+    string
+        Hex digest.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update('{} {} {}'.format(img.mode, *img.size).encode('utf-8'))
+    sha1.update(img.tobytes())
+    return sha1.hexdigest()
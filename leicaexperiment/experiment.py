@@ -2,28 +2,27 @@
 """
 Access matrix scans from Leica LAS AF MatrixScreener (Data Exporter)
 through an object.
+
+Heavy dependencies (fijibin, lxml, joblib and PIL) are imported in the
+functions which need them, so parsing filenames with ``attributes`` does not
+pay for them.
 """
 ##
 # imports
 ##
-import ast, os, re, pydebug, fijibin.macro
+import os, re, time, pydebug
 from collections import namedtuple
-from lxml import objectify
 
 # multiprocessing
-from .utils import chop
-from joblib import Parallel, delayed
-from multiprocessing import cpu_count
+from .utils import chop, cpu_count, fingerprint
+from .stats import Stats, run_instrumented, merge_profiles
 
-try:
-    _pools = cpu_count()
-except NotImplementedError:
-    _pools = 4
+# number of workers, number of CPUs if not set
+_pools = None
 
 # compress
 import json
-from PIL import Image
-from PIL.ImagePalette import ImagePalette
+from io import BytesIO
 from copy import copy
 
 # debug with `DEBUG=leicaexperiment python script.py`
@@ -46,13 +45,16 @@ _scanning_template = r'{ScanningTemplate}'
 
 # classes
 class Experiment:
-    def __init__(self, path):
+    def __init__(self, path, scan_threads=None):
         """Leica LAS AF MatrixScreener experiment.
 
         Parameters
         ----------
         path : string
             Path to matrix scan containing ``slide-SXX`` and ``AdditinalData``.
+        scan_threads : int
+            Number of threads listing wells in parallel when images are
+            listed. Helps on network filesystems with high latency.
 
         Attributes
         ----------
@@ -62,8 +64,14 @@ class Experiment:
             Path to folder below experiment.
         basename : string
             Foldername of experiment.
+        stats : leicaexperiment.Stats
+            Timings of glob, scan, compress and stitch calls on this
+            experiment.
         """
         _set_path(self, path)
+        self.stats = Stats()
+        self.scan_threads = scan_threads
+        self._table = None
 
         self._slide_path = _pattern(self.path, _slide)
         self._well_path = _pattern(self._slide_path, _chamber)
@@ -77,42 +85,51 @@ class Experiment:
     @property
     def slides(self):
         "List of paths to slides."
-        return glob(self._slide_path)
+        return self._glob(self._slide_path)
 
 
     @property
     def wells(self):
         "List of paths to wells."
-        return glob(self._well_path)
+        return self._glob(self._well_path)
 
 
     @property
     def fields(self):
         "List of paths to fields."
-        return glob(self._field_path)
+        return self._glob(self._field_path)
 
 
     @property
     def images(self):
-        "List of paths to images."
-        tifs = _pattern(self._image_path, extension='tif')
-        pngs = _pattern(self._image_path, extension='png')
-        imgs = []
-        imgs.extend(glob(tifs))
-        imgs.extend(glob(pngs))
-        return imgs
+        "List of paths to images, TIFFs followed by PNGs."
+        return self.scan().images
+
+
+    def scan(self):
+        """List experiment, each directory once, and classify files.
+
+        Returns
+        -------
+        leicaexperiment.scan.Scan
+            Namedtuple with sorted lists of slides, wells, fields, tifs,
+            pngs, xmls and jsons.
+        """
+        from .scan import scan
+        with self.stats.timer('scan'):
+            return scan(self.path, self.scan_threads)
 
 
     @property
     def stitched(self):
         "List of stitched images if they are in experiment folder."
-        return glob(_pattern(self.path, 'stitched'))
+        return self._glob(_pattern(self.path, 'stitched'))
 
 
     @property
     def scanning_template(self):
         "Path to {ScanningTemplate}name.xml of experiment."
-        tmpl = glob(_pattern(self.path, _additional_data, _scanning_template,
+        tmpl = self._glob(_pattern(self.path, _additional_data, _scanning_template,
                         extension='*.xml'))
         if tmpl:
             return tmpl[0]
@@ -128,29 +145,148 @@ class Experiment:
         -------
         list of ints
         """
-        return list(set([attribute(img, 'v') for img in self.images]))
+        return self.index().unique('v')
 
 
     @property
-    def well_rows(self, well_row, well_column):
+    def well_rows(self):
         """All well rows in experiment. Equivalent to --U in files.
 
         Returns
         -------
         list of ints
         """
-        return list(set([attribute(img, 'u') for img in self.images]))
+        return self.index().unique('u')
+
+
+    @property
+    def timepoints(self):
+        """All time points in experiment. Equivalent to --T in files.
+
+        Returns
+        -------
+        list of ints
+        """
+        return self.index().unique('t')
+
+
+    def index(self, cache=False):
+        """Table of images with attributes as integer columns. The
+        experiment is listed on every call, unless `cache` is given.
+
+        Parameters
+        ----------
+        cache : bool
+            Reuse table from last call, if any. Faster for many queries in
+            a row, but images added or removed since are not seen.
+
+        Returns
+        -------
+        leicaexperiment.index.ImageTable
+        """
+        from .index import ImageTable
+        if self._table is None or not cache:
+            images = self.images
+            with self.stats.timer('index'):
+                self._table = ImageTable(images)
+        return self._table
+
+
+    def select(self, table=False, cache=False, **criteria):
+        """Select images by attributes.
+
+            >>> experiment.select(C=1)
+            >>> experiment.select(U=range(0, 4), V=[1, 3], Z=slice(2, None))
+
+        Parameters
+        ----------
+        table : bool
+            Return table slice instead of list of paths.
+        cache : bool
+            Reuse table of images from last query, see ``index``.
+        criteria : keyword arguments
+            S, U, V, X, Y, Z, C or T with an int, a ``range``, a ``slice``
+            or a list of ints.
+
+        Returns
+        -------
+        list of strings or leicaexperiment.index.ImageTable
+        """
+        selected = self.index(cache).select(**criteria)
+        return selected if table else selected.tolist()
+
+
+    def iter_timepoints(self, poll=None, timeout=None):
+        """Yield images of each time point as soon as it is complete, so it
+        can be stitched or compressed while later time points are acquired.
+
+            >>> for t, images in experiment.iter_timepoints(poll=60,
+            ...                                              timeout=600):
+            ...     experiment.compress(timepoint=t)
+
+        A time point is complete when a later time point has been started,
+        or when it has as many images as the first time point. The last
+        time point is yielded when acquisition has stopped.
+
+        Parameters
+        ----------
+        poll : float
+            Seconds between listing experiment for new images. If not given,
+            images already acquired are yielded and the generator stops.
+        timeout : float
+            Stop polling when no new images have appeared in this many
+            seconds. If not given, poll until generator is closed.
+
+        Yields
+        ------
+        (t, images) : tuple of int and list of strings
+            Time point (same as --T in files) and paths of its images.
+        """
+        done = set()
+        size = None # number of images in first time point
+        count = None
+        changed = time.time()
+        while True:
+            table = self.index()
+            if len(table) != count:
+                count = len(table)
+                changed = time.time()
+            stopped = poll is None or (timeout is not None and
+                                       time.time() - changed >= timeout)
+            timepoints = table.unique('t')
+            for t in timepoints:
+                if t in done:
+                    continue
+                images = table.select(T=t).tolist()
+                if not (stopped or t != timepoints[-1] or
+                        (size is not None and len(images) >= size)):
+                    # last time point is still being acquired
+                    break
+                done.add(t)
+                if size is None:
+                    size = len(images)
+                yield t, images
+            if stopped:
+                return
+            time.sleep(poll)
 
 
     def __str__(self):
         return 'leicaexperiment.Experiment({})'.format(self.path)
 
 
+    def _glob(self, pattern):
+        "Sorted glob, timed in self.stats."
+        with self.stats.timer('glob'):
+            return glob(pattern)
+
+
     def __repr__(self):
         return self.__str__()
 
 
-    def image(self, well_row, well_column, field_row, field_column):
+    def image(self, well_row, well_column, field_row, field_column,
+              timepoint=None):
         """Get path of specified image.
 
         Parameters
@@ -163,20 +299,20 @@ class Experiment:
             Starts at 0. Same as --Y in files.
         field_column : int
             Starts at 0. Same as --X in files.
+        timepoint : int
+            Same as --T in files. Defaults to first time point found.
 
         Returns
         -------
         string
             Path to image or empty string if image is not found.
         """
-        return next((i for i in self.images
-                     if attribute(i, 'u') == well_column and
-                        attribute(i, 'v') == well_row and
-                        attribute(i, 'x') == field_column and
-                        attribute(i, 'y') == field_row), '')
+        images = self.select(U=well_column, V=well_row,
+                             X=field_column, Y=field_row, T=timepoint)
+        return images[0] if images else ''
 
 
-    def well_images(self, well_row, well_column):
+    def well_images(self, well_row, well_column, timepoint=None):
         """Get list of paths to images in specified well.
 
 
@@ -186,15 +322,15 @@ class Experiment:
             Starts at 0. Same as --V in files.
         well_column : int
             Starts at 0. Save as --U in files.
+        timepoint : int
+            Only images of this time point. Same as --T in files.
 
         Returns
         -------
         list of strings
             Paths to images or empty list if no images are found.
         """
-        return list(i for i in self.images
-                    if attribute(i, 'u') == well_column and
-                       attribute(i, 'v') == well_row)
+        return self.select(U=well_column, V=well_row, T=timepoint)
 
 
     def field_columns(self, well_row, well_column):
@@ -212,8 +348,8 @@ class Experiment:
         list of ints
             Columns found for specified well.
         """
-        imgs = self.well_images(well_row, well_column)
-        return list(set([attribute(img, 'x') for img in imgs]))
+        return self.select(table=True, U=well_column,
+                           V=well_row).unique('x')
 
 
     def field_rows(self, well_row, well_column):
@@ -231,20 +367,33 @@ class Experiment:
         list of ints
             Rows found for specified well.
         """
-        imgs = self.well_images(well_row, well_column)
-        return list(set([attribute(img, 'y') for img in imgs]))
+        return self.select(table=True, U=well_column,
+                           V=well_row).unique('y')
 
 
-    def stitch(self, folder=None):
+    def stitch(self, folder=None, profile=None, timepoint=None, preview=None):
         """Stitches all wells in experiment with ImageJ. Stitched images are
         saved in experiment root.
 
-        Images which already exists are omitted stitching.
+        Stitched images are reused if their tiles are unchanged since they
+        were stitched, see ``stitch_macro``.
 
         Parameters
         ----------
         folder : string
             Where to store stitched images. Defaults to experiment path.
+        profile : string
+            If given, run cProfile in each worker and save merged profile to
+            this filename.
+        timepoint : int
+            Only stitch this time point, see ``iter_timepoints``. Same as --T
+            in files.
+        preview : int
+            Instead of stitching with ImageJ, make previews with tiles
+            reduced by this factor, placed at their nominal positions
+            without registration. Saved as
+            ``preview--U{U}--V{V}--C{C}--Z{Z}.png``, see
+            ``leicaexperiment.preview``.
 
         Returns
         -------
@@ -252,28 +401,41 @@ class Experiment:
             Filenames of stitched images. Files which already exists before
             stitching are also returned.
         """
+        from joblib import Parallel, delayed
         debug('stitching ' + self.__str__())
         if not folder:
             folder = self.path
 
+        if preview:
+            from .preview import stitch_previews
+            wells = dict(((attribute(w, 'u'), attribute(w, 'v')), w)
+                         for w in self.wells)
+            return stitch_previews(self.select(table=True, T=timepoint),
+                                   wells, folder, preview, n_jobs=_workers(),
+                                   stats=self.stats)
+
         # create list of macros and files
         macros = []
         files = []
         for well in self.wells:
-            f,m = stitch_macro(well, folder)
+            f,m = stitch_macro(well, folder, timepoint)
             macros.extend(m)
             files.extend(f)
 
-        chopped_arguments = zip(chop(macros, _pools), chop(files, _pools))
-        chopped_filenames = Parallel(n_jobs=_pools)(delayed(fijibin.macro.run)
-                                      (macro=arg[0], output_files=arg[1])
-                                      for arg in chopped_arguments)
+        n_jobs = _workers()
+        chopped_arguments = zip(chop(macros, n_jobs), chop(files, n_jobs))
+        results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                                (_run_macros, arg, bool(profile))
+                                for arg in chopped_arguments)
+        chopped_filenames = _merge_results(results, self.stats, profile)
 
         # flatten
         return [f for list_ in chopped_filenames for f in list_]
 
 
-    def compress(self, delete_tif=False, folder=None):
+    def compress(self, delete_tif=False, folder=None, profile=None,
+                 pipeline=None, qc=False, timepoint=None, dedup=False,
+                 retries=2):
         """Lossless compress all images in experiment to PNG. If folder is
         omitted, images will not be moved.
 
@@ -285,6 +447,28 @@ class Experiment:
             Where to store PNGs. Defaults to the folder they are in.
         delete_tif : bool
             If set to truthy value, ome.tifs will be deleted after compression.
+        profile : string
+            If given, run cProfile in each worker and save merged profile to
+            this filename. Not used with `pipeline`.
+        pipeline : bool or dict
+            Overlap reading, encoding and writing with
+            ``leicaexperiment.pipeline.compress_pipelined``. A dictionary is
+            passed on as options, like ``{'readers': 8, 'read_ahead': 32}``.
+        qc : bool
+            Compute statistics of each image while it is decoded, and save
+            them in ``AdditionalData/qc.db``. Query them with ``qc``.
+        timepoint : int
+            Only compress images of this time point, see
+            ``iter_timepoints``. Same as --T in files.
+        dedup : bool
+            Store identical pixel planes and large tag values once, in
+            ``blobs`` in `folder` or ``AdditionalData/blobs``. PNGs are hard
+            links to the blobs. Not used with `pipeline`.
+        retries : int
+            Max number of retries of transient I/O errors per image. Images
+            which still fail are recorded in ``failed.jsonl`` in `folder` or
+            ``AdditionalData``, run them again with ``replay``. Not used with
+            `pipeline`.
 
         Returns
         -------
@@ -292,7 +476,568 @@ class Experiment:
             Filenames of PNG images. Files which already exists before
             compression are also returned.
         """
-        return compress(self.images, delete_tif, folder)
+        qc = self._qc_path if qc else None
+        if dedup:
+            dedup = os.path.join(folder or os.path.join(self.path,
+                                                        _additional_data),
+                                 'blobs')
+        else:
+            dedup = None
+        if timepoint is None:
+            images = self.images
+        else:
+            images = self.select(T=timepoint)
+        # images listed in index will change
+        self._table = None
+        if pipeline:
+            if dedup:
+                raise ValueError('dedup is not supported with pipeline')
+            from .pipeline import compress_pipelined
+            options = pipeline if isinstance(pipeline, dict) else {}
+            return compress_pipelined(images, delete_tif, folder,
+                                      stats=self.stats, qc=qc, **options)
+        return compress(images, delete_tif, folder, stats=self.stats,
+                        profile=profile, qc=qc, dedup=dedup, retries=retries,
+                        manifest=self._failures_path(folder))
+
+
+    def _failures_path(self, folder=None):
+        "Path to manifest of images which failed, next to output."
+        return os.path.join(folder or os.path.join(self.path,
+                                                   _additional_data),
+                            'failed.jsonl')
+
+
+    def replay(self, retries=2, folder=None):
+        """Run images which failed in ``compress`` again, with the options
+        they failed with, see ``leicaexperiment.batch.replay``.
+
+        Parameters
+        ----------
+        retries : int
+            Max number of retries of transient I/O errors per image.
+        folder : string
+            Same as `folder` given to ``compress``.
+
+        Returns
+        -------
+        list of leicaexperiment.batch.Result
+            Outcome of each image.
+        """
+        from .batch import replay
+        manifest = self._failures_path(folder)
+        if not os.path.isfile(manifest):
+            return []
+        # images listed in index will change
+        self._table = None
+        return replay(manifest, retries, stats=self.stats)
+
+
+    def plan(self, operation='compress', folder=None, timepoint=None,
+             sample=4, seed=None):
+        """Estimate wall time, output size and peak memory of ``compress``
+        or ``stitch`` without running it. A few images are compressed, or
+        one plane is stitched, to calibrate, see ``leicaexperiment.plan``.
+
+            >>> print(experiment.plan('compress'))
+
+        Parameters
+        ----------
+        operation : string
+            ``compress`` or ``stitch``.
+        folder, timepoint
+            As given to ``compress`` or ``stitch``.
+        sample : int
+            Number of images to compress for calibration. For stitch, 0
+            skips calibration.
+        seed : int
+            Seed for random sample.
+
+        Returns
+        -------
+        leicaexperiment.plan.Plan
+            Predictions for 1, 2, 4, ... workers, up to ``_workers()``.
+        """
+        from .plan import plan_compress, plan_stitch, worker_counts
+        workers = worker_counts(_workers())
+        if operation == 'compress':
+            if timepoint is None:
+                images = self.images
+            else:
+                images = self.select(T=timepoint)
+            return plan_compress(images, folder, sample, seed, workers,
+                                 stats=self.stats)
+        elif operation == 'stitch':
+            return plan_stitch(self.wells, folder or self.path, timepoint,
+                               bool(sample), workers, stats=self.stats)
+        raise ValueError("operation should be 'compress' or 'stitch'")
+
+
+    @property
+    def _qc_path(self):
+        "Path to table of image statistics."
+        return os.path.join(self.path, _additional_data, 'qc.db')
+
+
+    def qc(self, **criteria):
+        """Image statistics computed by ``compress(qc=True)``.
+
+            >>> experiment.qc(C=0, U=[0, 1])
+
+        Parameters
+        ----------
+        criteria : keyword arguments
+            Attributes U, V, X, Y, Z, C or T with an int or list of ints.
+
+        Returns
+        -------
+        list of dicts
+            ``image``, ``png``, attributes, ``min``, ``max``, ``mean``,
+            ``std``, ``saturated``, ``focus`` and ``histogram`` of each
+            image.
+        """
+        from .qc import QCTable
+        return QCTable(self._qc_path).query(**criteria)
+
+
+    def project(self, method='max', by='field', folder=None):
+        """Z-project all fields or stitched wells. Planes are reduced one at
+        a time, and z-stacks are projected in parallel.
+
+        Projections of fields are saved as PNG in a copy of the experiment
+        folder structure, at z-position 00. ``Experiment(folder).stitch()``
+        stitches projections, one stitch per channel instead of one per
+        z-plane and channel.
+
+        Parameters
+        ----------
+        method : string
+            ``max``, ``mean`` or ``focus`` (plane with best focus).
+        by : string
+            ``field`` to project images in fields, ``well`` to project
+            stitched images in experiment folder.
+        folder : string
+            Where to save projections. Defaults to ``projection--{method}``
+            in experiment folder.
+
+        Returns
+        -------
+        list of strings
+            Filenames of projections.
+        """
+        from joblib import Parallel, delayed
+        from .projection import (project_chunk, projected_filename,
+                                 z_stacks, methods)
+        if method not in methods:
+            raise ValueError('Unknown projection {}, use one of '
+                             '{}'.format(method, methods))
+        folder = folder or os.path.join(self.path, 'projection--' + method)
+
+        if by == 'field':
+            stacks = z_stacks(self.images)
+            root = self.path
+        elif by == 'well':
+            stacks = z_stacks(self.stitched)
+            root = None
+        else:
+            raise ValueError("by should be 'field' or 'well'")
+        tasks = [(stack, projected_filename(stack[0], folder, root))
+                 for stack in stacks]
+
+        n_jobs = _workers()
+        results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                                (project_chunk, (chunk, method))
+                                for chunk in chop(tasks, n_jobs))
+        chopped_filenames = _merge_results(results, self.stats)
+
+        # flatten
+        return [f for list_ in chopped_filenames for f in list_]
+
+
+    def overview(self, level=3, channel=0, z=0, folder=None, tile_size=256):
+        """Downsampled overview of plate, with wells laid out by U and V
+        and fields by X and Y. Each tile is decoded once. Well thumbnails are
+        cached, so after new wells are acquired only these are decoded, and
+        only pyramid tiles over them are rendered again.
+
+        Parameters
+        ----------
+        level : int
+            Tiles are reduced by a factor of ``2**level``.
+        channel : int
+            Channel to show. Same as --C in files.
+        z : int
+            Z-plane to show. Same as --Z in files.
+        folder : string
+            Where to save overview. Defaults to ``overview--C{C}--Z{Z}`` in
+            experiment folder.
+        tile_size : int
+            Size of tiles in pyramid.
+
+        Returns
+        -------
+        string
+            Filename of overview PNG. A tiled pyramid is saved in folder
+            ``pyramid`` next to it.
+        """
+        from .overview import build
+        folder = folder or os.path.join(self.path,
+                            'overview--C{:02d}--Z{:02d}'.format(channel, z))
+        return build(self.images, folder, level, channel, z, tile_size,
+                     n_jobs=_workers(), stats=self.stats)
+
+
+    def flatfield(self, channel=0, sample=None, seed=None, force=False):
+        """Illumination profile of channel, estimated from tiles with
+        streaming per-pixel statistics. The profile is cached in
+        ``AdditionalData/flatfield--C{C}.npz``.
+
+        Parameters
+        ----------
+        channel : int
+            Same as --C in files.
+        sample : int
+            Estimate from this many random tiles. Defaults to all tiles.
+        seed : int
+            Seed for random sample.
+        force : bool
+            Estimate again, even if profile is cached.
+
+        Returns
+        -------
+        leicaexperiment.flatfield.FlatField
+            Use ``.apply(data)`` to correct a tile.
+        """
+        from .flatfield import FlatField, estimate
+        filename = os.path.join(self.path, _additional_data,
+                                'flatfield--C{:02d}.npz'.format(channel))
+        if os.path.isfile(filename) and not force:
+            return FlatField.load(filename)
+
+        profile = estimate(self._channel_tiles(channel), sample, seed,
+                           n_jobs=_workers(), stats=self.stats)
+        profile.save(filename)
+        return profile
+
+
+    def _channel_tiles(self, channel):
+        "Images of channel, PNG or ome.tif but not both."
+        from .projection import _strip_extension
+        names = set()
+        tiles = []
+        for image in self.images:
+            name = _strip_extension(image)
+            if attribute(image, 'c') == channel and name not in names:
+                names.add(name)
+                tiles.append(image)
+        return tiles
+
+
+    def histogram(self, channel=0, sample=None, seed=None, force=False):
+        """Histogram of intensities in all tiles of channel. The histogram
+        is cached in ``AdditionalData/histogram--C{C}.npy``.
+
+        Parameters
+        ----------
+        channel : int
+            Same as --C in files.
+        sample : int
+            Count this many random tiles. Defaults to all tiles.
+        seed : int
+            Seed for random sample.
+        force : bool
+            Count again, even if histogram is cached.
+
+        Returns
+        -------
+        numpy.ndarray
+            Count of each intensity level, int64 of length 65536.
+        """
+        import numpy as np
+        from .render import histogram
+        filename = os.path.join(self.path, _additional_data,
+                                'histogram--C{:02d}.npy'.format(channel))
+        if os.path.isfile(filename) and not force:
+            return np.load(filename)
+
+        tiles = self._channel_tiles(channel)
+        if sample and sample < len(tiles):
+            rng = np.random.RandomState(seed)
+            tiles = [tiles[i] for i in
+                     sorted(rng.choice(len(tiles), sample, replace=False))]
+        counts = histogram(tiles, n_jobs=_workers(), stats=self.stats)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        np.save(filename, counts)
+        return counts
+
+
+    def contrast_limits(self, low=0.1, high=99.9, sample=None, seed=None,
+                        force=False):
+        """Plate wide contrast limits of each channel, from cached
+        histograms, see ``histogram``.
+
+        Parameters
+        ----------
+        low, high : float
+            Percentiles of intensities mapped to black and full color.
+        sample, seed, force
+            See ``histogram``.
+
+        Returns
+        -------
+        dict
+            ``{channel: (low, high)}``
+        """
+        from .render import contrast_limits
+        limits = {}
+        for channel in self.index().unique('c'):
+            counts = self.histogram(channel, sample, seed, force)
+            limits[channel] = contrast_limits(counts, low, high)
+        return limits
+
+
+    def render(self, by='field', colors=None, limits=None, folder=None,
+               format='png', quality=90):
+        """Render channels of each field or stitched well as an 8 bit RGB
+        composite, with the same contrast for the whole plate.
+
+            >>> e.render(by='stitched', colors={0: (255, 255, 255)})
+
+        Parameters
+        ----------
+        by : string
+            ``field`` for a composite of each field, time point and z-plane,
+            ``stitched`` for each stitched well, see ``stitched``.
+        colors : dict
+            ``{channel: (r, g, b)}``. Only these channels are rendered.
+            Defaults to all channels, colored as in
+            ``leicaexperiment.render.colors``.
+        limits : dict
+            ``{channel: (low, high)}``. Defaults to ``contrast_limits()``.
+        folder : string
+            Where to save composites, defaults to ``composite`` in experiment
+            folder.
+        format : string
+            ``png`` or ``jpg``.
+        quality : int
+            JPEG quality.
+
+        Returns
+        -------
+        list of strings
+            Filenames of composites.
+        """
+        from . import render
+        from .projection import _strip_extension
+        folder = folder or os.path.join(self.path, 'composite')
+
+        # {filename: {channel: path}}
+        composites = {}
+        if by == 'field':
+            names = set()
+            for image in self.images:
+                name = _strip_extension(image)
+                if name in names:
+                    continue
+                names.add(name)
+                a = attributes(image)
+                filename = ('composite--U{a.U}--V{a.V}--X{a.X}--Y{a.Y}--Z{a.Z}'
+                            '--T{a.T}.{}'.format(format, a=a))
+                composites.setdefault(filename, {})[a.c] = image
+        elif by == 'stitched':
+            for image in self.stitched:
+                name = re.sub('--C[0-9]{2}', '', os.path.basename(image))
+                name = 'composite' + _strip_extension(name)[len('stitched'):]
+                composites.setdefault(name + '.' + format, {})[
+                    attribute(os.path.basename(image), 'c')] = image
+        else:
+            raise ValueError("by should be 'field' or 'stitched'")
+
+        if colors is None:
+            channels = sorted(set(c for paths in composites.values()
+                                  for c in paths))
+            if len(channels) == 1:
+                colors = {channels[0]: (255, 255, 255)}
+            else:
+                colors = dict((c, render.colors[i % len(render.colors)])
+                              for i, c in enumerate(channels))
+        if limits is None:
+            limits = self.contrast_limits()
+        luts = dict((c, render.lut(limits[c], colors[c])) for c in colors)
+        tasks = [(os.path.join(folder, f), composites[f])
+                 for f in sorted(composites)]
+        return render.render(tasks, luts, n_jobs=_workers(),
+                             stats=self.stats, quality=quality)
+
+
+    def read(self, image, flatfield=False):
+        """Pixel data of image as numpy array.
+
+        Parameters
+        ----------
+        image : string
+            Path to ome.tif or PNG.
+        flatfield : bool
+            Correct illumination with profile of image's channel, see
+            ``flatfield``.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        from .pixels import read
+        data = read(image)
+        if flatfield:
+            data = self.flatfield(attribute(image, 'c')).apply(data)
+        return data
+
+
+    def open_image(self, image, mmap=True):
+        """Pixel data of image, without decoding it if it is an uncompressed
+        ome.tif. The TIFF is memory mapped, so cropping or sampling it only
+        reads the bytes touched.
+
+            >>> tile = experiment.open_image(experiment.images[0])
+            >>> corner = np.array(tile[:64, :64])
+
+        Parameters
+        ----------
+        image : string
+            Path to ome.tif or PNG.
+        mmap : bool
+            Memory map if possible. Compressed images are always decoded.
+
+        Returns
+        -------
+        numpy.memmap or numpy.ndarray
+            Read only view of image, or decoded image.
+        """
+        from .tiff import open_image
+        return open_image(image, mmap)
+
+
+    def to_zarr(self, path, levels=3, compression=1):
+        """Export experiment as OME-Zarr plate (NGFF 0.4 HCS), from ome.tifs
+        or compressed PNGs. Wells are written in parallel, one plane per
+        chunk.
+
+        Parameters
+        ----------
+        path : string
+            Folder of zarr plate, typically ending with ``.zarr``.
+        levels : int
+            Number of resolution levels, each halving the previous.
+        compression : int
+            zlib compression level of chunks, 0-9.
+
+        Returns
+        -------
+        string
+            Path of zarr plate.
+        """
+        from .ngff import to_zarr
+        return to_zarr(self.images, path, self.basename, levels, compression,
+                       n_jobs=_workers(), stats=self.stats)
+
+
+    def map(self, func, by='well', reduce=None, cache=True):
+        """Call `func` on each well, field or image in parallel, and memoize
+        results on disk. Results are computed again when the images of a
+        group or the code of `func` changes.
+
+            >>> def mean(group):
+            ...     return [data.mean() for data in group.read()]
+            >>> experiment.map(mean, by='field')
+            {(0, 0, 0, 0): [...], ...}
+
+        Parameters
+        ----------
+        func : callable
+            Called with a ``leicaexperiment.index.ImageTable`` of the
+            group. Read pixel data in the worker with ``group.read()``, or
+            ``group.select(C=1).read()``.
+        by : string
+            ``well``, ``field`` or ``image``.
+        reduce : callable
+            If given, called with the dictionary of results, and its return
+            value is returned.
+        cache : bool or string
+            Folder of memoized results. Defaults to ``AdditionalData/map``.
+            False to not memoize.
+
+        Returns
+        -------
+        dict
+            ``{key: result}``, where key is ``(u, v)`` for wells,
+            ``(u, v, x, y)`` for fields and the path for images.
+        """
+        from .mapreduce import groups, map_groups
+        if cache is True:
+            cache = os.path.join(self.path, _additional_data, 'map')
+        results = map_groups(func, groups(self.index(), by),
+                             cache or None, n_jobs=_workers(),
+                             stats=self.stats)
+        return reduce(results) if reduce else results
+
+
+    def archive(self, dest, compress=True, delete=False, verify=True,
+                writers=4, bandwidth=None):
+        """Copy experiment to archive in one pass, with TIFFs compressed to
+        PNG on the way. Files are checksummed and recorded in
+        ``archive.jsonl`` in `dest`, so an interrupted archive can be
+        resumed by calling this again.
+
+        Parameters
+        ----------
+        dest : string
+            Destination folder, like a mounted share.
+        compress : bool
+            Write TIFFs as PNG and json.
+        delete : bool
+            Delete files in experiment when their copy is verified.
+        verify : bool
+            Read back written files and compare checksums.
+        writers : int
+            Number of files written in parallel.
+        bandwidth : float
+            Max bytes per second written to `dest`.
+
+        Returns
+        -------
+        list of strings
+            Files in destination.
+        """
+        from .archive import archive
+        files = archive(self.path, dest, compress, delete, verify, writers,
+                        bandwidth, stats=self.stats)
+        if delete:
+            self._table = None
+        return files
+
+
+    def distribute(self, queue, operation='compress', **kwargs):
+        """Put one unit of work per well in a shared work queue. Start
+        workers on each host with ``leicaexperiment.workqueue.work(queue)``.
+
+        Parameters
+        ----------
+        queue : string
+            Filename of queue database, on a filesystem shared by workers.
+        operation : string
+            ``compress`` or ``stitch``.
+        kwargs : keyword arguments
+            Passed on to operation, like `folder` or `delete_tif`.
+
+        Returns
+        -------
+        leicaexperiment.WorkQueue
+        """
+        from .workqueue import WorkQueue
+        q = WorkQueue(queue)
+        for well in self.wells:
+            q.put(operation, well, **kwargs)
+        return q
 
 
     def field_metadata(self, well_row=0, well_column=0,
@@ -315,6 +1060,8 @@ class Experiment:
         lxml.objectify.ObjectifiedElement
             lxml object of OME-XML found in slide/chamber/field/metadata.
         """
+        from lxml import objectify
+
         def condition(path):
             attrs = attributes(path)
             return (attrs.u == well_column and attrs.v == well_row
@@ -345,6 +1092,7 @@ class Experiment:
         (xs, ys, attr) : tuples with float and collections.OrderedDict
             Tuple of x's, y's and attributes.
         """
+        import ast
         well = [w for w in self.wells
                     if attribute(w, 'u') == well_column and
                        attribute(w, 'v') == well_row]
@@ -371,8 +1119,15 @@ class Experiment:
 
 
 # methods
-def stitch_macro(path, output_folder=None):
+def stitch_macro(path, output_folder=None, timepoint=None, dry_run=False):
     """Create fiji-macros for stitching all channels and z-stacks for a well.
+    Time points are stitched separately. If the well has several time
+    points or `timepoint` is given, stitched filenames include ``--T``.
+
+    Stitched images are reused if their input tiles (path, size and mtime)
+    and stitch parameters are unchanged since they were stitched, as
+    recorded in ``stitched.json`` in the well folder. Stitched images from
+    before the cache are reused if they are newer than their tiles.
 
     Parameters
     ----------
@@ -380,12 +1135,17 @@ def stitch_macro(path, output_folder=None):
         Well path.
     output_folder : string
         Folder to store images. If not given well path is used.
+    timepoint : int
+        Only stitch this time point. Same as --T in files.
+    dry_run : bool
+        Do not update ``stitched.json``, for planning.
 
     Returns
     -------
     output_files, macros : tuple
         Tuple with filenames and macros for stitched well.
     """
+    import fijibin.macro
     output_folder = output_folder or path
     debug('stitching ' + path + ' to ' + output_folder)
 
@@ -406,10 +1166,16 @@ def stitch_macro(path, output_folder=None):
     # assume attributes are the same on all images
     attr = attributes(images[0])
 
-    # find all channels and z-stacks
+    # find all time points, channels and z-stacks
+    timepoints = []
     channels = []
     z_stacks = []
     for image in images:
+        # as in filename, LAS X uses four digits
+        T = attributes(image).T
+        if T not in timepoints:
+            timepoints.append(T)
+
         channel = attribute_as_str(image, 'C')
         if channel not in channels:
             channels.append(channel)
@@ -418,6 +1184,14 @@ def stitch_macro(path, output_folder=None):
         if z not in z_stacks:
             z_stacks.append(z)
 
+    # keep old filenames of experiments without time-lapse
+    name = 'stitched--U{U}--V{V}--T{T}--C{C}--Z{Z}.png'
+    if timepoint is None and len(timepoints) == 1:
+        name = 'stitched--U{U}--V{V}--C{C}--Z{Z}.png'
+    if timepoint is not None:
+        timepoints = [T for T in timepoints if int(T) == timepoint]
+
+    debug('time points ' + str(timepoints))
     debug('channels ' + str(channels))
     debug('z-stacks ' + str(z_stacks))
 
@@ -426,50 +1200,109 @@ def stitch_macro(path, output_folder=None):
     if extension == '.tif':
         # assume .ome.tif
         extension = '.ome.tif'
+
+    # input tiles of each stitched image
+    tiles = {}
+    for image in glob(_pattern(_pattern(path, _field), _image,
+                               extension='--*' + extension)):
+        key = (attributes(image).T, attribute_as_str(image, 'Z'),
+               attribute_as_str(image, 'C'))
+        tiles.setdefault(key, []).append(image)
+    cache_file = os.path.join(path, 'stitched.json')
+    cache = _read_stitch_cache(cache_file)
+    changed = False
+
     macros = []
     output_files = []
-    for Z in z_stacks:
-        for C in channels:
-            filenames = os.path.join(
-
-                    _field + '--X{xx}--Y{yy}',
-                    _image + '--L' + attr.L +
-                    '--S' + attr.S +
-                    '--U' + attr.U +
-                    '--V' + attr.V +
-                    '--J' + attr.J +
-                    '--E' + attr.E +
-                    '--O' + attr.O +
-                    '--X{xx}--Y{yy}' +
-                    '--T' + attr.T +
-                    '--Z' + Z +
-                    '--C' + C +
-                    extension)
-            debug('filenames ' + filenames)
-
-            cur_attr = attributes(filenames)._asdict()
-            f = 'stitched--U{U}--V{V}--C{C}--Z{Z}.png'.format(**cur_attr)
-
-            output = os.path.join(output_folder, f)
-            debug('output ' + output)
-            output_files.append(output)
-            if os.path.isfile(output):
-                # file already exists
-                print('leicaexperiment stitched file already'
-                      ' exists {}'.format(output))
-                continue
-            macros.append(fijibin.macro.stitch(path, filenames,
-                                  fields_column, fields_row,
-                                  output_filename=output,
-                                  x_start=x_min, y_start=y_min))
-
+    for T, Z, C in ((T, Z, C) for T in timepoints
+                    for Z in z_stacks for C in channels):
+        filenames = os.path.join(
+
+                _field + '--X{xx}--Y{yy}',
+                _image + '--L' + attr.L +
+                '--S' + attr.S +
+                '--U' + attr.U +
+                '--V' + attr.V +
+                '--J' + attr.J +
+                '--E' + attr.E +
+                '--O' + attr.O +
+                '--X{xx}--Y{yy}' +
+                '--T' + T +
+                '--Z' + Z +
+                '--C' + C +
+                extension)
+        debug('filenames ' + filenames)
+
+        cur_attr = attributes(filenames)._asdict()
+        f = name.format(**cur_attr)
+
+        output = os.path.join(output_folder, f)
+        debug('output ' + output)
+        output_files.append(output)
+
+        inputs = tiles.get((T, Z, C), [])
+        digest = fingerprint(inputs, filenames, fields_column, fields_row,
+                             x_min, y_min)
+        key = os.path.abspath(output)
+        if _stitch_cached(cache, key, output, digest, inputs):
+            print('leicaexperiment stitched file up to date {}'.format(output))
+            if key not in cache:
+                cache[key] = {'digest': digest, 'time': 0}
+                changed = True
+            continue
+        # mtime of output must be after this, allow for coarse mtimes
+        cache[key] = {'digest': digest, 'time': time.time() - 2}
+        changed = True
+        macros.append(fijibin.macro.stitch(path, filenames,
+                              fields_column, fields_row,
+                              output_filename=output,
+                              x_start=x_min, y_start=y_min))
+
+    if changed and not dry_run:
+        _write_stitch_cache(cache_file, cache)
     return (output_files, macros)
 
 
-def compress(images, delete_tif=False, folder=None):
+def _stitch_cached(cache, key, output, digest, inputs):
+    """Whether stitched image `output` can be reused. It is reused if it is
+    written after it was scheduled with the same fingerprint of inputs. If it
+    is not in cache, it is reused if it is newer than its inputs."""
+    if not os.path.isfile(output):
+        return False
+    mtime = os.path.getmtime(output)
+    entry = cache.get(key)
+    if entry is None:
+        return all(os.path.getmtime(i) <= mtime for i in inputs)
+    return entry['digest'] == digest and mtime >= entry['time']
+
+
+def _read_stitch_cache(filename):
+    "Stitch cache of well, ``{output: {'digest': ..., 'time': ...}}``."
+    if not os.path.isfile(filename):
+        return {}
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except ValueError:
+        # corrupt, stitch again
+        return {}
+
+
+def _write_stitch_cache(filename, cache):
+    "Replace stitch cache atomically."
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def compress(images, delete_tif=False, folder=None, stats=None,
+             profile=None, qc=None, dedup=None, retries=2, manifest=None,
+             results=False):
     """Lossless compression. Save images as PNG and TIFF tags to json. Can be
     reversed with `decompress`. Will run in multiprocessing, where
-    number of workers is decided by ``leicaexperiment.experiment._pools``.
+    number of workers is decided by ``leicaexperiment.experiment._pools``
+    (defaults to number of CPUs).
 
     Parameters
     ----------
@@ -479,25 +1312,110 @@ def compress(images, delete_tif=False, folder=None):
         Wheter to delete original images.
     folder : string
         Where to store images. Basename will be kept.
+    stats : leicaexperiment.Stats
+        If given, timings from all workers are merged into this object.
+    profile : string
+        If given, run cProfile in each worker and save merged profile to
+        this filename.
+    qc : string
+        If given, statistics of each image are computed while it is decoded
+        and saved in SQLite table with this filename, see
+        ``leicaexperiment.qc``.
+    dedup : string
+        If given, identical pixel planes and large tag values are stored
+        once in this folder, see ``leicaexperiment.dedup``.
+    retries : int
+        Max number of retries of transient I/O errors per image, see
+        ``leicaexperiment.batch``.
+    manifest : string
+        If given, images which fail are recorded in this failure manifest,
+        so they can be replayed with ``leicaexperiment.batch.replay``.
+    results : bool
+        Return ``leicaexperiment.batch.Result`` of each image instead of
+        filenames.
 
     Returns
     -------
     list of filenames
-        List of compressed files.
+        List of compressed files, empty string for images which failed.
     """
+    if stats is None:
+        stats = Stats()
     if type(images) == str:
         # only one image
-        return [compress_blocking(images, delete_tif, folder)]
-
-    filenames = copy(images) # as images property will change when looping
-
+        chopped_results = [_compress_chunk([images], delete_tif, folder, qc,
+                                           dedup, retries, stats)]
+    else:
+        from joblib import Parallel, delayed
+        filenames = copy(images) # as images property will change when looping
+
+        n_jobs = _workers()
+        chopped = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                         (_compress_chunk, (chunk, delete_tif, folder, qc,
+                                            dedup, retries),
+                          bool(profile))
+                         for chunk in chop(filenames, n_jobs))
+        chopped_results = _merge_results(chopped, stats, profile)
+
+    # flatten
+    outcomes = [r for list_ in chopped_results for r in list_]
+    if manifest:
+        from .batch import FailureManifest
+        FailureManifest(manifest).record(outcomes, {
+            'delete_tif': delete_tif, 'folder': folder, 'qc': qc,
+            'dedup': dedup})
+    if results:
+        return outcomes
+    return [r.output for r in outcomes]
+
+
+def _compress_chunk(images, delete_tif, folder, qc, dedup, retries, stats):
+    "Compress a list of images in one worker, returns list of Result."
+    from functools import partial
+    from .batch import run
+    statistics = [] if qc else None
+    func = partial(_compress_image, delete_tif=delete_tif, folder=folder,
+                   force=False, stats=stats, statistics=statistics,
+                   dedup=dedup)
+    outcomes = [run('compress', image, func, retries, stats=stats)
+                for image in images]
+    if qc:
+        from .qc import QCTable
+        with stats.timer('qc'):
+            QCTable(qc).insert(statistics)
+    return outcomes
+
+
+def _workers():
+    "Number of workers, ``_pools`` or number of CPUs."
+    return _pools or cpu_count()
+
+
+def _run_macros(macros, output_files, stats):
+    "Run a list of fiji macros in one worker."
+    import fijibin.macro
+    with stats.timer('macro'):
+        return fijibin.macro.run(macro=macros, output_files=output_files)
+
+
+def _merge_results(results, stats=None, profile=None):
+    """Merge timings and profiles from ``run_instrumented`` workers.
 
-    return Parallel(n_jobs=_pools)(delayed(compress_blocking)
-                     (image=image, delete_tif=delete_tif, folder=folder)
-                     for image in filenames)
+    Returns
+    -------
+    list
+        Return values from the workers.
+    """
+    if stats is not None:
+        for _, timings, _ in results:
+            stats.merge(timings)
+    if profile:
+        merge_profiles([prof for _, _, prof in results], profile)
+    return [result for result, _, _ in results]
 
 
-def compress_blocking(image, delete_tif=False, folder=None, force=False):
+def compress_blocking(image, delete_tif=False, folder=None, force=False,
+                      stats=None, statistics=None, dedup=None, retries=0):
     """Lossless compression. Save image as PNG and TIFF tags to json. Process
     can be reversed with `decompress`.
 
@@ -509,76 +1427,231 @@ def compress_blocking(image, delete_tif=False, folder=None, force=False):
         Wheter to delete original images.
     force : bool
         Wheter to compress even if .png already exists.
+    stats : leicaexperiment.Stats
+        Where to record timings of read, decode, tags, encode and write.
+    statistics : list
+        If given, statistics of image are computed while it is decoded and
+        appended to this list, see ``leicaexperiment.qc.image_statistics``.
+    dedup : string
+        Folder of ``leicaexperiment.dedup.BlobStore``. If given, PNG is a
+        hard link to a blob of identical pixels, and large tags are
+        referenced from json.
+    retries : int
+        Max number of retries of transient I/O errors.
 
     Returns
     -------
     string
         Filename of compressed image, or empty string if compress failed.
     """
+    from functools import partial
+    from .batch import run
+    if stats is None:
+        stats = Stats()
+    func = partial(_compress_image, delete_tif=delete_tif, folder=folder,
+                   force=force, stats=stats, statistics=statistics,
+                   dedup=dedup)
+    return run('compress', image, func, retries, stats=stats).output
+
 
+def _compress_image(image, delete_tif, folder, force, stats, statistics,
+                    dedup):
+    """Compress one image, see ``compress_blocking``. Raises IOError or
+    AssertionError if it fails.
+
+    Returns
+    -------
+    (status, output, bytes_in, bytes_out) : tuple
+    """
     debug('compressing {}'.format(image))
-    try:
-        new_filename, extension = os.path.splitext(image)
-        # remove last occurrence of .ome
-        new_filename = new_filename.rsplit('.ome', 1)[0]
-
-        # if compressed file should be put in specified folder
-        if folder:
-            basename = os.path.basename(new_filename)
-            new_filename = os.path.join(folder, basename + '.png')
-        else:
-            new_filename = new_filename + '.png'
-
-        # check if png exists
-        if os.path.isfile(new_filename) and not force:
-            compressed_images.append(new_filename)
-            msg = "Aborting compress, PNG already" \
-                  " exists: {}".format(new_filename)
-            raise AssertionError(msg)
-        if extension != '.tif':
-            msg = "Aborting compress, not a TIFF: {}".format(image)
-            raise AssertionError(msg)
-
-        # open image, load and close file pointer
-        img = Image.open(image)
-        fptr = img.fp # keep file pointer, for closing
-        img.load() # load img-data before switching mode, also closes fp
-
-        # get tags and save them as json
-        tags = img.tag.as_dict()
-        with open(new_filename[:-4] + '.json', 'w') as f:
-            if img.mode == 'P':
-                # keep palette
-                tags['palette'] = img.getpalette()
-            json.dump(tags, f)
-
-        # check if image is palette-mode
-        if img.mode == 'P':
-            # switch to luminance to keep data intact
-            debug('palette-mode switched to luminance')
-            img.mode = 'L'
-        if img.mode == 'I;16':
-            # https://github.com/python-pillow/Pillow/issues/1099
-            img = img.convert(mode='I')
+    if not image.endswith('.tif'):
+        # like PNGs of an earlier compress, listed with the TIFFs
+        debug('not a TIFF, skipping {}'.format(image))
+        return 'skipped', '', 0, 0
+    new_filename = _compressed_filename(image, folder)
+
+    # check if png exists
+    if os.path.isfile(new_filename) and not force:
+        print('leicaexperiment Aborting compress, PNG already'
+              ' exists: {}'.format(new_filename))
+        return 'skipped', new_filename, 0, 0
+
+    # read file to memory, file pointer is closed right away
+    with stats.timer('read'):
+        with open(image, 'rb') as f:
+            data = f.read()
+
+    if dedup:
+        record = _compress_deduplicated(data, new_filename, dedup, stats,
+                                        statistics is not None)
+    else:
+        png, tags, record = _encode_png(data, stats,
+                                        statistics is not None)
+        _write_compressed(new_filename, png, tags, stats)
+    written = (os.path.getsize(new_filename) +
+               os.path.getsize(new_filename[:-4] + '.json'))
+    if record is not None:
+        record.update(image=image, png=new_filename)
+        statistics.append(record)
+
+    if delete_tif:
+        os.remove(image)
+    return 'ok', new_filename, len(data), written
+
+
+def _compressed_filename(image, folder=None):
+    """Filename of PNG for `image`, in `folder` if given. Raises
+    AssertionError if `image` is not a TIFF."""
+    new_filename, extension = os.path.splitext(image)
+    if extension != '.tif':
+        msg = "Aborting compress, not a TIFF: {}".format(image)
+        raise AssertionError(msg)
+    # remove last occurrence of .ome
+    new_filename = new_filename.rsplit('.ome', 1)[0]
+
+    # if compressed file should be put in specified folder
+    if folder:
+        basename = os.path.basename(new_filename)
+        return os.path.join(folder, basename + '.png')
+    return new_filename + '.png'
+
+
+def _encode_png(data, stats, statistics=False):
+    """Decode TIFF and encode it as PNG in memory.
 
-        # compress/save
-        debug('saving to {}'.format(new_filename))
-        img.save(new_filename)
+    Parameters
+    ----------
+    data : bytes
+        Content of TIFF file.
+    stats : leicaexperiment.Stats
+        Where to record timings of decode, tags and encode.
+    statistics : bool
+        Whether to compute image statistics of decoded image.
+
+    Returns
+    -------
+    (png, tags, statistics) : tuple
+        PNG as bytes, TIFF tags as JSON string and dict of image statistics
+        (None if not asked for).
+    """
+    img, tags, record = _decode_tiff(data, stats, statistics)
+    with stats.timer('tags'):
+        tags = json.dumps(tags)
+    return _encode(img, stats), tags, record
+
+
+def _decode_tiff(data, stats, statistics=False):
+    """Decode TIFF in memory.
+
+    Returns
+    -------
+    (img, tags, statistics) : tuple
+        Loaded PIL image, TIFF tags as dict and dict of image statistics
+        (None if not asked for).
+    """
+    from PIL import Image
 
-        fptr.close() # windows bug Pillow
-        if delete_tif:
-            os.remove(image)
+    # load img-data before switching mode
+    with stats.timer('decode'):
+        img = Image.open(BytesIO(data))
+        img.load()
 
-    except (IOError, AssertionError) as e:
-        # print error - continue
-        print('leicaexperiment {}'.format(e))
-        return ''
+    with stats.timer('tags'):
+        tags = dict(img.tag)
+        if img.mode == 'P':
+            # keep palette
+            tags['palette'] = img.getpalette()
+
+    record = None
+    if statistics:
+        import numpy as np
+        from .qc import image_statistics
+        with stats.timer('statistics'):
+            record = image_statistics(np.array(img))
+    return img, tags, record
+
+
+def _encode(img, stats):
+    "Encode decoded TIFF as PNG bytes."
+    # check if image is palette-mode
+    if img.mode == 'P':
+        # switch to luminance to keep data intact
+        debug('palette-mode switched to luminance')
+        img.mode = 'L'
+    if img.mode == 'I;16':
+        # https://github.com/python-pillow/Pillow/issues/1099
+        img = img.convert(mode='I')
+
+    # compress
+    with stats.timer('encode'):
+        png = BytesIO()
+        img.save(png, format='PNG')
+    return png.getvalue()
+
+
+def _compress_deduplicated(data, new_filename, dedup, stats,
+                           statistics=False):
+    """Decode TIFF, link PNG to blob of identical pixels, encoding it only
+    if it is not stored yet, and write tags with references to blobs.
 
-    return new_filename
+    Returns
+    -------
+    dict
+        Image statistics, None if not asked for.
+    """
+    from .dedup import BlobStore, pixel_digest
+    store = BlobStore(dedup)
+    img, tags, record = _decode_tiff(data, stats, statistics)
+    with stats.timer('hash'):
+        blob = store.filename(pixel_digest(img), '.png')
+    if not os.path.isfile(blob):
+        png = _encode(img, stats)
+        with stats.timer('write'):
+            store.write(blob, png)
+    else:
+        # count reused blobs
+        stats.add('dedup', 0)
+
+    debug('linking {} to {}'.format(new_filename, blob))
+    with stats.timer('write'):
+        tags = store.deduplicate_tags(tags)
+        # relative, so experiment can be moved
+        tags['blobs'] = os.path.relpath(store.path,
+                                        os.path.dirname(new_filename))
+        # json first, an existing PNG means compress is complete
+        _write_atomic(new_filename[:-4] + '.json',
+                      json.dumps(tags).encode('utf-8'))
+        store.link(blob, new_filename)
+    return record
+
+
+def _write_compressed(new_filename, png, tags, stats):
+    """Write PNG and TIFF tags as json next to it. Both are written
+    atomically, json first, so an existing PNG means compress is complete."""
+    debug('saving to {}'.format(new_filename))
+    with stats.timer('write'):
+        _write_atomic(new_filename[:-4] + '.json', tags.encode('utf-8'))
+        _write_atomic(new_filename, png)
+
+
+def _write_atomic(filename, data):
+    "Write bytes to a temporary file, renamed when complete."
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, filename)
+    except BaseException:
+        # do not leave partial files, retries and replay write them again
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
 
 
 
-def decompress(images, delete_png=False, delete_json=False, folder=None):
+def decompress(images, delete_png=False, delete_json=False, folder=None,
+               stats=None, to='file', retries=2, manifest=None,
+               results=False):
     """Reverse compression from tif to png and save them in original format
     (ome.tif). TIFF-tags are gotten from json-files named the same as given
     images.
@@ -592,86 +1665,244 @@ def decompress(images, delete_png=False, delete_json=False, folder=None):
         Wheter to delete PNG images.
     delete_json : bool
         Wheter to delete TIFF-tags stored in json files on compress.
+    stats : leicaexperiment.Stats
+        Where to record timings of decode, tags and encode.
+    to : string
+        ``file`` to save ome.tifs. ``array`` or ``bytes`` to decompress in
+        memory, in parallel, see ``iter_decompressed``. Nothing is written
+        or deleted then.
+    retries : int
+        Max number of retries of transient I/O errors per image, see
+        ``leicaexperiment.batch``. Only used with `to` ``file``.
+    manifest : string
+        If given, images which fail are recorded in this failure manifest,
+        so they can be replayed with ``leicaexperiment.batch.replay``.
+    results : bool
+        Return ``leicaexperiment.batch.Result`` of each image instead of
+        filenames.
 
     Returns
     -------
-    list of filenames
-        List of decompressed files.
+    list
+        List of decompressed files, or with `to` ``array`` a list of
+        ``(numpy.ndarray, tags)`` and with `to` ``bytes`` a list of ome.tifs
+        as bytes. Images which fail are left out.
     """
     if type(images) == str:
         # only one image
-        return decompress([images])
+        return decompress([images], delete_png, delete_json, folder, stats,
+                          to, retries, manifest, results)
+    if to != 'file':
+        if delete_png or delete_json or manifest or results:
+            raise ValueError("delete_png, delete_json, manifest and results "
+                             "are only used with to='file'")
+        return [result for _, result
+                in iter_decompressed(images, to, stats=stats)]
+    from functools import partial
+    from .batch import run
+    if stats is None:
+        stats = Stats()
 
     filenames = copy(images) # as images property will change when looping
 
-    decompressed_images = []
-    for orig_filename in filenames:
-        debug('decompressing {}'.format(orig_filename))
-        try:
-            filename, extension = os.path.splitext(orig_filename)
+    func = partial(_decompress_image, delete_png=delete_png,
+                   delete_json=delete_json, folder=folder, stats=stats)
+    outcomes = [run('decompress', filename, func, retries, stats=stats)
+                for filename in filenames]
+    if manifest:
+        from .batch import FailureManifest
+        FailureManifest(manifest).record(outcomes, {
+            'delete_png': delete_png, 'delete_json': delete_json,
+            'folder': folder})
+    if results:
+        return outcomes
+    return [r.output for r in outcomes if r.output]
+
+
+def _decompress_image(orig_filename, delete_png, delete_json, folder,
+                      stats):
+    """Decompress one image to ome.tif, see ``decompress``. Raises IOError
+    or AssertionError if it fails.
 
-            # if decompressed file should be put in specified folder
-            if folder:
-                basename = os.path.basename(filename)
-                new_filename = os.path.join(folder, basename + '.ome.tif')
-            else:
-                new_filename = filename + '.ome.tif'
-
-            # check if tif exists
-            if os.path.isfile(new_filename):
-                decompressed_images.append(new_filename)
-                msg = "Aborting decompress, TIFF already exists:" \
-                      " {}".format(orig_filename)
-                raise AssertionError(msg)
-            if extension != '.png':
-                msg = "Aborting decompress, not a " \
-                      "PNG: {}".format(orig_filename)
-                raise AssertionError(msg)
-
-            # open image, load and close file pointer
-            img = Image.open(orig_filename)
-            img.load() # load img-data before switching mode, also closes fp
-
-            # get tags from json
-            info = {}
-            with open(filename + '.json', 'r') as f:
-                tags = json.load(f)
-                # convert dictionary to original types (lost in json conversion)
-                for tag,val in tags.items():
-                    if tag == 'palette':
-                        # hack hack
-                        continue
-                    if type(val) == list:
-                        val = tuple(val)
-                    if type(val[0]) == list:
-                        # list of list
-                        val = tuple(tuple(x) for x in val)
-                    info[int(tag)] = val
-
-            # check for color map
-            if 'palette' in tags:
-                img.putpalette(tags['palette'])
-
-            # save as tif
-            debug('saving to {}'.format(new_filename))
-            img.save(new_filename, tiffinfo=info)
-            decompressed_images.append(new_filename)
-
-            if delete_png:
-                os.remove(orig_filename)
-            if delete_json:
-                os.remove(filename + '.json')
-
-        except (IOError, AssertionError) as e:
-            # print error - continue
-            print('leicaexperiment {}'.format(e))
-
-    return decompressed_images
+    Returns
+    -------
+    (status, output, bytes_in, bytes_out) : tuple
+    """
+    debug('decompressing {}'.format(orig_filename))
+    filename, extension = os.path.splitext(orig_filename)
+
+    # if decompressed file should be put in specified folder
+    if folder:
+        basename = os.path.basename(filename)
+        new_filename = os.path.join(folder, basename + '.ome.tif')
+    else:
+        new_filename = filename + '.ome.tif'
+
+    # check if tif exists
+    if os.path.isfile(new_filename):
+        print('leicaexperiment Aborting decompress, TIFF already exists:'
+              ' {}'.format(orig_filename))
+        return 'skipped', new_filename, 0, 0
+
+    img, info = _read_compressed(orig_filename, stats)
+    read = (os.path.getsize(orig_filename) +
+            os.path.getsize(filename + '.json'))
+
+    # save as tif, renamed when complete
+    debug('saving to {}'.format(new_filename))
+    tmp = '{}.{}.tmp'.format(new_filename, os.getpid())
+    try:
+        with stats.timer('encode'):
+            img.save(tmp, format='TIFF', tiffinfo=info)
+        os.rename(tmp, new_filename)
+    except BaseException:
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        raise
+    written = os.path.getsize(new_filename)
+
+    if delete_png:
+        os.remove(orig_filename)
+    if delete_json:
+        os.remove(filename + '.json')
+    return 'ok', new_filename, read, written
+
+
+def iter_decompressed(images, to='array', read_ahead=8, threads=None,
+                      stats=None):
+    """Decompress images in memory, in parallel threads, without writing
+    ome.tifs. At most `read_ahead` images are decompressed ahead of the
+    one being consumed, which bounds memory use.
+
+        >>> for png, (data, tags) in iter_decompressed(pngs):
+        ...     analyze(data)
+
+    Parameters
+    ----------
+    images : list of filenames
+        PNGs to decompress.
+    to : string
+        ``array`` for pixel data and TIFF tags, ``bytes`` for ome.tif in
+        memory.
+    read_ahead : int
+        Max number of decompressed images waiting to be consumed.
+    threads : int
+        Number of threads. Defaults to number of CPUs.
+    stats : leicaexperiment.Stats
+        Where to record timings of decode, tags and encode.
+
+    Yields
+    ------
+    (filename, result) : tuple
+        Result is ``(numpy.ndarray, tags)`` for ``array``, where tags is a
+        dictionary of TIFF tags, and bytes of ome.tif for ``bytes``. Images
+        which fail are printed and skipped.
+    """
+    from collections import deque
+    from multiprocessing.pool import ThreadPool
+    if to not in ('array', 'bytes'):
+        raise ValueError("to should be 'array' or 'bytes'")
+    if type(images) == str:
+        images = [images]
+    images = iter(copy(images))
+
+    pool = ThreadPool(threads or cpu_count())
+    pending = deque()
+    try:
+        for image in images:
+            pending.append((image, pool.apply_async(_decompress_in_memory,
+                                                    (image, to))))
+            if len(pending) >= read_ahead:
+                break
+        while pending:
+            image, result = pending.popleft()
+            # keep read ahead full
+            for next_image in images:
+                pending.append((next_image, pool.apply_async(
+                    _decompress_in_memory, (next_image, to))))
+                break
+            try:
+                output, timings = result.get()
+            except (IOError, AssertionError) as e:
+                print('leicaexperiment {}'.format(e))
+                continue
+            if stats is not None:
+                stats.merge(timings)
+            yield image, output
+    finally:
+        pool.terminate()
+
+
+def _decompress_in_memory(image, to):
+    "Decompress to array and tags or ome.tif bytes, with own timings."
+    stats = Stats()
+    debug('decompressing {}'.format(image))
+    img, info = _read_compressed(image, stats)
+    if to == 'bytes':
+        with stats.timer('encode'):
+            tif = BytesIO()
+            img.save(tif, format='TIFF', tiffinfo=info)
+        return tif.getvalue(), stats.as_dict()
+    import numpy as np
+    data = np.array(img)
+    if img.mode == 'I':
+        # 16 bit PNG is read as 32 bit integers by Pillow
+        data = data.astype(np.uint16)
+    return (data, info), stats.as_dict()
+
+
+def _read_compressed(image, stats):
+    """Read compressed PNG and its TIFF tags from json.
+
+    Returns
+    -------
+    (img, info) : tuple
+        Loaded PIL image with palette restored and dict of TIFF tags, as
+        ``tiffinfo`` to ``PIL.Image.save``.
+    """
+    from PIL import Image
+    filename, extension = os.path.splitext(image)
+    if extension != '.png':
+        msg = "Aborting decompress, not a " \
+              "PNG: {}".format(image)
+        raise AssertionError(msg)
+
+    # open image, load and close file pointer
+    with stats.timer('decode'):
+        img = Image.open(image)
+        img.load() # load img-data before switching mode, closes fp
+
+    # get tags from json
+    info = {}
+    with stats.timer('tags'), open(filename + '.json', 'r') as f:
+        tags = json.load(f)
+        if 'blobs' in tags:
+            # compressed with dedup, resolve references
+            from .dedup import BlobStore
+            blobs = os.path.join(os.path.dirname(filename),
+                                 tags.pop('blobs'))
+            tags = BlobStore(blobs).resolve_tags(tags)
+        # convert dictionary to original types (lost in json conversion)
+        for tag,val in tags.items():
+            if tag == 'palette':
+                # hack hack
+                continue
+            if type(val) == list:
+                val = tuple(val)
+            if type(val[0]) == list:
+                # list of list
+                val = tuple(tuple(x) for x in val)
+            info[int(tag)] = val
+
+    # check for color map
+    if 'palette' in tags:
+        img.putpalette(tags['palette'])
+    return img, info
 
 
 def attribute(path, name):
-    """Returns the two numbers found behind --[A-Z] in path. If several matches
-    are found, the last one is returned.
+    """Returns the two or four numbers found behind --[A-Z] in path. If
+    several matches are found, the last one is returned.
 
     Parameters
     ----------
@@ -686,7 +1917,7 @@ def attribute(path, name):
     integer
         Returns number found in path behind --name as an integer.
     """
-    matches = re.findall('--' + name.upper() + '([0-9]{2})', path)
+    matches = re.findall('--' + name.upper() + '([0-9]{2,4})', path)
     if matches:
         return int(matches[-1])
     else:
@@ -694,8 +1925,8 @@ def attribute(path, name):
 
 
 def attribute_as_str(path, name):
-    """Returns the two numbers found behind --[A-Z] in path. If several matches
-    are found, the last one is returned.
+    """Returns the two or four numbers found behind --[A-Z] in path. If
+    several matches are found, the last one is returned.
 
     Parameters
     ----------
@@ -708,9 +1939,9 @@ def attribute_as_str(path, name):
     Returns
     -------
     string
-        Returns two digit number found in path behind --name.
+        Returns number found in path behind --name, as in path.
     """
-    matches = re.findall('--' + name.upper() + '([0-9]{2})', path)
+    matches = re.findall('--' + name.upper() + '([0-9]{2,4})', path)
     if matches:
         return matches[-1]
     else:
@@ -0,0 +1,239 @@
+# encoding: utf-8
+"""
+Estimate and correct uneven illumination. Profiles are estimated per
+channel from streaming per-pixel statistics, so memory use is independent
+of number of tiles:
+
+- dark field is a low percentile of each pixel over all tiles, so noise and
+  a few dark tiles do not pull it down like a minimum would
+- flat field is the per-pixel median of all tiles, minus dark field,
+  smoothed and normalized to mean 1. Objects in some of the tiles do not
+  shift a median like they shift a mean
+
+Percentiles are tracked with the P² algorithm (Jain and Chlamtac, 1985),
+five markers per pixel which are updated as tiles are read.
+
+Tiles are corrected by ``(tile - dark) / flat``.
+"""
+import os
+from collections import namedtuple
+import numpy as np
+from . import pixels
+
+
+class FlatField(namedtuple('FlatField', 'flat dark')):
+    """Illumination profile of one channel.
+
+    Attributes
+    ----------
+    flat : numpy.ndarray
+        Flat field, float32 with mean 1.
+    dark : numpy.ndarray
+        Dark field, float32.
+    """
+    __slots__ = ()
+
+    def apply(self, data):
+        """Correct image.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Tile of same size as profile.
+
+        Returns
+        -------
+        numpy.ndarray
+            Corrected tile, same dtype as `data`.
+        """
+        corrected = (data - self.dark) / self.flat
+        if np.issubdtype(data.dtype, np.integer):
+            info = np.iinfo(data.dtype)
+            corrected = np.clip(corrected.round(), info.min, info.max)
+        return corrected.astype(data.dtype)
+
+
+    def save(self, filename):
+        "Save profile as .npz. Returns filename."
+        folder = os.path.dirname(filename)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        np.savez(filename, flat=self.flat, dark=self.dark)
+        return filename
+
+
+    @classmethod
+    def load(cls, filename):
+        "Load profile saved with ``save``."
+        with np.load(filename) as f:
+            return cls(f['flat'], f['dark'])
+
+
+
+def estimate(filenames, sample=None, seed=None, smooth=16, low=5,
+             n_jobs=1, stats=None):
+    """Estimate illumination profile from tiles of one channel.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Tiles of one channel.
+    sample : int
+        If given, estimate from this many randomly chosen tiles.
+    seed : int
+        Seed for random sample.
+    smooth : int
+        Width of box filter smoothing the flat field. 0 to turn off.
+    low : float
+        Percentile of each pixel used as dark field.
+    n_jobs : int
+        Number of workers. Each estimates from a random share of the tiles,
+        and estimates are averaged weighted by number of tiles.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    FlatField
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results
+    from .stats import run_instrumented
+
+    filenames = list(filenames)
+    if not filenames:
+        raise ValueError('No tiles to estimate flat field from')
+    rng = np.random.RandomState(seed)
+    if sample and sample < len(filenames):
+        filenames = [filenames[i] for i in
+                     sorted(rng.choice(len(filenames), sample, replace=False))]
+
+    # random shares, so percentiles of each worker estimate the same
+    # percentiles of the plate, and can be averaged
+    shuffled = [filenames[i] for i in rng.permutation(len(filenames))]
+    chunks = [shuffled[i::n_jobs] for i in range(min(n_jobs, len(shuffled)))]
+    results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                            (_accumulate, (chunk, low))
+                            for chunk in chunks)
+    dark, median, count = 0, 0, 0
+    for d, m, n in _merge_results(results, stats):
+        dark = dark + n * d
+        median = median + n * m
+        count += n
+    dark /= count
+    median /= count
+
+    flat = median - dark
+    if smooth:
+        flat = _box_filter(flat, smooth)
+    flat /= flat.mean()
+    # avoid division by zero in corners without signal
+    flat[flat <= 0] = 1
+    return FlatField(flat.astype(np.float32), dark.astype(np.float32))
+
+
+def _accumulate(filenames, low, stats):
+    """Per-pixel `low` percentile and median of tiles in one worker.
+
+    Returns
+    -------
+    (dark, median, count) : tuple
+    """
+    first = []
+    trackers = None
+    for filename in filenames:
+        with stats.timer('decode'):
+            data = pixels.read(filename)
+        with stats.timer('flatfield'):
+            if trackers is not None:
+                for tracker in trackers:
+                    tracker.add(data)
+                continue
+            first.append(data)
+            if len(first) == 5:
+                trackers = [_Percentile(first, low), _Percentile(first, 50)]
+    if trackers is None:
+        # too few tiles for P², percentiles of all
+        stack = np.array(first, np.float64)
+        return (np.percentile(stack, low, axis=0),
+                np.median(stack, axis=0), len(filenames))
+    dark, median = [t.value() for t in trackers]
+    return dark, median, len(filenames)
+
+
+
+class _Percentile:
+    def __init__(self, first, percentile):
+        """Streaming estimate of a percentile of each pixel, with the P²
+        algorithm.
+
+        Parameters
+        ----------
+        first : list of five numpy.ndarray
+            First tiles.
+        percentile : float
+            Percentile to estimate, 0 to 100.
+        """
+        p = percentile / 100.
+        # heights and positions of markers, first axis is marker
+        self.heights = np.sort(np.array(first, np.float32), axis=0)
+        self.positions = np.empty(self.heights.shape, np.int32)
+        for i in range(5):
+            self.positions[i] = i + 1
+        # desired positions are same for all pixels, as each pixel gets
+        # one value from each tile
+        self.desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])
+        self.increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+
+    def add(self, data):
+        "Update markers with a tile."
+        q, n = self.heights, self.positions
+        np.minimum(q[0], data, out=q[0])
+        np.maximum(q[4], data, out=q[4])
+        # markers above value move up one position
+        for i in range(1, 4):
+            n[i] += data < q[i]
+        n[4] += 1
+        self.desired += self.increments
+
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            up = (d >= 1) & (n[i + 1] - n[i] > 1)
+            down = (d <= -1) & (n[i - 1] - n[i] < -1)
+            move = up | down
+            if not move.any():
+                continue
+            d = np.where(up, 1, -1)[move]
+            qi, ni = q[i][move], n[i][move]
+            qa, na = q[i + 1][move], n[i + 1][move]
+            qb, nb = q[i - 1][move], n[i - 1][move]
+            parabolic = qi + d / (na - nb).astype(np.float32) * (
+                (ni - nb + d) * (qa - qi) / (na - ni) +
+                (na - ni - d) * (qi - qb) / (ni - nb))
+            linear = np.where(d > 0, qi + (qa - qi) / (na - ni),
+                              qi - (qb - qi) / (nb - ni))
+            inside = (qb < parabolic) & (parabolic < qa)
+            q[i][move] = np.where(inside, parabolic, linear)
+            n[i][move] = ni + d
+
+
+    def value(self):
+        "Estimated percentile of each pixel."
+        return self.heights[2].astype(np.float64)
+
+
+def _box_filter(data, width):
+    "Mean filter of `width` x `width` pixels, edges are repeated."
+    r = width // 2
+    for axis in (0, 1):
+        pad = [(0, 0), (0, 0)]
+        pad[axis] = (r + 1, r)
+        padded = np.pad(data, pad, mode='edge')
+        summed = np.cumsum(padded, axis=axis)
+        if axis == 0:
+            data = (summed[2 * r + 1:] - summed[:-2 * r - 1]) / (2 * r + 1)
+        else:
+            data = ((summed[:, 2 * r + 1:] - summed[:, :-2 * r - 1]) /
+                    (2 * r + 1))
+    return data
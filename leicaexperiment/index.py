@@ -0,0 +1,128 @@
+# encoding: utf-8
+"""
+Table of images with their attributes as integer columns. Selections are
+evaluated as boolean masks over the columns, instead of parsing filenames
+for every query.
+"""
+import re
+import numpy as np
+from .utils import range_type, range_bounds
+
+# attributes in filenames, --U00
+_attribute = re.compile('--([A-Z])([0-9]{2,4})')
+
+columns = 'SUVXYZCT'
+
+
+class ImageTable:
+    def __init__(self, paths, data=None):
+        """Table of images.
+
+        Parameters
+        ----------
+        paths : list of strings
+            Images. Attributes are parsed from filenames.
+        data : dict
+            Already parsed columns, ``{name: numpy.ndarray}``. Used when
+            slicing tables.
+
+        Attributes
+        ----------
+        paths : numpy.ndarray
+            Paths of images.
+        columns : dict
+            ``{'U': numpy.ndarray, ...}`` with attributes S, U, V, X, Y, Z,
+            C and T of each image. -1 where attribute is missing.
+        """
+        self.paths = np.array(paths, dtype=object)
+        if data is None:
+            data = dict((c, np.full(len(paths), -1, dtype=np.int32))
+                        for c in columns)
+            for i, path in enumerate(paths):
+                # last occurrence wins, like attributes()
+                for key, value in _attribute.findall(path):
+                    if key in data:
+                        data[key][i] = int(value)
+        self.columns = data
+
+
+    def mask(self, **criteria):
+        """Boolean mask of images matching all criteria.
+
+        Parameters
+        ----------
+        criteria : keyword arguments
+            Attribute (S, U, V, X, Y, Z, C or T, case insensitive) with an
+            int, a ``range``, a ``slice`` or a list of ints.
+
+        Returns
+        -------
+        numpy.ndarray of bools
+        """
+        mask = np.ones(len(self.paths), dtype=bool)
+        for key, value in criteria.items():
+            if value is None:
+                continue
+            key = key.upper()
+            if key not in self.columns:
+                raise ValueError('Unknown attribute {}'.format(key))
+            column = self.columns[key]
+            bounds = range_bounds(value)
+            if bounds is not None:
+                mask &= (column >= bounds[0]) & (column < bounds[1])
+            elif isinstance(value, slice):
+                if value.start is not None:
+                    mask &= column >= value.start
+                if value.stop is not None:
+                    mask &= column < value.stop
+            elif isinstance(value, (list, tuple, set, range_type,
+                                    np.ndarray)):
+                mask &= np.isin(column, list(value))
+            else:
+                mask &= column == value
+        return mask
+
+
+    def select(self, **criteria):
+        """Table of images matching criteria, see ``mask``.
+
+        Returns
+        -------
+        ImageTable
+        """
+        return self[self.mask(**criteria)]
+
+
+    def unique(self, column):
+        """Sorted unique values of column.
+
+        Returns
+        -------
+        list of ints
+        """
+        return [int(v) for v in np.unique(self.columns[column.upper()])]
+
+
+    def __getitem__(self, index):
+        return ImageTable(self.paths[index],
+                          dict((c, v[index]) for c, v in self.columns.items()))
+
+
+    def __len__(self):
+        return len(self.paths)
+
+
+    def tolist(self):
+        "Paths as list of strings."
+        return self.paths.tolist()
+
+
+    def read(self):
+        """Pixel data of images, see ``leicaexperiment.pixels.read``.
+
+        Returns
+        -------
+        list of numpy.ndarray
+        """
+        from .pixels import read
+        return [read(path) for path in self.paths]
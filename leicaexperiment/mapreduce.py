@@ -0,0 +1,158 @@
+# encoding: utf-8
+"""
+Parallel map over wells, fields or images of an experiment, with results
+memoized on disk. Workers get paths and decode the images they need
+themselves, so pixel data is never pickled between processes. Results are
+keyed by the identity of the function (name and code) and a fingerprint of
+the input files, so a rerun only computes groups which are new or changed.
+"""
+import hashlib, os, pickle
+from .utils import chop, fingerprint
+
+# attributes identifying a group
+_keys = {
+    'well': 'UV',
+    'field': 'UVXY',
+    'image': None,
+}
+
+
+def groups(table, by='well'):
+    """Split table of images into groups. If an image is found both as TIFF
+    and PNG, only the first one is kept.
+
+    Parameters
+    ----------
+    table : leicaexperiment.index.ImageTable
+        Images.
+    by : string
+        ``well``, ``field`` or ``image``.
+
+    Returns
+    -------
+    list of (key, ImageTable) tuples
+        Key is ``(u, v)`` for wells, ``(u, v, x, y)`` for fields and the
+        path for images.
+    """
+    from .projection import _strip_extension
+    import numpy as np
+    if by not in _keys:
+        raise ValueError("by should be one of {}".format(sorted(_keys)))
+
+    names = set()
+    keep = np.zeros(len(table), dtype=bool)
+    for i, path in enumerate(table.paths):
+        name = _strip_extension(path)
+        if name not in names:
+            names.add(name)
+            keep[i] = True
+    table = table[keep]
+
+    if by == 'image':
+        return [(path, table[i:i + 1]) for i, path in enumerate(table.paths)]
+    columns = [table.columns[c] for c in _keys[by]]
+    keys = sorted(set(zip(*[c.tolist() for c in columns])))
+    return [(key, table.select(**dict(zip(_keys[by], key))))
+            for key in keys]
+
+
+def function_identity(func):
+    """Name and hash of code of function. Changes when the function is
+    edited, so memoized results are not reused.
+
+    Returns
+    -------
+    string
+    """
+    import inspect
+    name = '{}.{}'.format(getattr(func, '__module__', ''),
+                          getattr(func, '__qualname__',
+                                  getattr(func, '__name__', repr(func))))
+    try:
+        code = inspect.getsource(func).encode('utf-8')
+    except (IOError, TypeError):
+        # defined in interpreter
+        code = getattr(getattr(func, '__code__', None), 'co_code', b'')
+    return '{}-{}'.format(name, hashlib.sha1(code).hexdigest()[:12])
+
+
+def map_groups(func, grouped, cache=None, n_jobs=1, stats=None):
+    """Call ``func(group)`` on each group in parallel.
+
+    Parameters
+    ----------
+    func : callable
+        Takes a ``leicaexperiment.index.ImageTable``, pixel data is read
+        with ``group.read()``. Must be picklable by joblib.
+    grouped : list of (key, ImageTable) tuples
+        See ``groups``.
+    cache : string
+        Folder of memoized results. Not memoized if not given.
+    n_jobs : int
+        Number of workers.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    dict
+        ``{key: result}``
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results
+    from .stats import run_instrumented
+
+    results = {}
+    tasks = []
+    identity = function_identity(func)
+    for key, group in grouped:
+        filename = digest = None
+        if cache:
+            digest = fingerprint(group.tolist())
+            name = hashlib.sha1(repr((identity, key)).encode('utf-8'))
+            filename = os.path.join(cache, name.hexdigest() + '.pickle')
+            cached = _load(filename, digest)
+            if cached is not None:
+                results[key] = cached[0]
+                continue
+        tasks.append((key, group, filename, digest))
+
+    if tasks:
+        if cache and not os.path.isdir(cache):
+            os.makedirs(cache)
+        chunks = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                                (_map_chunk, (func, chunk))
+                                for chunk in chop(tasks, n_jobs))
+        for chunk in _merge_results(chunks, stats):
+            results.update(chunk)
+    # in order of groups
+    return dict((key, results[key]) for key, _ in grouped)
+
+
+def _load(filename, digest):
+    "Memoized result as 1-tuple, None if missing or inputs have changed."
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            stored, result = pickle.load(f)
+    except Exception:
+        # partially written or from incompatible version
+        return None
+    return (result,) if stored == digest else None
+
+
+def _map_chunk(func, tasks, stats):
+    "Call func on groups in one worker, memoizing results."
+    results = {}
+    for key, group, filename, digest in tasks:
+        with stats.timer('map'):
+            result = func(group)
+        if filename:
+            with stats.timer('memoize'):
+                tmp = '{}.{}.tmp'.format(filename, os.getpid())
+                with open(tmp, 'wb') as f:
+                    pickle.dump((digest, result), f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, filename)
+        results[key] = result
+    return results
@@ -0,0 +1,204 @@
+# encoding: utf-8
+"""
+Export experiment as OME-Zarr, NGFF 0.4 high content screening layout:
+
+    plate.zarr/{row}/{column}/{field}/{level}
+
+Wells are placed in rows by --V and in columns by --U. Each field is a
+multiscale TCZYX image, where level 0 is full resolution and each next
+level halves Y and X. The files are written as zarr version 2 directly,
+without depending on the zarr package. Each chunk holds one plane, and
+each well is written by one worker, so workers never write to the same
+chunk.
+"""
+import json, os, zlib
+import numpy as np
+from . import pixels
+from .utils import chop
+
+_version = '0.4'
+_axes = [{'name': 't', 'type': 'time'},
+         {'name': 'c', 'type': 'channel'},
+         {'name': 'z', 'type': 'space'},
+         {'name': 'y', 'type': 'space'},
+         {'name': 'x', 'type': 'space'}]
+
+
+def to_zarr(images, path, name=None, levels=3, compression=1, n_jobs=1,
+            stats=None):
+    """Write images as OME-Zarr plate.
+
+    Parameters
+    ----------
+    images : list of strings
+        ome.tifs or compressed PNGs. If an image is found both as TIFF and
+        PNG, the first one is used.
+    path : string
+        Folder of zarr plate, typically ending with ``.zarr``.
+    name : string
+        Name of plate. Defaults to basename of `path`.
+    levels : int
+        Number of resolution levels.
+    compression : int
+        zlib compression level of chunks, 0-9.
+    n_jobs : int
+        Number of workers, each writing whole wells.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    string
+        Path of zarr plate.
+    """
+    from joblib import Parallel, delayed
+    from .experiment import attributes, _merge_results
+    from .projection import _strip_extension
+    from .stats import run_instrumented
+
+    # {(u, v): {(y, x): {(t, c, z): filename}}}
+    wells = {}
+    names = set()
+    ts, cs, zs = set(), set(), set()
+    for image in images:
+        name_ = _strip_extension(image)
+        if name_ in names:
+            continue
+        names.add(name_)
+        a = attributes(image)
+        t, c, z = getattr(a, 't', 0), getattr(a, 'c', 0), getattr(a, 'z', 0)
+        ts.add(t)
+        cs.add(c)
+        zs.add(z)
+        field = wells.setdefault((a.u, a.v), {}).setdefault((a.y, a.x), {})
+        field[(t, c, z)] = image
+    if not wells:
+        raise ValueError('No images to export')
+
+    ts, cs, zs = sorted(ts), sorted(cs), sorted(zs)
+    first = pixels.read(images[0])
+    us = sorted(set(u for u, v in wells))
+    vs = sorted(set(v for u, v in wells))
+    rows = [_row_name(v) for v in vs]
+    columns = [str(u + 1) for u in us]
+
+    _group(path, {'plate': {
+        'version': _version,
+        'name': name or os.path.basename(os.path.abspath(path)),
+        'rows': [{'name': r} for r in rows],
+        'columns': [{'name': c} for c in columns],
+        'wells': [{'path': '{}/{}'.format(_row_name(v), u + 1),
+                   'rowIndex': vs.index(v), 'columnIndex': us.index(u)}
+                  for u, v in sorted(wells, key=lambda w: (w[1], w[0]))],
+        'field_count': max(len(fields) for fields in wells.values()),
+    }})
+    for row in rows:
+        _group(os.path.join(path, row))
+
+    tasks = []
+    for (u, v), fields in sorted(wells.items()):
+        planes = []
+        for field in sorted(fields):
+            planes.append(dict(((ts.index(t), cs.index(c), zs.index(z)), f)
+                               for (t, c, z), f in fields[field].items()))
+        tasks.append((os.path.join(path, _row_name(v), str(u + 1)), planes))
+
+    shape = (len(ts), len(cs), len(zs)) + first.shape[:2]
+    results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                            (_write_wells,
+                             (chunk, shape, first.dtype.str, levels,
+                              compression))
+                            for chunk in chop(tasks, n_jobs))
+    _merge_results(results, stats)
+    return path
+
+
+def _row_name(v):
+    "Row name of well row --V, A-Z, then AA, AB, ..."
+    name = ''
+    v += 1
+    while v:
+        v, rest = divmod(v - 1, 26)
+        name = chr(ord('A') + rest) + name
+    return name
+
+
+def _group(path, attrs=None):
+    "Create zarr group with attributes."
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    _write_json(os.path.join(path, '.zgroup'), {'zarr_format': 2})
+    if attrs is not None:
+        _write_json(os.path.join(path, '.zattrs'), attrs)
+
+
+def _write_json(filename, data):
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def _write_wells(tasks, shape, dtype, levels, compression, stats):
+    "Write wells in one worker."
+    for well, planes in tasks:
+        _group(well, {'well': {
+            'version': _version,
+            'images': [{'path': str(i)} for i in range(len(planes))],
+        }})
+        for i, field in enumerate(planes):
+            _write_field(os.path.join(well, str(i)), field, shape, dtype,
+                         levels, compression, stats)
+
+
+def _write_field(path, planes, shape, dtype, levels, compression, stats):
+    "Write multiscale image of field, each plane is decoded once."
+    datasets = []
+    for level in range(levels):
+        scale = 2 ** level
+        datasets.append({
+            'path': str(level),
+            'coordinateTransformations': [{
+                'type': 'scale', 'scale': [1, 1, 1, scale, scale]}],
+        })
+        level_shape = list(shape[:3]) + [shape[3] // scale,
+                                         shape[4] // scale]
+        _write_json(os.path.join(_mkdir(path, str(level)), '.zarray'), {
+            'zarr_format': 2,
+            'shape': level_shape,
+            'chunks': [1, 1, 1] + level_shape[3:],
+            'dtype': dtype,
+            'compressor': {'id': 'zlib', 'level': compression},
+            'fill_value': 0,
+            'order': 'C',
+            'filters': None,
+            'dimension_separator': '/',
+        })
+    _group(path, {'multiscales': [{
+        'version': _version,
+        'name': os.path.basename(path),
+        'axes': _axes,
+        'datasets': datasets,
+    }]})
+
+    for (t, c, z), filename in sorted(planes.items()):
+        with stats.timer('decode'):
+            data = pixels.read(filename).astype(np.dtype(dtype))
+        for level in range(levels):
+            if level:
+                data = pixels.downsample(data, 2)
+            h, w = shape[3] // 2 ** level, shape[4] // 2 ** level
+            chunk = np.zeros((h, w), data.dtype)
+            chunk[:data.shape[0], :data.shape[1]] = data[:h, :w]
+            with stats.timer('encode'):
+                compressed = zlib.compress(chunk.tobytes(), compression)
+            folder = _mkdir(path, str(level), str(t), str(c), str(z), '0')
+            with stats.timer('write'):
+                with open(os.path.join(folder, '0'), 'wb') as f:
+                    f.write(compressed)
+
+
+def _mkdir(*names):
+    "Join path and create folder if missing."
+    path = os.path.join(*names)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
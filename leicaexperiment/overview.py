@@ -0,0 +1,338 @@
+# encoding: utf-8
+"""
+Downsampled plate overview. Every tile is decoded once and reduced as it is
+read. Each well is cached as a thumbnail, so rebuilding the overview after
+new wells are acquired only decodes wells which changed. The overview is
+saved as one PNG and as a tiled pyramid. Levels of the pyramid are made from
+the tiles of the level below, so only tiles over changed wells are rendered
+again, up through the levels.
+"""
+import json, os, re, shutil
+import numpy as np
+from . import pixels
+from .utils import chop, fingerprint
+
+
+def build(images, folder, level=3, channel=0, z=0, tile_size=256, spacing=4,
+          n_jobs=1, stats=None):
+    """Build plate overview of one channel and z-plane.
+
+    Parameters
+    ----------
+    images : list of strings
+        Images in experiment.
+    folder : string
+        Where to save overview, pyramid and cached well thumbnails.
+    level : int
+        Tiles are reduced by a factor of ``2**level``.
+    channel : int
+        Channel to show. Same as --C in files.
+    z : int
+        Z-plane to show. Same as --Z in files.
+    tile_size : int
+        Width and height of pyramid tiles.
+    spacing : int
+        Pixels between wells.
+    n_jobs : int
+        Number of workers rendering well thumbnails.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    string
+        Filename of overview PNG. Pyramid tiles are saved as
+        ``pyramid/{level}/{column}_{row}.png`` next to it, where level 0 is
+        the overview in full size and each next level halves it.
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results
+    from .stats import run_instrumented
+
+    factor = 2 ** level
+    cache = os.path.join(folder, 'wells')
+    manifest_file = os.path.join(cache, 'manifest.json')
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    wells = well_tiles(images, channel, z)
+    thumbnails = {}
+    tasks = []
+    changed = []
+    for (u, v), tiles in wells.items():
+        key = _key(u, v)
+        filename = os.path.join(cache, key + '.png')
+        thumbnails[(u, v)] = filename
+        digest = fingerprint(tiles.values(), factor)
+        if manifest.get(key) != digest or not os.path.isfile(filename):
+            tasks.append((tiles, factor, filename))
+            changed.append((u, v))
+            manifest[key] = digest
+
+    # overview and pyramid are complete when layout is in manifest
+    overview = os.path.join(folder, 'overview.png')
+    previous = manifest.pop('layout', None)
+    if (not tasks and os.path.isfile(overview) and previous and
+            previous['wells'] == sorted(_key(u, v) for u, v in wells) and
+            previous['spacing'] == spacing and
+            previous['tile_size'] == tile_size):
+        return overview
+    if previous or tasks:
+        _save_manifest(manifest_file, manifest)
+
+    if tasks:
+        results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                                (_thumbnail_chunk, (chunk,))
+                                for chunk in chop(tasks, n_jobs))
+        _merge_results(results, stats)
+
+    thumbnails = dict((key, pixels.read(filename))
+                      for key, filename in thumbnails.items())
+    data = montage(thumbnails, spacing)
+    offsets = positions(dict((key, t.shape) for key, t in thumbnails.items()),
+                        spacing)[0]
+    layout = {'wells': sorted(_key(u, v) for u, v in wells),
+              'offsets': sorted([_key(u, v), list(offset)]
+                                for (u, v), offset in offsets.items()),
+              'shape': list(data.shape), 'spacing': spacing,
+              'tile_size': tile_size}
+    tiles = os.path.join(folder, 'pyramid')
+    dirty = None
+    if previous == layout and os.path.isdir(tiles):
+        dirty = []
+        for key in changed:
+            (row, column), (h, w) = offsets[key], thumbnails[key].shape[:2]
+            dirty.append((row, column, row + h, column + w))
+
+    pixels.write(overview, data)
+    pyramid(data, tiles, tile_size, dirty)
+    manifest['layout'] = layout
+    _save_manifest(manifest_file, manifest)
+    return overview
+
+
+def well_tiles(images, channel=0, z=0):
+    """Group images of a channel and z-plane by well and field. If a field is
+    found several times (TIFF and PNG, or several time points), the first
+    one is used.
+
+    Returns
+    -------
+    dict
+        ``{(u, v): {(x, y): filename}}``
+    """
+    from .experiment import attributes
+    wells = {}
+    for image in images:
+        attrs = attributes(image)
+        if (getattr(attrs, 'c', None) != channel or
+                getattr(attrs, 'z', None) != z):
+            continue
+        tiles = wells.setdefault((attrs.u, attrs.v), {})
+        tiles.setdefault((attrs.x, attrs.y), image)
+    return wells
+
+
+def thumbnail(tiles, factor):
+    """Well image with fields laid out by X and Y, each reduced by `factor`
+    as it is read.
+
+    Parameters
+    ----------
+    tiles : dict
+        ``{(x, y): filename}``
+    factor : int
+        Reduction factor.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    xs = sorted(set(x for x, y in tiles))
+    ys = sorted(set(y for x, y in tiles))
+    canvas = None
+    for (x, y), filename in tiles.items():
+        data = pixels.downsample(pixels.read(filename), factor)
+        if canvas is None:
+            h, w = data.shape[:2]
+            canvas = np.zeros((len(ys) * h, len(xs) * w) + data.shape[2:],
+                              data.dtype)
+        row, column = ys.index(y) * h, xs.index(x) * w
+        data = data[:h, :w]
+        canvas[row:row + data.shape[0], column:column + data.shape[1]] = data
+    return canvas
+
+
+def montage(thumbnails, spacing=0):
+    """Plate image with wells laid out by U as column and V as row.
+
+    Parameters
+    ----------
+    thumbnails : dict
+        ``{(u, v): numpy.ndarray}``
+    spacing : int
+        Pixels between wells.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    offsets, shape = positions(dict((key, t.shape)
+                                    for key, t in thumbnails.items()), spacing)
+    first = next(iter(thumbnails.values()))
+    canvas = np.zeros(shape + first.shape[2:], first.dtype)
+    for key, data in thumbnails.items():
+        row, column = offsets[key]
+        canvas[row:row + data.shape[0], column:column + data.shape[1]] = data
+    return canvas
+
+
+def positions(shapes, spacing=0):
+    """Where wells are placed in ``montage``.
+
+    Parameters
+    ----------
+    shapes : dict
+        ``{(u, v): shape}`` of well thumbnails.
+    spacing : int
+        Pixels between wells.
+
+    Returns
+    -------
+    (offsets, shape) : tuple
+        ``{(u, v): (row, column)}`` of top left corner of each well, and
+        ``(height, width)`` of montage.
+    """
+    us = sorted(set(u for u, v in shapes))
+    vs = sorted(set(v for u, v in shapes))
+    h = max(s[0] for s in shapes.values()) + spacing
+    w = max(s[1] for s in shapes.values()) + spacing
+    offsets = dict(((u, v), (vs.index(v) * h, us.index(u) * w))
+                   for u, v in shapes)
+    return offsets, (len(vs) * h - spacing, len(us) * w - spacing)
+
+
+def pyramid(data, folder, tile_size=256, dirty=None):
+    """Save image as tiled pyramid, ``{folder}/{level}/{column}_{row}.png``.
+    Level 0 is full size, each next level halves the previous, until the
+    image fits in one tile. Tiles are made from the four tiles below them,
+    read from an earlier pyramid if they have not changed. Tiles and levels
+    outside the image, from an earlier larger image, are removed.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Full size image.
+    folder : string
+        Where to save tiles.
+    tile_size : int
+        Width and height of tiles.
+    dirty : list of tuples
+        ``(top, left, bottom, right)`` of regions changed since the pyramid
+        in `folder` was saved with same size of image and tiles. Only tiles
+        over these regions are rendered. All tiles if not given.
+
+    Returns
+    -------
+    int
+        Number of levels.
+    """
+    h, w = data.shape[:2]
+    if dirty is None:
+        dirty = [(0, 0, h, w)]
+    level = 0
+    below, size = {}, None
+    while True:
+        rows, columns = -(-h // tile_size), -(-w // tile_size)
+        tiles = set()
+        for top, left, bottom, right in dirty:
+            for row in range(top // tile_size,
+                             min(-(-bottom // tile_size), rows)):
+                for column in range(left // tile_size,
+                                    min(-(-right // tile_size), columns)):
+                    tiles.add((column, row))
+        rendered = {}
+        for column, row in sorted(tiles):
+            if level == 0:
+                tile = data[row * tile_size:(row + 1) * tile_size,
+                            column * tile_size:(column + 1) * tile_size]
+            else:
+                tile = _reduce(below, folder, level - 1, column, row,
+                               tile_size, size)
+            pixels.write(_tile(folder, level, column, row), tile)
+            rendered[(column, row)] = tile
+        _remove_outside(os.path.join(folder, str(level)), columns, rows)
+        if max(h, w) <= tile_size:
+            break
+        below, size = rendered, (h, w)
+        dirty = [(top // 2, left // 2, -(-bottom // 2), -(-right // 2))
+                 for top, left, bottom, right in dirty]
+        # odd sizes are padded with edge before halving
+        h, w = -(-h // 2), -(-w // 2)
+        level += 1
+
+    for name in os.listdir(folder):
+        if name.isdigit() and int(name) > level:
+            shutil.rmtree(os.path.join(folder, name))
+    return level + 1
+
+
+def _reduce(below, folder, level, column, row, tile_size, size):
+    """Tile of next level from the up to four tiles below it, in `below` or
+    saved in `level` of `folder`. `size` is height and width of `level`."""
+    h, w = size
+    lines = []
+    for r in [2 * row, 2 * row + 1]:
+        line = []
+        for c in [2 * column, 2 * column + 1]:
+            if r * tile_size >= h or c * tile_size >= w:
+                continue
+            tile = below.get((c, r))
+            if tile is None:
+                tile = pixels.read(_tile(folder, level, c, r))
+            line.append(tile)
+        if line:
+            lines.append(np.concatenate(line, axis=1))
+    data = np.concatenate(lines, axis=0)
+    # pad to even size, so no pixels are lost when halving
+    pad = [(0, data.shape[0] % 2), (0, data.shape[1] % 2)] + \
+          [(0, 0)] * (data.ndim - 2)
+    return pixels.downsample(np.pad(data, pad, mode='edge'), 2)
+
+
+def _tile(folder, level, column, row):
+    return os.path.join(folder, str(level), '{}_{}.png'.format(column, row))
+
+
+def _remove_outside(folder, columns, rows):
+    "Remove tiles from an earlier, larger image."
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        match = re.match(r'^(\d+)_(\d+)\.png$', name)
+        if match and (int(match.group(1)) >= columns or
+                      int(match.group(2)) >= rows):
+            os.remove(os.path.join(folder, name))
+
+
+def _key(u, v):
+    return 'well--U{:02d}--V{:02d}'.format(u, v)
+
+
+def _save_manifest(filename, manifest):
+    folder = os.path.dirname(filename)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def _thumbnail_chunk(tasks, stats):
+    "Render and save thumbnails of wells in one worker."
+    for tiles, factor, filename in tasks:
+        with stats.timer('thumbnail'):
+            data = thumbnail(tiles, factor)
+        with stats.timer('write'):
+            pixels.write(filename, data)
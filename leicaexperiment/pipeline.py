@@ -0,0 +1,255 @@
+# encoding: utf-8
+"""
+Pipelined lossless compression. Reading, encoding and writing run in
+separate stages connected by bounded queues, so workers on network storage
+do not sit idle while waiting for I/O:
+
+- reader threads prefetch up to `read_ahead` files into memory
+- encoder threads (or processes) decode TIFF and encode PNG
+- writer threads write up to `write_behind` PNG and json files
+
+With encoder processes, files are read into shared memory buffers, so
+TIFFs are not pickled to the processes, see ``leicaexperiment.shm``.
+"""
+import os, threading, pydebug
+
+try:
+    from queue import Queue
+except ImportError:
+    # python 2
+    from Queue import Queue
+
+from .stats import Stats
+from .utils import cpu_count
+
+# debug with `DEBUG=leicaexperiment python script.py`
+debug = pydebug.debug('leicaexperiment')
+
+# marks end of queue
+_done = None
+
+
+def compress_pipelined(images, delete_tif=False, folder=None, readers=4,
+                       encoders=None, writers=2, read_ahead=16,
+                       write_behind=16, processes=False, stats=None,
+                       qc=None, shared_memory=True):
+    """Lossless compression as ``leicaexperiment.compress``, but with reading,
+    encoding and writing overlapping each other.
+
+    Parameters
+    ----------
+    images : list of filenames
+        Images to lossless compress.
+    delete_tif : bool
+        Wheter to delete original images.
+    folder : string
+        Where to store images. Basename will be kept.
+    readers : int
+        Number of threads reading files.
+    encoders : int
+        Number of encoders. Defaults to number of CPUs.
+    writers : int
+        Number of threads writing files.
+    read_ahead : int
+        Max number of files read into memory and waiting for an encoder.
+    write_behind : int
+        Max number of encoded files waiting for a writer.
+    processes : bool
+        Encode in a process pool instead of threads. zlib releases the GIL,
+        so threads are often sufficient.
+    shared_memory : bool
+        With `processes`, hand TIFFs to encoders in shared memory instead
+        of pickling them. Ignored if shared memory is not supported.
+    stats : leicaexperiment.Stats
+        If given, timings from all stages are merged into this object.
+    qc : string
+        If given, statistics of each image are computed while it is encoded
+        and saved in SQLite table with this filename.
+
+    Returns
+    -------
+    list of filenames
+        List of compressed files, empty string for images which failed.
+    """
+    if type(images) == str:
+        images = [images]
+    encoders = encoders or cpu_count()
+
+    tasks = Queue()
+    read = Queue(maxsize=read_ahead)
+    encoded = Queue(maxsize=write_behind)
+    results = [''] * len(images)
+    statistics = []
+
+    for i, image in enumerate(images):
+        tasks.put((i, image))
+
+    pool = buffers = None
+    if processes:
+        from multiprocessing import Pool
+        from . import shm
+        if shared_memory and shm.available():
+            # one buffer for each file held by a stage, created before
+            # processes are started
+            buffers = shm.BufferPool(readers + read_ahead + encoders)
+        pool = Pool(encoders)
+
+    all_stats = []
+    try:
+        readers_ = _start(readers, _reader, (tasks, read, folder, buffers),
+                          all_stats)
+        encoders_ = _start(encoders, _encoder,
+                           (read, encoded, pool, bool(qc)), all_stats)
+        writers_ = _start(writers, _writer,
+                          (encoded, results, statistics, delete_tif),
+                          all_stats)
+
+        # end stages in order, each stage gets end markers when its input
+        # is exhausted
+        for stage, queue in [(readers_, tasks), (encoders_, read),
+                             (writers_, encoded)]:
+            for _ in stage:
+                queue.put(_done)
+            for t in stage:
+                t.join()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if buffers is not None:
+            buffers.close()
+
+    if qc:
+        from .qc import QCTable
+        QCTable(qc).insert(statistics)
+    if stats is not None:
+        for s in all_stats:
+            stats.merge(s)
+    return results
+
+
+def _start(n, target, args, all_stats):
+    "Start `n` threads of a stage, each with its own Stats object."
+    threads = []
+    for _ in range(n):
+        stats = Stats()
+        all_stats.append(stats)
+        t = threading.Thread(target=target, args=args + (stats,))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    return threads
+
+
+def _reader(tasks, read, folder, buffers, stats):
+    "Read TIFFs into memory, or into shared memory from `buffers`."
+    from .experiment import _compressed_filename
+    while True:
+        task = tasks.get()
+        if task is _done:
+            return
+        i, image = task
+        try:
+            new_filename = _compressed_filename(image, folder)
+            if os.path.isfile(new_filename):
+                print('leicaexperiment Aborting compress, PNG already'
+                      ' exists: {}'.format(new_filename))
+                read.put((i, image, new_filename, None))
+                continue
+            with stats.timer('read'):
+                with open(image, 'rb') as f:
+                    if buffers is None:
+                        data = f.read()
+                    else:
+                        data = _read_shared(f, buffers)
+        except (IOError, AssertionError) as e:
+            print('leicaexperiment {}'.format(e))
+            continue
+        read.put((i, image, new_filename, data))
+
+
+def _read_shared(f, buffers):
+    "Read file into buffer from pool."
+    data = buffers.acquire(os.fstat(f.fileno()).st_size)
+    try:
+        view = data.view
+        n = f.readinto(view)
+        view.release()
+        if n != data.length:
+            raise IOError('Short read of {}'.format(f.name))
+    except Exception:
+        data.release()
+        raise
+    return data
+
+
+def _encoder(read, encoded, pool, statistics, stats):
+    "Encode TIFFs to PNG in this thread or in `pool`."
+    from .experiment import _encode_png
+    while True:
+        item = read.get()
+        if item is _done:
+            return
+        i, image, new_filename, data = item
+        if data is None:
+            # already compressed
+            encoded.put(item)
+            continue
+        debug('compressing {}'.format(image))
+        try:
+            if pool is None:
+                output = _encode_png(data, stats, statistics)
+            elif isinstance(data, bytes):
+                output, timings = pool.apply(_encode_in_process,
+                                             (data, statistics))
+                stats.merge(timings)
+            else:
+                # shared memory buffer, only its name is pickled
+                try:
+                    output, timings = pool.apply(_encode_shared,
+                        (data.name, data.length, statistics))
+                finally:
+                    data.release()
+                stats.merge(timings)
+        except Exception as e:
+            # keep thread alive, or the stages before it would block forever
+            print('leicaexperiment {}'.format(e))
+            continue
+        encoded.put((i, image, new_filename, output))
+
+
+def _encode_in_process(data, statistics):
+    "Encode in a worker process, returning timings along with output."
+    from .experiment import _encode_png
+    stats = Stats()
+    output = _encode_png(data, stats, statistics)
+    return output, stats.as_dict()
+
+
+def _encode_shared(name, length, statistics):
+    "Encode TIFF in shared memory block `name` in a worker process."
+    from .shm import attach
+    return _encode_in_process(attach(name)[:length], statistics)
+
+
+def _writer(encoded, results, statistics, delete_tif, stats):
+    "Write PNGs and json, collect statistics and delete TIFFs if asked for."
+    from .experiment import _write_compressed
+    while True:
+        item = encoded.get()
+        if item is _done:
+            return
+        i, image, new_filename, output = item
+        try:
+            if output is not None:
+                png, tags, record = output
+                _write_compressed(new_filename, png, tags, stats)
+                if record is not None:
+                    record.update(image=image, png=new_filename)
+                    statistics.append(record)
+                if delete_tif:
+                    os.remove(image)
+        except (IOError, AssertionError) as e:
+            print('leicaexperiment {}'.format(e))
+            continue
+        results[i] = new_filename
@@ -0,0 +1,87 @@
+# encoding: utf-8
+"""
+Read and write pixel data of images in an experiment as numpy arrays.
+"""
+import os
+import numpy as np
+
+
+def read(filename):
+    """Pixel data of ome.tif or compressed PNG.
+
+    Palette images are returned as their indices, which is the raw data
+    from the microscope. 16 bit PNGs are returned as uint16, like the
+    ome.tif they were compressed from.
+
+    Parameters
+    ----------
+    filename : string
+        Path to image.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    from PIL import Image
+    img = Image.open(filename)
+    data = np.array(img)
+    if img.format == 'PNG' and img.mode == 'I':
+        # 16 bit PNG is read as 32 bit integers by Pillow
+        data = data.astype(np.uint16)
+    return data
+
+
+def write(filename, data):
+    """Save pixel data lossless as PNG. Creates folder if missing.
+
+    Parameters
+    ----------
+    filename : string
+        Path to PNG.
+    data : numpy.ndarray
+        8 or 16 bit image.
+
+    Returns
+    -------
+    string
+        Filename.
+    """
+    from PIL import Image
+    folder = os.path.dirname(filename)
+    if folder and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # created by another worker
+            pass
+    img = Image.fromarray(data)
+    if img.mode == 'I;16':
+        # https://github.com/python-pillow/Pillow/issues/1099
+        img = img.convert(mode='I')
+    img.save(filename)
+    return filename
+
+
+def downsample(data, factor):
+    """Reduce image by averaging `factor` x `factor` boxes. Edges which do
+    not fill a whole box are cropped.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D image.
+    factor : int
+        Reduction factor.
+
+    Returns
+    -------
+    numpy.ndarray
+        Reduced image with same dtype as `data`.
+    """
+    factor = int(factor)
+    if factor <= 1:
+        return data
+    h = data.shape[0] // factor * factor
+    w = data.shape[1] // factor * factor
+    boxes = data[:h, :w].reshape(h // factor, factor, w // factor, factor)
+    return boxes.mean(axis=(1, 3)).round().astype(data.dtype)
@@ -0,0 +1,261 @@
+# encoding: utf-8
+"""
+Estimate wall time, output size and peak memory of ``compress`` and
+``stitch`` before running them. Work is found the same way the operation
+finds it, so files which are already compressed or stitched are not counted.
+A small sample is then processed to calibrate:
+
+- compress encodes a few random TIFFs and writes them to a temporary file
+  in the destination folder
+- stitch runs Fiji on one plane of one well, in a temporary folder
+
+Time per byte from the sample is scaled to the rest of the files and split
+on workers the same way the operation splits them. This assumes workers do
+not compete for storage, so predictions for many workers on a slow share are
+optimistic.
+"""
+import os, shutil, tempfile, time
+from collections import namedtuple
+from .utils import chop, cpu_count
+
+
+class Plan(namedtuple('Plan', 'operation items input_bytes output_bytes '
+                              'seconds peak_memory sample')):
+    """Result of ``plan_compress`` and ``plan_stitch``.
+
+    Attributes
+    ----------
+    operation : string
+        ``compress`` or ``stitch``.
+    items : int
+        Number of images to compress, or stitched images to make.
+    input_bytes : int
+        Bytes read.
+    output_bytes : int
+        Predicted bytes written. None if not calibrated.
+    seconds : dict
+        Predicted wall time, ``{workers: seconds}``. Empty if not calibrated.
+    peak_memory : dict
+        Predicted peak memory of all workers, ``{workers: bytes}``.
+    sample : int
+        Number of items processed to calibrate.
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        lines = ['{}: {} items, {} in'.format(self.operation, self.items,
+                                              _human(self.input_bytes))]
+        if self.output_bytes is not None:
+            lines[0] += ', {} out'.format(_human(self.output_bytes))
+        lines.append('calibrated on {} items'.format(self.sample))
+        lines.append('{:>8} {:>12} {:>12}'.format('workers', 'time',
+                                                  'memory'))
+        for n in sorted(self.peak_memory):
+            seconds = self.seconds.get(n)
+            lines.append('{:>8} {:>12} {:>12}'.format(
+                n, '-' if seconds is None else _duration(seconds),
+                _human(self.peak_memory[n])))
+        return '\n'.join(lines)
+
+
+
+def worker_counts(max_workers=None):
+    "Powers of two up to `max_workers`, and `max_workers` itself."
+    max_workers = max_workers or cpu_count()
+    counts = set([max_workers])
+    n = 1
+    while n < max_workers:
+        counts.add(n)
+        n *= 2
+    return sorted(counts)
+
+
+def plan_compress(images, folder=None, sample=4, seed=None, workers=None,
+                  stats=None):
+    """Estimate ``compress(images, folder=folder)``.
+
+    Parameters
+    ----------
+    images : list of strings
+        Images, PNGs and TIFFs which are already compressed are skipped like
+        ``compress`` does.
+    folder : string
+        Where PNGs would be stored.
+    sample : int
+        Number of random TIFFs to compress for calibration. 0 to only count
+        input.
+    seed : int
+        Seed for random sample.
+    workers : list of ints
+        Worker counts to predict. Defaults to ``worker_counts()``.
+    stats : leicaexperiment.Stats
+        Where to record timings of calibration.
+
+    Returns
+    -------
+    Plan
+    """
+    import numpy as np
+    from .experiment import _compressed_filename, _encode_png
+    from .stats import Stats
+    if stats is None:
+        stats = Stats()
+    workers = workers or worker_counts()
+
+    todo = [i for i in images if i.endswith('.tif') and
+            not os.path.isfile(_compressed_filename(i, folder))]
+    sizes = [os.path.getsize(i) for i in todo]
+    largest = max(sizes) if sizes else 0
+
+    sample = min(sample, len(todo))
+    calibration = []
+    if sample:
+        rng = np.random.RandomState(seed)
+        for i in sorted(rng.choice(len(todo), sample, replace=False)):
+            image = todo[i]
+            start = time.time()
+            with stats.timer('read'):
+                with open(image, 'rb') as f:
+                    data = f.read()
+            png, tags, _ = _encode_png(data, stats)
+            destination = folder or os.path.dirname(image)
+            with stats.timer('write'):
+                for content in [png, tags.encode('utf-8')]:
+                    _write_temporary(destination, content)
+            calibration.append((len(data), len(png) + len(tags),
+                                time.time() - start))
+
+    # raw bytes, decoded pixels and PNG of one image in each worker
+    ratio = _ratio(calibration)
+    per_worker = largest * (2 + (ratio or 1))
+    peak_memory = dict((n, n * per_worker) for n in workers)
+    if not calibration:
+        return Plan('compress', len(todo), sum(sizes), None, {}, peak_memory,
+                    0)
+    seconds_per_byte = _seconds_per_byte(calibration)
+    times = [s * seconds_per_byte for s in sizes]
+    seconds = dict((n, _wall_time(times, n)) for n in workers)
+    return Plan('compress', len(todo), sum(sizes), int(sum(sizes) * ratio),
+                seconds, peak_memory, len(calibration))
+
+
+def plan_stitch(wells, folder=None, timepoint=None, calibrate=True,
+                workers=None, stats=None):
+    """Estimate ``stitch`` of wells. Requires fijibin.
+
+    Parameters
+    ----------
+    wells : list of strings
+        Paths of wells.
+    folder : string
+        Where stitched images would be stored, defaults to each well.
+    timepoint : int
+        Only stitch this time point. Same as --T in files.
+    calibrate : bool
+        Stitch one plane with Fiji to predict time and output size.
+    workers : list of ints
+        Worker counts to predict. Defaults to ``worker_counts()``.
+    stats : leicaexperiment.Stats
+        Where to record timings of calibration.
+
+    Returns
+    -------
+    Plan
+    """
+    from .experiment import (_run_macros, stitch_macro, attributes, _field,
+                             _image, _pattern, glob)
+    from .stats import Stats
+    if stats is None:
+        stats = Stats()
+    workers = workers or worker_counts()
+
+    # bytes of each stitched image to make, in order of macros
+    planes = []
+    for well in wells:
+        outputs, macros = stitch_macro(well, folder, timepoint, dry_run=True)
+        if not macros:
+            continue
+        tiles = glob(_pattern(_pattern(well, _field), _image))
+        if any(t.endswith('.png') for t in tiles):
+            # stitch uses PNGs if well is compressed
+            tiles = [t for t in tiles if t.endswith('.png')]
+        if timepoint is not None:
+            # --T is two or four digits
+            tiles = [t for t in tiles
+                     if attributes(os.path.basename(t)).t == timepoint]
+        nbytes = sum(os.path.getsize(t) for t in tiles) // len(outputs)
+        planes.append((well, len(macros), nbytes))
+    items = sum(n for _, n, _ in planes)
+    input_bytes = sum(n * b for _, n, b in planes)
+    largest = max([b for _, _, b in planes] or [0])
+
+    calibration = []
+    if calibrate and planes:
+        well, _, nbytes = planes[0]
+        tmp = tempfile.mkdtemp(prefix='leicaexperiment-plan-')
+        try:
+            outputs, macros = stitch_macro(well, tmp, timepoint, dry_run=True)
+            start = time.time()
+            _run_macros(macros[:1], outputs[:1], stats)
+            seconds = time.time() - start
+            written = (os.path.getsize(outputs[0])
+                       if os.path.isfile(outputs[0]) else 0)
+            calibration.append((nbytes, written, seconds))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # tiles and fused image of one plane in each worker
+    peak_memory = dict((n, n * 2 * largest) for n in workers)
+    if not calibration:
+        return Plan('stitch', items, input_bytes, None, {}, peak_memory, 0)
+    seconds_per_byte = _seconds_per_byte(calibration)
+    # stitch splits macros on workers
+    times = [b * seconds_per_byte for _, n, b in planes for _ in range(n)]
+    seconds = dict((n, _wall_time(times, n)) for n in workers)
+    return Plan('stitch', items, input_bytes,
+                int(input_bytes * _ratio(calibration)),
+                seconds, peak_memory, len(calibration))
+
+
+def _write_temporary(folder, content):
+    "Write content to a temporary file in folder, and remove it."
+    if not os.path.isdir(folder):
+        folder = tempfile.gettempdir()
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.tmp') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _ratio(calibration):
+    "Output bytes per input byte in calibration, None if empty."
+    read = sum(r for r, _, _ in calibration)
+    if not read:
+        return None
+    return sum(w for _, w, _ in calibration) / float(read)
+
+
+def _seconds_per_byte(calibration):
+    read = sum(r for r, _, _ in calibration)
+    return sum(s for _, _, s in calibration) / float(max(read, 1))
+
+
+def _wall_time(times, n):
+    "Longest chunk when times are chopped on `n` workers."
+    return max(sum(chunk) for chunk in chop(times, n)) if times else 0.
+
+
+def _human(nbytes):
+    "Bytes with unit."
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(nbytes) < 1000:
+            return '{:.1f} {}'.format(nbytes, unit)
+        nbytes /= 1000.
+    return '{:.1f} TB'.format(nbytes)
+
+
+def _duration(seconds):
+    "Seconds as h:mm:ss."
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
@@ -0,0 +1,163 @@
+# encoding: utf-8
+"""
+Low resolution preview of stitched wells. Tiles are reduced as they are
+read and placed at their nominal positions from ``TileConfiguration.txt``
+in the well folder, or in a grid by --X and --Y if it is missing. There is
+no registration, so a preview takes a fraction of the time and memory of
+stitching with Fiji.
+"""
+import ast, os
+import numpy as np
+from . import pixels
+from .utils import chop
+
+
+def tile_positions(well):
+    """Nominal positions of fields from ``TileConfiguration.txt`` in well.
+
+    Parameters
+    ----------
+    well : string
+        Path to well.
+
+    Returns
+    -------
+    dict or None
+        ``{(x, y): (column, row)}`` in pixels, by --X and --Y of fields.
+        None if well has no tile configuration.
+    """
+    from .experiment import attribute
+    filename = os.path.join(well, 'TileConfiguration.txt')
+    if not os.path.isfile(filename):
+        return None
+    positions = {}
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('image--'):
+                continue
+            name, _, coordinates = [x.strip() for x in line.split(';')]
+            key = (attribute(name, 'x'), attribute(name, 'y'))
+            positions[key] = ast.literal_eval(coordinates)[:2]
+    return positions or None
+
+
+def mosaic(tiles, factor, positions=None):
+    """Place tiles reduced by `factor` in one image. Overlapping tiles are
+    drawn over each other, without blending.
+
+    Parameters
+    ----------
+    tiles : dict
+        ``{(x, y): filename}``
+    factor : int
+        Reduction factor.
+    positions : dict
+        ``{(x, y): (column, row)}`` in full resolution pixels, see
+        ``tile_positions``. Tiles are laid out in a grid if not given or
+        if a tile is missing from it.
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    from .overview import thumbnail
+    if not positions or any(key not in positions for key in tiles):
+        return thumbnail(tiles, factor)
+
+    x0 = min(positions[key][0] for key in tiles)
+    y0 = min(positions[key][1] for key in tiles)
+    canvas = None
+    for key in sorted(tiles):
+        data = pixels.downsample(pixels.read(tiles[key]), factor)
+        if canvas is None:
+            h, w = data.shape[:2]
+            width = max(int(round((positions[k][0] - x0) / factor))
+                        for k in tiles) + w
+            height = max(int(round((positions[k][1] - y0) / factor))
+                         for k in tiles) + h
+            canvas = np.zeros((height, width) + data.shape[2:], data.dtype)
+        column = int(round((positions[key][0] - x0) / factor))
+        row = int(round((positions[key][1] - y0) / factor))
+        data = data[:h, :w]
+        canvas[row:row + data.shape[0], column:column + data.shape[1]] = data
+    return canvas
+
+
+def stitch_previews(table, wells, folder, factor, n_jobs=1, stats=None):
+    """Preview mosaic of each well, time point, z-plane and channel.
+
+    Parameters
+    ----------
+    table : leicaexperiment.index.ImageTable
+        Images to include. If an image is found both as TIFF and PNG, the
+        first one is used.
+    wells : dict
+        ``{(u, v): path}`` of well folders, for tile configurations.
+    folder : string
+        Where to save previews, as
+        ``preview--U{U}--V{V}--T{T}--C{C}--Z{Z}.png``. ``--T`` is left out
+        if all images are from the same time point.
+    factor : int
+        Reduction factor.
+    n_jobs : int
+        Number of workers, each making previews of whole wells.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    list of strings
+        Filenames of previews.
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results, attributes
+    from .projection import _strip_extension
+    from .stats import run_instrumented
+
+    # --T as in files, two or four digits, like stitch_macro
+    name = 'preview--U{u:02d}--V{v:02d}--T{T}--C{c:02d}--Z{z:02d}.png'
+    if len(table.unique('t')) == 1:
+        name = 'preview--U{u:02d}--V{v:02d}--C{c:02d}--Z{z:02d}.png'
+
+    # {(u, v): {(t, c, z): {(x, y): filename}}}
+    mosaics = {}
+    timepoints = {}
+    names = set()
+    columns = dict((k, v.tolist()) for k, v in table.columns.items())
+    for i, path in enumerate(table.paths):
+        stripped = _strip_extension(path)
+        if stripped in names:
+            continue
+        names.add(stripped)
+        u, v, x, y, t, c, z = [columns[k][i] for k in 'UVXYTCZ']
+        tiles = mosaics.setdefault((u, v), {}).setdefault((t, c, z), {})
+        tiles[(x, y)] = path
+        if t not in timepoints:
+            timepoints[t] = attributes(path).T
+
+    tasks = []
+    for (u, v), planes in sorted(mosaics.items()):
+        outputs = []
+        for (t, c, z), tiles in sorted(planes.items()):
+            filename = name.format(u=u, v=v, T=timepoints[t], c=c, z=z)
+            outputs.append((tiles, os.path.join(folder, filename)))
+        tasks.append((wells.get((u, v)), outputs))
+
+    results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                            (_preview_chunk, (chunk, factor))
+                            for chunk in chop(tasks, n_jobs))
+    chopped_filenames = _merge_results(results, stats)
+    return [f for list_ in chopped_filenames for f in list_]
+
+
+def _preview_chunk(tasks, factor, stats):
+    "Make previews of wells in one worker."
+    filenames = []
+    for well, outputs in tasks:
+        positions = tile_positions(well) if well else None
+        for tiles, filename in outputs:
+            with stats.timer('preview'):
+                data = mosaic(tiles, factor, positions)
+            with stats.timer('write'):
+                filenames.append(pixels.write(filename, data))
+    return filenames
@@ -0,0 +1,146 @@
+# encoding: utf-8
+"""
+Z-projection of fields and stitched wells. Planes are read one by one into
+a running reduction, so a full z-stack is never held in memory.
+"""
+import os, re
+import numpy as np
+from . import pixels
+
+methods = ('max', 'mean', 'focus')
+
+# z-position in filenames
+_z = re.compile('--Z[0-9]{2,4}')
+
+
+def project(filenames, method='max'):
+    """Project z-planes into one image.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Images of each z-plane.
+    method : string
+        ``max`` for maximum intensity, ``mean`` for average intensity or
+        ``focus`` for the plane with best focus (see ``focus_score``).
+
+    Returns
+    -------
+    numpy.ndarray
+        Projected image, same dtype as planes.
+    """
+    if method not in methods:
+        raise ValueError('Unknown projection {}, use one of '
+                         '{}'.format(method, methods))
+    result = None
+    best = None
+    for n, filename in enumerate(filenames, 1):
+        plane = pixels.read(filename)
+        if result is None:
+            dtype = plane.dtype
+        if method == 'max':
+            if result is None:
+                result = plane
+            else:
+                np.maximum(result, plane, out=result)
+        elif method == 'mean':
+            if result is None:
+                result = plane.astype(np.float64)
+            else:
+                result += plane
+        else:
+            score = focus_score(plane)
+            if best is None or score > best:
+                best, result = score, plane
+
+    if method == 'mean':
+        result = (result / n).round().astype(dtype)
+    return result
+
+
+def focus_score(data):
+    """Focus score of image as variance of its Laplacian. Higher is sharper.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D image.
+
+    Returns
+    -------
+    float
+    """
+    d = data.astype(np.float64)
+    laplacian = (d[1:-1, :-2] + d[1:-1, 2:] + d[:-2, 1:-1] + d[2:, 1:-1] -
+                 4 * d[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def z_stacks(filenames):
+    """Group images which only differ by z-position. If an image is found
+    both as TIFF and PNG, the first one is used.
+
+    Parameters
+    ----------
+    filenames : list of strings
+
+    Returns
+    -------
+    list of lists
+        Z-stacks, sorted by filename of first plane.
+    """
+    stacks = {}
+    seen = set()
+    for filename in filenames:
+        name = _strip_extension(filename)
+        if name in seen:
+            continue
+        seen.add(name)
+        stacks.setdefault(_z.sub('', name), []).append(filename)
+    return [stacks[key] for key in sorted(stacks)]
+
+
+def projected_filename(filename, folder, root=None):
+    """Filename of projection of z-stack, a PNG at z-position 00.
+
+    Parameters
+    ----------
+    filename : string
+        Any plane in z-stack.
+    folder : string
+        Where to store projection.
+    root : string
+        If given, path of `filename` relative to `root` is kept in `folder`.
+
+    Returns
+    -------
+    string
+    """
+    name = _z.sub('--Z00', os.path.basename(_strip_extension(filename)))
+    if root:
+        relative = os.path.relpath(os.path.dirname(filename), root)
+        folder = os.path.join(folder, relative)
+    return os.path.join(folder, name + '.png')
+
+
+def project_chunk(tasks, method, stats):
+    """Project and save a list of (filenames, output) in one worker.
+
+    Returns
+    -------
+    list of strings
+        Filenames of projections.
+    """
+    outputs = []
+    for filenames, output in tasks:
+        with stats.timer('project'):
+            data = project(filenames, method)
+        with stats.timer('write'):
+            outputs.append(pixels.write(output, data))
+    return outputs
+
+
+def _strip_extension(filename):
+    "Filename without .ome.tif, .tif or .png."
+    name = os.path.splitext(filename)[0]
+    return name.rsplit('.ome', 1)[0] if name.endswith('.ome') else name
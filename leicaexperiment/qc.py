@@ -0,0 +1,163 @@
+# encoding: utf-8
+"""
+Per-image statistics for quality control, computed while images are
+decoded for compression, and stored in a SQLite table per experiment.
+"""
+import json, os, sqlite3
+import numpy as np
+
+_columns = ['image', 'png', 'u', 'v', 'x', 'y', 'z', 'c', 't',
+            'min', 'max', 'mean', 'std', 'saturated', 'focus', 'histogram']
+
+_schema = """
+CREATE TABLE IF NOT EXISTS statistics (
+    image TEXT PRIMARY KEY,
+    png TEXT,
+    u INTEGER, v INTEGER, x INTEGER, y INTEGER,
+    z INTEGER, c INTEGER, t INTEGER,
+    min REAL, max REAL, mean REAL, std REAL,
+    saturated REAL, focus REAL,
+    histogram TEXT
+)
+"""
+
+
+def image_statistics(data, bins=256):
+    """Statistics of image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2D image.
+    bins : int
+        Number of histogram bins, spread over the range of the dtype.
+
+    Returns
+    -------
+    dict
+        ``min``, ``max``, ``mean``, ``std``, ``saturated`` (fraction of
+        pixels at max of dtype), ``focus`` (variance of Laplacian) and
+        ``histogram`` (list of counts).
+    """
+    from .projection import focus_score
+    if np.issubdtype(data.dtype, np.integer):
+        top = np.iinfo(data.dtype).max
+        saturated = float(np.count_nonzero(data == top)) / data.size
+        hist_range = (0, top + 1)
+    else:
+        saturated = 0.0
+        hist_range = (float(data.min()), float(data.max()) or 1.0)
+    histogram = np.histogram(data, bins=bins, range=hist_range)[0]
+    return {
+        'min': float(data.min()),
+        'max': float(data.max()),
+        'mean': float(data.mean()),
+        'std': float(data.std()),
+        'saturated': saturated,
+        'focus': focus_score(data),
+        'histogram': histogram.tolist(),
+    }
+
+
+class QCTable:
+    def __init__(self, path):
+        """Table of image statistics in SQLite database `path`.
+
+        Parameters
+        ----------
+        path : string
+            Filename of database. Folder is created if missing.
+        """
+        self.path = os.path.abspath(path)
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                # created by another worker
+                pass
+        db = self._connect()
+        with db:
+            db.execute(_schema)
+        db.close()
+
+
+    def _connect(self):
+        "Connection which commits on success."
+        return sqlite3.connect(self.path, timeout=60)
+
+
+    def insert(self, records):
+        """Insert or replace statistics.
+
+        Parameters
+        ----------
+        records : list of dicts
+            Records with keys ``image``, ``png`` and those returned by
+            ``image_statistics``.
+        """
+        from .experiment import attributes
+        rows = []
+        for record in records:
+            attrs = attributes(record['image'])
+            row = dict(record)
+            for key in 'uvxyzct':
+                row[key] = getattr(attrs, key, None)
+            row['histogram'] = json.dumps(row['histogram'])
+            rows.append([row.get(c) for c in _columns])
+        if not rows:
+            return
+        db = self._connect()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO statistics ({}) VALUES '
+                           '({})'.format(', '.join(_columns),
+                                         ', '.join('?' * len(_columns))),
+                           rows)
+        db.close()
+
+
+    def query(self, **criteria):
+        """Statistics of images matching criteria.
+
+            >>> table.query(C=1, U=[0, 1])
+
+        Parameters
+        ----------
+        criteria : keyword arguments
+            Attributes U, V, X, Y, Z, C or T with an int or list of ints.
+
+        Returns
+        -------
+        list of dicts
+        """
+        where, args = [], []
+        for key, value in sorted(criteria.items()):
+            key = key.lower()
+            if len(key) != 1 or key not in 'uvxyzct':
+                raise ValueError('Unknown attribute {}'.format(key))
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                where.append('{} IN ({})'.format(key, ', '.join('?' *
+                                                                len(value))))
+                args.extend(value)
+            else:
+                where.append('{} = ?'.format(key))
+                args.append(value)
+        sql = 'SELECT {} FROM statistics'.format(', '.join(_columns))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        db = self._connect()
+        rows = db.execute(sql + ' ORDER BY image', args).fetchall()
+        db.close()
+        records = [dict(zip(_columns, row)) for row in rows]
+        for record in records:
+            record['histogram'] = json.loads(record['histogram'])
+        return records
+
+
+    def __str__(self):
+        return 'leicaexperiment.qc.QCTable({})'.format(self.path)
+
+
+    def __repr__(self):
+        return self.__str__()
@@ -0,0 +1,210 @@
+# encoding: utf-8
+"""
+Render channels as 8 bit RGB composites. Contrast limits are set per
+channel for the whole plate, from histograms of all tiles, so composites of
+different fields and wells are comparable. Histograms are accumulated in
+parallel workers with one bin per intensity level, so memory use is
+independent of number of tiles.
+
+Each channel is mapped to its color with a lookup table, and colors of
+channels are added and clipped.
+"""
+import os
+import numpy as np
+from .utils import chop
+
+# default colors of channels, in order of --C
+colors = [(0, 255, 0), (255, 0, 255), (0, 255, 255), (255, 255, 0),
+          (255, 0, 0), (0, 0, 255)]
+
+# number of intensity levels in histograms and lookup tables
+_levels = 1 << 16
+
+
+def histogram(filenames, n_jobs=1, stats=None):
+    """Histogram of intensities in 8 or 16 bit images.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Tiles, typically of one channel.
+    n_jobs : int
+        Number of workers, each counting a part of the tiles.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+
+    Returns
+    -------
+    numpy.ndarray
+        Count of each intensity level, int64 of length 65536.
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results
+    from .stats import run_instrumented
+
+    filenames = list(filenames)
+    results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                            (_histogram_chunk, (chunk,))
+                            for chunk in chop(filenames, n_jobs))
+    total = np.zeros(_levels, np.int64)
+    for counts in _merge_results(results, stats):
+        total += counts
+    return total
+
+
+def contrast_limits(counts, low=0.1, high=99.9):
+    """Intensities at percentiles of histogram.
+
+    Parameters
+    ----------
+    counts : numpy.ndarray
+        Histogram from ``histogram``.
+    low, high : float
+        Percentiles mapped to black and full color.
+
+    Returns
+    -------
+    (low, high) : tuple of ints
+        ``high`` is always larger than ``low``.
+    """
+    total = counts.sum()
+    if total == 0:
+        return 0, 1
+    cumulative = np.cumsum(counts)
+    lower = int(np.searchsorted(cumulative, total * low / 100., 'right'))
+    upper = int(np.searchsorted(cumulative, total * high / 100.))
+    return lower, max(upper, lower + 1)
+
+
+def lut(limits, color):
+    """Lookup table from intensity to RGB.
+
+    Parameters
+    ----------
+    limits : (low, high) tuple
+        Intensities mapped to black and `color`.
+    color : (r, g, b) tuple
+        8 bit color.
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 of shape (65536, 3), index it with an image.
+    """
+    low, high = limits
+    ramp = (np.arange(_levels, dtype=np.float32) - low) / (high - low)
+    ramp = np.clip(ramp, 0, 1)
+    table = ramp[:, None] * np.array(color, np.float32)[None, :]
+    return table.round().astype(np.uint8)
+
+
+def composite(channels, luts):
+    """Add colors of channels.
+
+    Parameters
+    ----------
+    channels : list of numpy.ndarray
+        8 or 16 bit images of same shape.
+    luts : list of numpy.ndarray
+        Lookup table of each channel, see ``lut``.
+
+    Returns
+    -------
+    numpy.ndarray
+        uint8 RGB image.
+    """
+    rgb = None
+    for data, table in zip(channels, luts):
+        colored = table[_unsigned(data)]
+        if rgb is None:
+            rgb = colored.astype(np.uint16)
+        else:
+            rgb += colored
+    return np.minimum(rgb, 255).astype(np.uint8)
+
+
+def render(tasks, luts, n_jobs=1, stats=None, quality=90):
+    """Save composites in parallel.
+
+    Parameters
+    ----------
+    tasks : list
+        ``(filename, {channel: path})`` of each composite. Format is given
+        by extension of filename, like ``.png`` or ``.jpg``.
+    luts : dict
+        ``{channel: lookup table}``, see ``lut``. Channels without a lookup
+        table are left out.
+    n_jobs : int
+        Number of workers.
+    stats : leicaexperiment.Stats
+        If given, timings from workers are merged into this object.
+    quality : int
+        JPEG quality.
+
+    Returns
+    -------
+    list of strings
+        Filenames of composites.
+    """
+    from joblib import Parallel, delayed
+    from .experiment import _merge_results
+    from .stats import run_instrumented
+
+    results = Parallel(n_jobs=n_jobs)(delayed(run_instrumented)
+                            (_render_chunk, (chunk, luts, quality))
+                            for chunk in chop(tasks, n_jobs))
+    chopped_filenames = _merge_results(results, stats)
+    return [f for list_ in chopped_filenames for f in list_]
+
+
+def _unsigned(data):
+    "Image in native byte order, so it can index a lookup table."
+    if data.dtype.kind != 'u' or data.dtype.itemsize not in (1, 2):
+        raise ValueError('Only 8 and 16 bit images can be rendered, '
+                         'got {}'.format(data.dtype))
+    if not data.dtype.isnative:
+        # like big endian TIFFs, memory mapped
+        data = data.astype(data.dtype.newbyteorder('='))
+    return data
+
+
+def _histogram_chunk(filenames, stats):
+    "Histogram of tiles in one worker."
+    from .tiff import open_image
+    total = np.zeros(_levels, np.int64)
+    for filename in filenames:
+        with stats.timer('decode'):
+            data = _unsigned(np.asarray(open_image(filename)))
+        with stats.timer('histogram'):
+            total += np.bincount(data.ravel(), minlength=_levels)[:_levels]
+    return total
+
+
+def _render_chunk(tasks, luts, quality, stats):
+    "Render composites in one worker."
+    from PIL import Image
+    from . import pixels
+    filenames = []
+    for filename, paths in tasks:
+        channels, tables = [], []
+        for channel in sorted(paths):
+            if channel not in luts:
+                continue
+            with stats.timer('decode'):
+                channels.append(pixels.read(paths[channel]))
+            tables.append(luts[channel])
+        if not channels:
+            continue
+        with stats.timer('render'):
+            rgb = composite(channels, tables)
+        with stats.timer('write'):
+            folder = os.path.dirname(filename)
+            if folder and not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    # created by another worker
+                    pass
+            Image.fromarray(rgb).save(filename, quality=quality)
+        filenames.append(filename)
+    return filenames
@@ -0,0 +1,114 @@
+# encoding: utf-8
+"""
+Bulk listing of an experiment. Every directory is listed exactly once with
+``os.scandir``, and images, metadata and TIFF-tags are classified in the
+same pass. This saves many round trips on network filesystems compared to
+globbing each pattern.
+"""
+import os
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2, pip install scandir
+    from scandir import scandir
+
+from .experiment import _slide, _chamber, _field, _image
+
+_metadata = 'metadata'
+
+
+class Scan(namedtuple('Scan', 'slides wells fields tifs pngs xmls jsons')):
+    """Result of ``scan``. All fields are sorted lists of paths.
+
+    Attributes
+    ----------
+    slides, wells, fields : list of strings
+        Folders in experiment.
+    tifs, pngs : list of strings
+        Images in fields.
+    xmls : list of strings
+        OME-XML in metadata folder of fields.
+    jsons : list of strings
+        TIFF-tags of compressed images.
+    """
+    __slots__ = ()
+
+    @property
+    def images(self):
+        "TIFFs followed by PNGs, like ``Experiment.images``."
+        return self.tifs + self.pngs
+
+
+
+def scan(path, threads=None):
+    """List experiment with one ``scandir`` call per directory.
+
+    Parameters
+    ----------
+    path : string
+        Path to experiment.
+    threads : int
+        If given, list wells in a pool of this many threads. Useful on
+        network filesystems with high latency.
+
+    Returns
+    -------
+    Scan
+        Namedtuple with sorted lists of slides, wells, fields, tifs, pngs,
+        xmls and jsons.
+    """
+    slides = _dirs(path, _slide + '--')
+    wells = [w for s in slides for w in _dirs(s, _chamber + '--')]
+
+    if threads:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            listings = pool.map(_scan_well, wells)
+        finally:
+            pool.close()
+    else:
+        listings = [_scan_well(w) for w in wells]
+
+    fields, tifs, pngs, xmls, jsons = [], [], [], [], []
+    for listing in listings:
+        fields.extend(listing[0])
+        tifs.extend(listing[1])
+        pngs.extend(listing[2])
+        xmls.extend(listing[3])
+        jsons.extend(listing[4])
+
+    return Scan(sorted(slides), sorted(wells), sorted(fields), sorted(tifs),
+                sorted(pngs), sorted(xmls), sorted(jsons))
+
+
+def _dirs(path, prefix):
+    "Directories in path starting with prefix."
+    try:
+        return [e.path for e in scandir(path)
+                if e.name.startswith(prefix) and e.is_dir()]
+    except OSError:
+        return []
+
+
+def _scan_well(well):
+    "List fields of well and classify their files."
+    fields, tifs, pngs, xmls, jsons = [], [], [], [], []
+    for field in _dirs(well, _field + '--'):
+        fields.append(field)
+        for e in scandir(field):
+            name = e.name
+            if name.startswith(_image + '--'):
+                if name.endswith('tif'):
+                    tifs.append(e.path)
+                elif name.endswith('png'):
+                    pngs.append(e.path)
+                elif name.endswith('.json'):
+                    jsons.append(e.path)
+            elif name == _metadata and e.is_dir():
+                xmls.extend(m.path for m in scandir(e.path)
+                            if m.name.startswith(_image + '--') and
+                               m.name.endswith('.xml'))
+    return fields, tifs, pngs, xmls, jsons
@@ -0,0 +1,312 @@
+# encoding: utf-8
+"""
+Local HTTP server for browsing an experiment. Fields and stitched images are
+decoded, downscaled and contrast adjusted on demand, and served as 8 bit PNG
+tiles. Decoded levels and rendered tiles are kept in an LRU cache, and
+requests are handled in threads.
+
+Routes:
+
+- ``/`` JSON index of fields, channels, z-planes and stitched images
+- ``/field/{U}/{V}/{X}/{Y}/{C}/{Z}/{level}/{column}_{row}.png``
+- ``/stitched/{filename}/{level}/{column}_{row}.png``
+
+Level 0 is full resolution, each next level halves the previous. Contrast
+is stretched between query parameters ``min`` and ``max``, defaulting to
+the 0.1 and 99.9 percentiles of the image.
+"""
+import json, re, threading, pydebug
+from collections import OrderedDict
+from io import BytesIO
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+# debug with `DEBUG=leicaexperiment python script.py`
+debug = pydebug.debug('leicaexperiment')
+
+_field_route = re.compile(r'^/field/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/(\d+)/'
+                          r'(\d+)/(\d+)_(\d+)\.png$')
+_stitched_route = re.compile(r'^/stitched/([^/]+)/(\d+)/(\d+)_(\d+)\.png$')
+
+
+class LRUCache:
+    def __init__(self, size=256):
+        """Thread safe least recently used cache.
+
+        Parameters
+        ----------
+        size : int
+            Max number of items.
+
+        Attributes
+        ----------
+        hits, misses : int
+            Number of lookups found and not found in cache.
+        """
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key, compute):
+        """Get item, calling `compute()` if it is not in cache. `compute` is
+        called without holding the lock, so slow items do not block others.
+        """
+        with self._lock:
+            if key in self._items:
+                value = self._items.pop(key)
+                self._items[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+        return value
+
+
+    def __len__(self):
+        return len(self._items)
+
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, experiment, address=('127.0.0.1', 8000),
+                 tile_size=256, cache_size=512, refresh=10):
+        """HTTP server of tiles from experiment. Serve with
+        ``serve_forever()``.
+
+        Parameters
+        ----------
+        experiment : leicaexperiment.Experiment or string
+            Experiment or path to it.
+        address : tuple
+            (host, port) to listen on. Port 0 picks a free port.
+        tile_size : int
+            Width and height of tiles.
+        cache_size : int
+            Number of decoded levels and tiles kept in memory.
+        refresh : float
+            Seconds before fields and stitched images are listed again, so
+            images acquired while serving are found. See also
+            ``invalidate``.
+        """
+        from .experiment import Experiment
+        if not isinstance(experiment, Experiment):
+            experiment = Experiment(experiment)
+        HTTPServer.__init__(self, address, _Handler)
+        self.experiment = experiment
+        self.tile_size = tile_size
+        self.cache = LRUCache(cache_size)
+        self.refresh = refresh
+        self._fields = None
+        self._stitched = None
+        self._listed = 0
+        self._lock = threading.Lock()
+
+
+    @property
+    def url(self):
+        "Address of server."
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+
+    def invalidate(self):
+        "List fields and stitched images again on next request."
+        with self._lock:
+            self._fields = None
+
+
+    def fields(self, refresh=False):
+        """Images by attributes, ``{(u, v, x, y, c, z): filename}``. First
+        image found is used, if it exists as both TIFF and PNG or at several
+        time points."""
+        return self._list(refresh)[0]
+
+
+    def index(self):
+        "Index of experiment, as served on ``/``."
+        fields, stitched = self._list()
+        fields = sorted(fields)
+        return {
+            'experiment': self.experiment.path,
+            'tile_size': self.tile_size,
+            'fields': sorted(set(f[:4] for f in fields)),
+            'channels': sorted(set(f[4] for f in fields)),
+            'z': sorted(set(f[5] for f in fields)),
+            'stitched': sorted(stitched),
+        }
+
+
+    def field(self, u, v, x, y, c, z):
+        "Filename of field image, None if not found."
+        return self.fields().get((u, v, x, y, c, z))
+
+
+    def stitched(self, name):
+        "Filename of stitched image, None if not found."
+        return self._list()[1].get(name)
+
+
+    def _list(self, refresh=False):
+        """Fields and stitched images, ``{name: filename}``, listed again if
+        older than ``self.refresh`` seconds."""
+        import os, time
+        from .experiment import attributes
+        with self._lock:
+            if (self._fields is None or refresh or
+                    time.time() - self._listed > self.refresh):
+                fields = {}
+                for image in self.experiment.images:
+                    a = attributes(image)
+                    key = tuple(getattr(a, k, 0) for k in 'uvxycz')
+                    fields.setdefault(key, image)
+                self._fields = fields
+                self._stitched = dict((os.path.basename(s), s)
+                                      for s in self.experiment.stitched)
+                self._listed = time.time()
+            return self._fields, self._stitched
+
+
+    def level(self, filename, level):
+        "Pixel data of image reduced by ``2**level``, cached."
+        from . import pixels
+        return self.cache.get(('level', filename, level), lambda:
+            pixels.downsample(pixels.read(filename), 2 ** level))
+
+
+    def limits(self, filename, level):
+        "Default contrast limits of image, 0.1 and 99.9 percentiles."
+        import numpy as np
+        def compute():
+            lo, hi = np.percentile(self.level(filename, level), [0.1, 99.9])
+            return float(lo), float(hi)
+        return self.cache.get(('limits', filename, level), compute)
+
+
+    def tile(self, filename, level, column, row, lo=None, hi=None):
+        """Tile as 8 bit PNG, cached.
+
+        Returns
+        -------
+        bytes
+            PNG, or None if tile is outside image.
+        """
+        if lo is None or hi is None:
+            auto = self.limits(filename, level)
+            lo = auto[0] if lo is None else lo
+            hi = auto[1] if hi is None else hi
+        key = ('tile', filename, level, column, row, lo, hi)
+        return self.cache.get(key, lambda: self._render(filename, level,
+                                                        column, row, lo, hi))
+
+
+    def _render(self, filename, level, column, row, lo, hi):
+        "Crop tile and stretch contrast."
+        import numpy as np
+        from PIL import Image
+        data = self.level(filename, level)
+        size = self.tile_size
+        data = data[row * size:(row + 1) * size,
+                    column * size:(column + 1) * size]
+        if data.size == 0:
+            return None
+        scaled = (data.astype(np.float32) - lo) * (255.0 / max(hi - lo, 1e-9))
+        png = BytesIO()
+        Image.fromarray(np.clip(scaled, 0, 255).astype(np.uint8)).save(
+            png, format='PNG')
+        return png.getvalue()
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    "Routes requests to TileServer."
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        lo = float(query['min'][0]) if 'min' in query else None
+        hi = float(query['max'][0]) if 'max' in query else None
+        server = self.server
+        try:
+            if url.path == '/':
+                body = json.dumps(server.index()).encode('utf-8')
+                return self._send(200, body, 'application/json')
+
+            match = _field_route.match(url.path)
+            if match:
+                numbers = [int(n) for n in match.groups()]
+                filename = server.field(*numbers[:6])
+                level, column, row = numbers[6:]
+            else:
+                match = _stitched_route.match(url.path)
+                if not match:
+                    return self._send(404, b'Not found', 'text/plain')
+                filename = server.stitched(match.group(1))
+                level, column, row = [int(n) for n in match.groups()[1:]]
+
+            tile = None
+            if filename is not None:
+                tile = server.tile(filename, level, column, row, lo, hi)
+            if tile is None:
+                return self._send(404, b'Not found', 'text/plain')
+            self._send(200, tile, 'image/png')
+        except (IOError, ValueError) as e:
+            print('leicaexperiment {}'.format(e))
+            self._send(500, str(e).encode('utf-8'), 'text/plain')
+
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        debug(format % args)
+
+
+
+def serve(path, host='127.0.0.1', port=8000, tile_size=256, cache_size=512,
+          refresh=10):
+    """Serve tiles of experiment until interrupted.
+
+    Parameters
+    ----------
+    path : string
+        Path to experiment.
+    host : string
+        Interface to listen on.
+    port : int
+        Port to listen on.
+    tile_size : int
+        Width and height of tiles.
+    cache_size : int
+        Number of decoded levels and tiles kept in memory.
+    refresh : float
+        Seconds before experiment is listed again.
+    """
+    server = TileServer(path, (host, port), tile_size, cache_size, refresh)
+    print('leicaexperiment serving {} on {}'.format(path, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,202 @@
+# encoding: utf-8
+"""
+Pool of shared memory buffers for handing data to worker processes without
+pickling it. The parent reads a file straight into a buffer and passes its
+name to the worker, which attaches to it and reads it in place. Buffers are
+reference counted and return to the pool when the last user releases them,
+so blocks are reused instead of created for every file.
+
+Requires ``multiprocessing.shared_memory`` (python 3.8 or newer), see
+``available``.
+"""
+import threading
+from collections import OrderedDict
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+
+# round block sizes up to this, so blocks can be reused for files of
+# slightly different size
+_granularity = 1 << 20
+
+# blocks attached in this process, {name: SharedMemory}, least recently
+# used first. Blocks replaced in the pool are never used again, so the
+# oldest ones are closed to free address space and /dev/shm.
+_attached = OrderedDict()
+_max_attached = 16
+
+
+def available():
+    "Whether shared memory is supported by this python."
+    return shared_memory is not None
+
+
+
+class Buffer:
+    def __init__(self, pool, block):
+        """Buffer borrowed from a ``BufferPool``, with one reference.
+
+        Attributes
+        ----------
+        name : string
+            Name of shared memory block, pass it to ``attach`` in workers.
+        length : int
+            Number of bytes in use.
+        """
+        self.name = block.name
+        self.length = 0
+        self._pool = pool
+        self._block = block
+        self._refs = 1
+
+
+    @property
+    def view(self):
+        "Writable memoryview of bytes in use."
+        return self._block.buf[:self.length]
+
+
+    def retain(self):
+        "Add a reference, for handing buffer to one more user."
+        with self._pool._lock:
+            self._refs += 1
+        return self
+
+
+    def release(self):
+        "Remove a reference, last one returns buffer to pool."
+        with self._pool._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+        self._pool._put_back(self._block)
+
+
+
+class BufferPool:
+    def __init__(self, count):
+        """Pool of at most `count` shared memory blocks. Blocks are created
+        when needed, and replaced by larger ones if too small.
+
+        Parameters
+        ----------
+        count : int
+            Max number of buffers in use at the same time. ``acquire``
+            blocks when all are in use.
+        """
+        if not available():
+            raise RuntimeError('multiprocessing.shared_memory is not '
+                               'available, python 3.8 or newer is needed')
+        try:
+            # processes started after this share tracker of blocks with
+            # this process, or they would unlink blocks when they exit
+            from multiprocessing import resource_tracker
+            resource_tracker.ensure_running()
+        except ImportError:
+            pass
+        self.count = count
+        self._free = []
+        self._blocks = []
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+
+    def acquire(self, size):
+        """Borrow a buffer of `size` bytes, waiting if all are in use.
+
+        Returns
+        -------
+        leicaexperiment.shm.Buffer
+            Release it with ``release()``.
+        """
+        with self._available:
+            while not self._free and len(self._blocks) >= self.count:
+                self._available.wait()
+            block = None
+            if self._free:
+                block = self._free.pop()
+                if block.size < size:
+                    self._blocks.remove(block)
+                    _destroy(block)
+                    block = None
+            if block is None:
+                rounded = -(-max(size, 1) // _granularity) * _granularity
+                block = shared_memory.SharedMemory(create=True,
+                                                   size=rounded)
+                self._blocks.append(block)
+        buffer = Buffer(self, block)
+        buffer.length = size
+        return buffer
+
+
+    def _put_back(self, block):
+        with self._available:
+            self._free.append(block)
+            self._available.notify()
+
+
+    def close(self):
+        "Free all shared memory. Buffers must not be used after this."
+        with self._lock:
+            for block in self._blocks:
+                _destroy(block)
+            self._blocks = []
+            self._free = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def attach(name):
+    """Shared memory block of `name`, attached once per process. Should be
+    called in processes started after the ``BufferPool`` was created. The
+    pool owns the block and unlinks it. At most ``_max_attached`` blocks
+    are kept attached, the least recently used is closed when exceeded, so
+    do not keep the memoryview after attaching other blocks.
+
+    Returns
+    -------
+    memoryview
+        All bytes of block, slice it to the length in use.
+    """
+    block = _attached.pop(name, None)
+    if block is None:
+        block = shared_memory.SharedMemory(name=name)
+    _attached[name] = block
+    while len(_attached) > _max_attached:
+        _, oldest = _attached.popitem(last=False)
+        _close(oldest)
+    return block.buf
+
+
+def detach(name):
+    "Close block of `name` if attached in this process."
+    block = _attached.pop(name, None)
+    if block is not None:
+        _close(block)
+
+
+def _close(block):
+    try:
+        block.close()
+    except BufferError:
+        # views still alive, memory is freed when they are
+        pass
+
+
+def _destroy(block):
+    detach(block.name)
+    _close(block)
+    try:
+        block.unlink()
+    except OSError:
+        pass
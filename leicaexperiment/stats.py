@@ -0,0 +1,226 @@
+# encoding: utf-8
+"""
+Timing instrumentation of hot paths. Timings are aggregated per worker and
+merged in the parent process.
+"""
+import json, os, time
+from contextlib import contextmanager
+
+# perf_counter is not available in python 2
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class Stats:
+    def __init__(self, timings=None):
+        """Aggregated timings of instrumented sections, like ``decode``,
+        ``encode``, ``tags``, ``read``, ``write``, ``glob`` and ``macro``.
+
+        Parameters
+        ----------
+        timings : dict
+            Optional timings to start with, as returned by ``as_dict``.
+
+        Attributes
+        ----------
+        timings : dict
+            Section name -> dict with ``count``, ``total``, ``min`` and
+            ``max`` (seconds).
+        """
+        self.timings = {}
+        if timings:
+            self.merge(timings)
+
+
+    @contextmanager
+    def timer(self, name):
+        "Context manager which times the enclosed block as section `name`."
+        start = _clock()
+        try:
+            yield
+        finally:
+            self.add(name, _clock() - start)
+
+
+    def add(self, name, seconds, count=1):
+        """Add `seconds` spent in section `name`.
+
+        Parameters
+        ----------
+        name : string
+            Name of section.
+        seconds : float
+            Time spent.
+        count : int
+            Number of calls the time is spent on.
+        """
+        t = self.timings.get(name)
+        if t is None:
+            self.timings[name] = {'count': count, 'total': seconds,
+                                  'min': seconds, 'max': seconds}
+            return
+        t['count'] += count
+        t['total'] += seconds
+        t['min'] = min(t['min'], seconds)
+        t['max'] = max(t['max'], seconds)
+
+
+    def merge(self, other):
+        """Merge timings from another worker into this object.
+
+        Parameters
+        ----------
+        other : Stats or dict
+            Stats object or dictionary as returned by ``as_dict``.
+        """
+        if isinstance(other, Stats):
+            other = other.timings
+        for name, t in other.items():
+            if name not in self.timings:
+                self.timings[name] = dict(t)
+                continue
+            s = self.timings[name]
+            s['count'] += t['count']
+            s['total'] += t['total']
+            s['min'] = min(s['min'], t['min'])
+            s['max'] = max(s['max'], t['max'])
+
+
+    def reset(self):
+        "Remove all timings."
+        self.timings = {}
+
+
+    def as_dict(self):
+        "Timings as a dictionary, suitable for sending between processes."
+        return dict((name, dict(t)) for name, t in self.timings.items())
+
+
+    def to_json(self, filename=None):
+        """Timings as JSON.
+
+        Parameters
+        ----------
+        filename : string
+            If given, JSON is also written to this file.
+
+        Returns
+        -------
+        string
+            JSON document.
+        """
+        doc = json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        if filename:
+            with open(filename, 'w') as f:
+                f.write(doc)
+        return doc
+
+
+    def to_prometheus(self, prefix='leicaexperiment'):
+        """Timings in Prometheus text exposition format.
+
+        Parameters
+        ----------
+        prefix : string
+            Prefix of metric names.
+
+        Returns
+        -------
+        string
+        """
+        metrics = [
+            ('seconds_total', 'counter', 'total',
+             'Seconds spent in instrumented section.'),
+            ('calls_total', 'counter', 'count',
+             'Number of calls to instrumented section.'),
+            ('seconds_max', 'gauge', 'max',
+             'Longest call to instrumented section in seconds.'),
+        ]
+        lines = []
+        for suffix, kind, key, help_ in metrics:
+            name = prefix + '_' + suffix
+            lines.append('# HELP {} {}'.format(name, help_))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for section in sorted(self.timings):
+                lines.append('{}{{section="{}"}} {}'.format(
+                    name, section, self.timings[section][key]))
+        return '\n'.join(lines) + '\n'
+
+
+    def __str__(self):
+        lines = ['{:<10} {:>8} {:>10} {:>10}'.format('section', 'count',
+                                                     'total', 'max')]
+        for name in sorted(self.timings):
+            t = self.timings[name]
+            lines.append('{:<10} {:>8} {:>10.3f} {:>10.3f}'.format(
+                name, t['count'], t['total'], t['max']))
+        return '\n'.join(lines)
+
+
+    def __repr__(self):
+        return 'leicaexperiment.Stats({})'.format(sorted(self.timings))
+
+
+
+def run_instrumented(func, args, profile=False):
+    """Call ``func(*args, stats=stats)`` in a worker, with a fresh Stats object
+    and optionally cProfile enabled.
+
+    Parameters
+    ----------
+    func : callable
+        Function taking keyword argument `stats`.
+    args : tuple
+        Positional arguments for `func`.
+    profile : bool
+        Whether to run cProfile around the call.
+
+    Returns
+    -------
+    (result, timings, profile_filename) : tuple
+        Return value of `func`, timings as dict and filename of dumped
+        profile (None if `profile` is false).
+    """
+    stats = Stats()
+    if not profile:
+        return func(*args, stats=stats), stats.as_dict(), None
+
+    import cProfile, tempfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = func(*args, stats=stats)
+    finally:
+        profiler.disable()
+    fd, filename = tempfile.mkstemp(prefix='leicaexperiment-', suffix='.prof')
+    os.close(fd)
+    profiler.dump_stats(filename)
+    return result, stats.as_dict(), filename
+
+
+def merge_profiles(filenames, output):
+    """Merge cProfile dumps from workers into one file and remove the worker
+    dumps.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Profile dumps from workers.
+    output : string
+        Filename of merged profile, readable with ``pstats``.
+
+    Returns
+    -------
+    string
+        Filename of merged profile.
+    """
+    import pstats
+    filenames = [f for f in filenames if f]
+    if not filenames:
+        return output
+    merged = pstats.Stats(filenames[0])
+    for filename in filenames[1:]:
+        merged.add(filename)
+    merged.dump_stats(output)
+    for filename in filenames:
+        os.remove(filename)
+    return output
@@ -0,0 +1,150 @@
+# encoding: utf-8
+"""
+Memory mapped reading of uncompressed TIFFs. The first IFD is parsed to
+find the pixel data, and if it is stored uncompressed in contiguous strips
+it is returned as a ``numpy.memmap``. Cropping or sampling a tile then only
+reads the bytes touched. Other images are decoded with
+``leicaexperiment.pixels.read``.
+"""
+import struct
+import numpy as np
+
+# tags used to locate pixel data
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+PLANAR_CONFIGURATION = 284
+TILE_WIDTH = 322
+SAMPLE_FORMAT = 339
+
+# TIFF field types, {type: (struct format, size)}
+_types = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8),
+}
+
+# SampleFormat to numpy kind
+_kinds = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def read_ifd(filename):
+    """Tags of first image in TIFF.
+
+    Parameters
+    ----------
+    filename : string
+        Path to TIFF.
+
+    Returns
+    -------
+    (byteorder, tags) : tuple
+        ``<`` or ``>``, and ``{tag: tuple of values}``.
+
+    Raises
+    ------
+    ValueError
+        If file is not a classic TIFF.
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(8)
+        if header[:2] == b'II':
+            byteorder = '<'
+        elif header[:2] == b'MM':
+            byteorder = '>'
+        else:
+            raise ValueError('Not a TIFF: {}'.format(filename))
+        magic, offset = struct.unpack(byteorder + 'HI', header[2:8])
+        if magic != 42:
+            raise ValueError('Not a classic TIFF: {}'.format(filename))
+
+        f.seek(offset)
+        count, = struct.unpack(byteorder + 'H', f.read(2))
+        entries = f.read(12 * count)
+        tags = {}
+        for i in range(count):
+            tag, type_, n = struct.unpack(byteorder + 'HHI',
+                                          entries[12 * i:12 * i + 8])
+            if type_ not in _types:
+                continue
+            fmt, size = _types[type_]
+            data = entries[12 * i + 8:12 * i + 12]
+            if size * n > 4:
+                value_offset, = struct.unpack(byteorder + 'I', data)
+                f.seek(value_offset)
+                data = f.read(size * n)
+            tags[tag] = struct.unpack(byteorder + fmt * n, data[:size * n])
+    return byteorder, tags
+
+
+def layout(filename):
+    """Location of pixel data, if it can be memory mapped.
+
+    Returns
+    -------
+    (offset, shape, dtype) : tuple or None
+        None if pixel data is compressed, tiled, planar or not contiguous.
+    """
+    try:
+        byteorder, tags = read_ifd(filename)
+    except (ValueError, struct.error):
+        return None
+    if (tags.get(COMPRESSION, (1,))[0] != 1 or TILE_WIDTH in tags or
+            STRIP_OFFSETS not in tags):
+        return None
+    samples = tags.get(SAMPLES_PER_PIXEL, (1,))[0]
+    if samples > 1 and tags.get(PLANAR_CONFIGURATION, (1,))[0] != 1:
+        return None
+    bits = set(tags.get(BITS_PER_SAMPLE, (1,)))
+    kind = _kinds.get(tags.get(SAMPLE_FORMAT, (1,))[0])
+    if len(bits) != 1 or kind is None:
+        return None
+    bits = bits.pop()
+    if bits not in (8, 16, 32, 64):
+        return None
+    dtype = np.dtype('{}{}{}'.format(byteorder, kind, bits // 8))
+
+    width = tags[IMAGE_WIDTH][0]
+    height = tags[IMAGE_LENGTH][0]
+    shape = (height, width) if samples == 1 else (height, width, samples)
+    offsets = tags[STRIP_OFFSETS]
+    counts = tags.get(STRIP_BYTE_COUNTS)
+    if counts is None or len(counts) != len(offsets):
+        return None
+    for i in range(1, len(offsets)):
+        if offsets[i] != offsets[i - 1] + counts[i - 1]:
+            return None
+    if sum(counts) < int(np.prod(shape)) * dtype.itemsize:
+        return None
+    return offsets[0], shape, dtype
+
+
+def open_image(filename, mmap=True):
+    """Pixel data of image, memory mapped if it is an uncompressed TIFF.
+
+    Parameters
+    ----------
+    filename : string
+        Path to ome.tif or PNG.
+    mmap : bool
+        Memory map if possible. If false, or image is compressed, it is
+        decoded with ``leicaexperiment.pixels.read``.
+
+    Returns
+    -------
+    numpy.memmap or numpy.ndarray
+        Read only. Palette images are their indices, like
+        ``leicaexperiment.pixels.read``.
+    """
+    if mmap and filename.endswith('.tif'):
+        location = layout(filename)
+        if location is not None:
+            offset, shape, dtype = location
+            return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                             shape=shape)
+    from .pixels import read
+    return read(filename)
@@ -1,9 +1,21 @@
-from multiprocessing import Pool, cpu_count
+# number of CPUs, determined on first call to cpu_count()
+_cpu_count = None
 
-try:
-    _pools = cpu_count()
-except NotImplementedError:
-    _pools = 4
+# type of range objects, range() returns a list on python 2
+range_type = type(range(0))
+
+
+def cpu_count():
+    """Number of CPUs on this host, 4 if it cannot be determined. Found on
+    first call, so importing leicaexperiment stays fast."""
+    global _cpu_count
+    if _cpu_count is None:
+        from multiprocessing import cpu_count as _mp_cpu_count
+        try:
+            _cpu_count = _mp_cpu_count()
+        except NotImplementedError:
+            _cpu_count = 4
+    return _cpu_count
 
 
 def chop(list_, n):
@@ -22,3 +34,37 @@ def chop(list_, n):
             end = size
         chopped.append(list_[start:end])
     return chopped
+
+
+def fingerprint(filenames, *extra):
+    """Hash of path, size and modification time of files, and any extra
+    values. Changes when a file is added, removed or rewritten.
+
+    Parameters
+    ----------
+    filenames : list of strings
+        Files to include.
+    extra : JSON serializable
+        Parameters which should also change the hash.
+
+    Returns
+    -------
+    string
+        Hex digest.
+    """
+    import hashlib, json, os
+    identity = []
+    for filename in sorted(filenames):
+        st = os.stat(filename)
+        identity.append((filename, st.st_size, st.st_mtime))
+    data = json.dumps([identity, list(extra)], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def range_bounds(value):
+    """``(start, stop)`` of a range object with step 1, None for other
+    values. Lists given by range() on python 2 are not ranges."""
+    if (isinstance(value, range_type) and not isinstance(value, list) and
+            value.step == 1):
+        return value.start, value.stop
+    return None
@@ -0,0 +1,339 @@
+# encoding: utf-8
+"""
+File based work queue for distributing compress and stitch of an experiment
+across several hosts. The queue is a SQLite database on a filesystem shared
+by all workers. Each well (chamber) is one unit of work. Workers claim units
+with a lease, which is renewed while the unit is processed. Units whose
+lease has expired, because the worker crashed, are claimed again by other
+workers.
+"""
+import hashlib, json, os, socket, sqlite3, threading, time, pydebug
+
+# debug with `DEBUG=leicaexperiment python script.py`
+debug = pydebug.debug('leicaexperiment')
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+FAILED = 'failed'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS units (
+    id TEXT PRIMARY KEY,
+    operation TEXT NOT NULL,
+    path TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    error TEXT
+)
+"""
+
+
+class WorkQueue:
+    def __init__(self, path, lease=600, max_attempts=3):
+        """Work queue stored in SQLite database `path`.
+
+        Parameters
+        ----------
+        path : string
+            Filename of queue database. Should be on a filesystem all
+            workers can reach.
+        lease : float
+            Seconds a claimed unit is reserved for a worker before other
+            workers may claim it. Renewed by running workers.
+        max_attempts : int
+            Number of times a unit is tried before it is marked as failed.
+
+        Attributes
+        ----------
+        owner : string
+            Identity of this worker, ``hostname:pid``.
+        """
+        self.path = os.path.abspath(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        with self._connect() as db:
+            db.execute(_schema)
+
+
+    def _connect(self):
+        "New connection, autocommit mode with explicit transactions."
+        db = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        return _Closing(db)
+
+
+    def put(self, operation, path, **kwargs):
+        """Add a unit of work. Units already in queue are left untouched.
+
+        Parameters
+        ----------
+        operation : string
+            ``compress`` or ``stitch``.
+        path : string
+            Path to well.
+        kwargs : keyword arguments
+            Passed on to the operation, must be JSON serializable. Units of
+            different ``timepoint`` in the same well are separate units.
+
+        Returns
+        -------
+        string
+            Id of unit.
+        """
+        if operation not in _operations:
+            raise ValueError('Unknown operation {}'.format(operation))
+        path = os.path.abspath(path)
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]
+        id_ = '{}--{}--{}'.format(operation, os.path.basename(path), digest)
+        if kwargs.get('timepoint') is not None:
+            id_ += '--timepoint{}'.format(kwargs['timepoint'])
+        with self._connect() as db:
+            db.execute('INSERT OR IGNORE INTO units (id, operation, path, '
+                       'kwargs, state) VALUES (?, ?, ?, ?, ?)',
+                       (id_, operation, path, json.dumps(kwargs), PENDING))
+        return id_
+
+
+    def claim(self):
+        """Atomically claim next unit which is pending or has an expired
+        lease. Units whose lease expired after `max_attempts` tries, like
+        units which crash their worker, are marked as failed.
+
+        Returns
+        -------
+        dict or None
+            Unit with keys ``id``, ``operation``, ``path`` and ``kwargs``.
+            None if no unit is available.
+        """
+        now = time.time()
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('UPDATE units SET state = ?, expires = NULL, '
+                       'error = ? WHERE state = ? AND expires < ? AND '
+                       'attempts >= ?',
+                       (FAILED, 'lease expired', CLAIMED, now,
+                        self.max_attempts))
+            row = db.execute('SELECT id, operation, path, kwargs FROM units '
+                             'WHERE state = ? OR (state = ? AND expires < ? '
+                             'AND attempts < ?) ORDER BY id LIMIT 1',
+                             (PENDING, CLAIMED, now,
+                              self.max_attempts)).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            db.execute('UPDATE units SET state = ?, owner = ?, expires = ?, '
+                       'attempts = attempts + 1 WHERE id = ?',
+                       (CLAIMED, self.owner, now + self.lease, row[0]))
+            db.execute('COMMIT')
+        debug('{} claimed {}'.format(self.owner, row[0]))
+        return {'id': row[0], 'operation': row[1], 'path': row[2],
+                'kwargs': json.loads(row[3])}
+
+
+    def renew(self, id_):
+        """Extend lease of a claimed unit.
+
+        Returns
+        -------
+        bool
+            False if the lease is lost to another worker.
+        """
+        with self._connect() as db:
+            cursor = db.execute('UPDATE units SET expires = ? WHERE id = ? '
+                                'AND owner = ? AND state = ?',
+                                (time.time() + self.lease, id_,
+                                 self.owner, CLAIMED))
+            return cursor.rowcount == 1
+
+
+    def complete(self, id_, result=None):
+        """Mark unit as done.
+
+        Parameters
+        ----------
+        id_ : string
+            Id of unit.
+        result : JSON serializable
+            Result of operation, typically list of filenames.
+        """
+        with self._connect() as db:
+            db.execute('UPDATE units SET state = ?, expires = NULL, '
+                       'result = ? WHERE id = ? AND owner = ?',
+                       (DONE, json.dumps(result), id_, self.owner))
+
+
+    def fail(self, id_, error):
+        """Release unit after an error. It is put back in queue until it has
+        been tried `max_attempts` times.
+        """
+        with self._connect() as db:
+            db.execute('UPDATE units SET state = CASE WHEN attempts < ? '
+                       'THEN ? ELSE ? END, expires = NULL, error = ? '
+                       'WHERE id = ? AND owner = ?',
+                       (self.max_attempts, PENDING, FAILED, str(error),
+                        id_, self.owner))
+
+
+    def counts(self):
+        """Number of units in each state.
+
+        Returns
+        -------
+        dict
+        """
+        with self._connect() as db:
+            rows = db.execute('SELECT state, COUNT(*) FROM units '
+                              'GROUP BY state').fetchall()
+        counts = dict((state, 0) for state in (PENDING, CLAIMED, DONE, FAILED))
+        counts.update(rows)
+        return counts
+
+
+    def units(self, state=None):
+        """List units in queue.
+
+        Parameters
+        ----------
+        state : string
+            Only list units in this state.
+
+        Returns
+        -------
+        list of dicts
+        """
+        keys = ('id', 'operation', 'path', 'state', 'owner', 'attempts',
+                'result', 'error')
+        sql = 'SELECT {} FROM units'.format(', '.join(keys))
+        args = ()
+        if state:
+            sql += ' WHERE state = ?'
+            args = (state,)
+        with self._connect() as db:
+            rows = db.execute(sql + ' ORDER BY id', args).fetchall()
+        units = [dict(zip(keys, row)) for row in rows]
+        for unit in units:
+            if unit['result'] is not None:
+                unit['result'] = json.loads(unit['result'])
+        return units
+
+
+    def __str__(self):
+        return 'leicaexperiment.WorkQueue({})'.format(self.path)
+
+
+    def __repr__(self):
+        return self.__str__()
+
+
+
+class _Closing:
+    "Context manager closing the sqlite connection."
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc):
+        try:
+            # transaction left open by an error
+            self.db.execute('ROLLBACK')
+        except sqlite3.OperationalError:
+            # no transaction is active
+            pass
+        self.db.close()
+
+
+
+def work(path, lease=600, poll=None):
+    """Process units from queue until it is empty. Run this on each host
+    taking part in the job.
+
+    Parameters
+    ----------
+    path : string
+        Filename of queue database.
+    lease : float
+        Seconds of each lease. The lease is renewed every `lease` / 3
+        seconds while a unit is processed.
+    poll : float
+        If given, wait and poll every `poll` seconds while other workers
+        hold units, so units of crashed workers are picked up when their
+        lease expires. If not given, return when no unit can be claimed.
+
+    Returns
+    -------
+    list of strings
+        Ids of units processed by this worker.
+    """
+    queue = WorkQueue(path, lease=lease)
+    processed = []
+    while True:
+        unit = queue.claim()
+        if unit is None:
+            if poll and queue.counts()[CLAIMED]:
+                time.sleep(poll)
+                continue
+            return processed
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=_heartbeat,
+                                     args=(path, lease, unit['id'], stop))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            operation = _operations[unit['operation']]
+            result = operation(unit['path'], **unit['kwargs'])
+        except Exception as e:
+            print('leicaexperiment {} failed: {}'.format(unit['id'], e))
+            queue.fail(unit['id'], e)
+        else:
+            queue.complete(unit['id'], result)
+            processed.append(unit['id'])
+        finally:
+            stop.set()
+            heartbeat.join()
+
+
+def _heartbeat(path, lease, id_, stop):
+    "Renew lease of unit until `stop` is set."
+    queue = WorkQueue(path, lease=lease)
+    while not stop.wait(lease / 3.0):
+        if not queue.renew(id_):
+            debug('lost lease of {}'.format(id_))
+            return
+
+
+def _compress_well(path, delete_tif=False, folder=None, timepoint=None):
+    "Compress all images in well, or images of one time point."
+    from .experiment import (compress, glob, attributes, _pattern, _field,
+                             _image)
+    images = glob(_pattern(_pattern(path, _field), _image,
+                           extension='--*.tif'))
+    if timepoint is not None:
+        # --T is two or four digits
+        images = [i for i in images
+                  if attributes(os.path.basename(i)).t == timepoint]
+    return compress(images, delete_tif, folder)
+
+
+def _stitch_well(path, folder=None, timepoint=None):
+    "Stitch all channels and z-stacks of well, or of one time point."
+    from .experiment import stitch_macro
+    import fijibin.macro
+    files, macros = stitch_macro(path, folder, timepoint)
+    if not macros:
+        return files
+    fijibin.macro.run(macro=macros, output_files=files)
+    return files
+
+
+_operations = {
+    'compress': _compress_well,
+    'stitch': _stitch_well,
+}
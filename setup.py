@@ -34,8 +34,14 @@ setup(
         'Pillow',
         'fijibin',
         'lxml',
-        'joblib'
+        'joblib',
+        'numpy'
     ],
+    entry_points={
+        'console_scripts': [
+            'leicaexperiment = leicaexperiment.cli:main',
+        ],
+    },
     license='MIT',
     zip_safe=False,
     keywords='leicaexperiment',
@@ -1,6 +1,6 @@
 import pytest
 from py import path
-from leicaexperiment.experiment import attribute
+from leicaexperiment.experiment import attribute, attribute_as_str
 
 @pytest.fixture
 def experiment(tmpdir):
@@ -127,3 +127,1022 @@ def test_16bit(ometif16bit):
     png_data = np.array(Image.open(png))
 
     assert np.all(tif_data == png_data)
+
+
+def test_stats(tmpdir, experiment):
+    "It should time compression in workers and merge profiles."
+    import json, pstats
+
+    profile = tmpdir.join('compress.prof').strpath
+    experiment.compress(folder=tmpdir.mkdir('pngs').strpath, profile=profile)
+
+    timings = experiment.stats.as_dict()
+    for section in ['glob', 'read', 'decode', 'tags', 'encode', 'write']:
+        assert section in timings
+    assert timings['decode']['count'] == 4
+
+    assert json.loads(experiment.stats.to_json()) == timings
+    assert 'section="encode"' in experiment.stats.to_prometheus()
+    assert pstats.Stats(profile).total_calls > 0
+
+
+def test_workqueue(tmpdir, experiment):
+    "It should let several workers share wells and take over expired leases."
+    from multiprocessing import Process
+    from leicaexperiment.workqueue import WorkQueue, work
+
+    well = path.local(experiment.wells[0])
+    for u in range(1, 4):
+        well.copy(well.dirpath().join('chamber--U0{}--V00'.format(u)))
+
+    queue = tmpdir.join('queue.db').strpath
+    q = experiment.distribute(queue, 'compress')
+    assert q.counts()['pending'] == 4
+
+    # a worker which crashes after claiming a unit
+    crashed = WorkQueue(queue, lease=0.5).claim()
+
+    workers = [Process(target=work, args=(queue,),
+                       kwargs={'lease': 5, 'poll': 0.1}) for _ in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    done = q.units('done')
+    assert len(done) == 4
+    assert crashed['id'] in [u['id'] for u in done]
+    pngs = sorted(f for unit in done for f in unit['result'])
+    assert pngs == [i for i in experiment.images if i.endswith('.png')]
+    assert len(pngs) == 16
+
+    # a unit which crashes every worker fails after max_attempts
+    q = WorkQueue(tmpdir.join('crash.db').strpath, lease=-1, max_attempts=2)
+    q.put('compress', well.strpath)
+    assert q.claim() and q.claim()
+    assert q.claim() is None
+    assert [(u['state'], u['attempts']) for u in q.units()] == \
+        [('failed', 2)]
+
+
+def test_import_time():
+    "It should import without loading heavy dependencies, within budget."
+    import subprocess, sys
+
+    budget = 0.5 # seconds, measured ~0.05 s without heavy dependencies
+    code = ('import sys, time; start = time.time(); import leicaexperiment; '
+            'print(time.time() - start); print(" ".join(sys.modules))')
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=path.local(__file__).dirpath().dirpath()
+                                      .strpath)
+    seconds, modules = out.decode().splitlines()
+    modules = modules.split()
+
+    for heavy in ['fijibin', 'lxml', 'joblib', 'PIL', 'multiprocessing',
+                  'sqlite3', 'socket']:
+        assert heavy not in modules
+    assert float(seconds) < budget
+
+    # loaded on first use
+    code = ('import leicaexperiment; '
+            'from leicaexperiment import WorkQueue, ExperimentCatalog; '
+            'print(WorkQueue.__module__, ExperimentCatalog.__module__)')
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=path.local(__file__).dirpath().dirpath()
+                                      .strpath)
+    assert out.decode().split() == ['leicaexperiment.workqueue',
+                                    'leicaexperiment.catalog']
+
+
+@pytest.mark.parametrize('processes,shared_memory',
+                         [(False, False), (True, False), (True, True)])
+def test_compress_pipelined(tmpdir, experiment, processes, shared_memory):
+    "It should compress the same as compress() with overlapping stages."
+    from leicaexperiment.experiment import compress
+
+    tifs = experiment.images
+    pngs = compress(tifs, folder=tmpdir.mkdir('pngs').strpath)
+    piped = experiment.compress(folder=tmpdir.mkdir('piped').strpath,
+                                pipeline={'read_ahead': 1, 'write_behind': 1,
+                                          'encoders': 2,
+                                          'processes': processes,
+                                          'shared_memory': shared_memory})
+
+    assert piped == tmpdir.join('piped').listdir('*.png', sort=True)
+    assert len(piped) == len(tifs)
+    for png, pipe in zip(pngs, piped):
+        assert path.local(png).read_binary() == path.local(pipe).read_binary()
+        assert (path.local(png[:-4] + '.json').read() ==
+                path.local(pipe[:-4] + '.json').read())
+    assert experiment.stats.timings['encode']['count'] == len(tifs)
+
+
+@pytest.mark.parametrize('threads', [None, 2])
+def test_scan(experiment, threads):
+    "It should list the experiment the same as globbing."
+    from glob import glob
+    from leicaexperiment.scan import scan
+
+    experiment.compress()
+    s = scan(experiment.path, threads)
+    field = experiment.path + '/slide--*/chamber--*/field--*/'
+
+    assert s.wells == experiment.wells
+    assert s.fields == experiment.fields
+    assert s.tifs == sorted(glob(field + 'image--*.tif'))
+    assert s.pngs == sorted(glob(field + 'image--*.png'))
+    assert s.jsons == sorted(glob(field + 'image--*.json'))
+    assert s.xmls == sorted(glob(field + 'metadata/image--*.xml'))
+    assert len(s.tifs) == len(s.pngs) == len(s.jsons) == 4
+    assert experiment.images == s.tifs + s.pngs
+
+
+@pytest.mark.parametrize('method', ['max', 'mean', 'focus'])
+def test_project(tmpdir, experiment, method):
+    "It should z-project fields and stitched wells."
+    from leicaexperiment import Experiment
+    from leicaexperiment.pixels import read, write
+    import numpy as np
+
+    # second z-plane of every image, with the inverted image
+    tifs = experiment.images
+    for tif in tifs:
+        data = read(tif)
+        write(tif.replace('--Z00', '--Z01').replace('.ome.tif', '.png'),
+              255 - data)
+        stitched = path.local(experiment.path).join(
+            'stitched--U00--V00--C{:02d}--Z00.png'.format(tifs.index(tif)))
+        write(stitched.strpath, data)
+        write(stitched.strpath.replace('--Z00', '--Z01'), 255 - data)
+
+    files = experiment.project(method, folder=tmpdir.join('p').strpath)
+    assert len(files) == len(tifs) == 4
+    assert Experiment(tmpdir.join('p').strpath).images == files
+
+    for tif, projection in zip(tifs, files):
+        data = read(tif).astype(int)
+        expected = {'max': np.maximum(data, 255 - data),
+                    'mean': np.full(data.shape, 128), # round(255 / 2)
+                    'focus': data}[method]
+        assert np.all(read(projection) == expected)
+
+    wells = experiment.project(method, by='well',
+                               folder=tmpdir.join('w').strpath)
+    assert [path.local(w).basename for w in wells] == [
+        'stitched--U00--V00--C0{}--Z00.png'.format(i) for i in range(4)]
+
+
+def test_overview(tmpdir, experiment):
+    "It should build a plate overview and only redo changed wells."
+    import os
+    from leicaexperiment import overview as pyramid_module
+    from leicaexperiment.pixels import read, write, downsample
+    import numpy as np
+
+    well = path.local(experiment.wells[0])
+    well.copy(well.dirpath().join('chamber--U01--V00'))
+    # rename images of new well, so U is correct in filename
+    for image in well.dirpath().join('chamber--U01--V00').visit('image--*'):
+        image.move(image.dirpath().join(image.basename.replace('U00', 'U01')))
+
+    folder = tmpdir.join('overview')
+    overview = experiment.overview(level=2, folder=folder.strpath,
+                                   tile_size=128)
+    data = read(overview)
+    # 2 wells of 1 x 2 fields, 1024 / 4 = 256 pixels each, 4 pixels apart
+    assert data.shape == (512, 2 * 256 + 4)
+    field = [i for i in experiment.images
+             if attribute(i, 'c') == 0 and attribute(i, 'u') == 0][0]
+    assert np.all(data[:256, :256] == downsample(read(field), 4))
+
+    pyramid = folder.join('pyramid')
+    assert len(pyramid.listdir()) == 4
+    assert len(pyramid.join('0').listdir()) == 4 * 5
+    assert pyramid.join('3', '0_0.png').check()
+
+    # only changed well is rendered again
+    cached = folder.join('wells', 'well--U00--V00.png')
+    mtime = cached.mtime()
+    changed = [i for i in experiment.images if attribute(i, 'u') == 1][0]
+    write(changed.replace('.ome.tif', '.png'), read(changed))
+    path.local(changed).remove()
+    mtimes = dict((t.strpath, t.mtime()) for t in pyramid.visit('*.png'))
+    experiment.overview(level=2, folder=folder.strpath, tile_size=128)
+    assert cached.mtime() == mtime
+    assert experiment.stats.timings['thumbnail']['count'] == 3
+
+    # only tiles over changed well are rendered, up through the levels
+    kept = [t for t in pyramid.visit('*.png')
+            if (t.dirpath().basename, t.basename[0]) in
+            [('0', '0'), ('0', '1'), ('1', '0')]]
+    assert len(kept) == 4 + 4 + 2
+    assert all(t.mtime() == mtimes[t.strpath] for t in kept)
+    full = tmpdir.join('full')
+    pyramid_module.pyramid(read(folder.join('overview.png').strpath),
+                           full.strpath, 128)
+    for tile in full.visit('*.png'):
+        assert np.all(read(tile.strpath) ==
+                      read(pyramid.join(tile.relto(full)).strpath))
+
+    # nothing changed
+    mtime = folder.join('overview.png').mtime()
+    os.utime(folder.join('overview.png').strpath, (mtime - 10, mtime - 10))
+    experiment.overview(level=2, folder=folder.strpath, tile_size=128)
+    assert folder.join('overview.png').mtime() == mtime - 10
+
+    # tiles and levels of a larger plate are removed
+    well.dirpath().join('chamber--U01--V00').remove()
+    experiment.overview(level=2, folder=folder.strpath, tile_size=128)
+    full.remove()
+    pyramid_module.pyramid(read(folder.join('overview.png').strpath),
+                           full.strpath, 128)
+    assert sorted(t.relto(full) for t in full.visit('*.png')) == \
+        sorted(t.relto(pyramid) for t in pyramid.visit('*.png'))
+
+
+def test_pyramid(tmpdir):
+    "It should render only dirty tiles, same as rendering all of them."
+    from leicaexperiment.overview import pyramid
+    from leicaexperiment.pixels import read
+    import numpy as np
+
+    rng = np.random.RandomState(0)
+    data = rng.randint(0, 256, (75, 101)).astype(np.uint8)
+    assert pyramid(data, tmpdir.join('a').strpath, 16) == 4
+    data[40:50, 60:70] = 255
+    pyramid(data, tmpdir.join('a').strpath, 16, dirty=[(40, 60, 50, 70)])
+    pyramid(data, tmpdir.join('b').strpath, 16)
+    tiles = sorted(t.relto(tmpdir.join('b'))
+                   for t in tmpdir.join('b').visit('*.png'))
+    assert tiles == sorted(t.relto(tmpdir.join('a'))
+                           for t in tmpdir.join('a').visit('*.png'))
+    for tile in tiles:
+        assert np.all(read(tmpdir.join('a', tile).strpath) ==
+                      read(tmpdir.join('b', tile).strpath))
+
+
+def test_flatfield(tmpdir, experiment):
+    "It should estimate, cache and apply illumination profiles."
+    from leicaexperiment.flatfield import estimate
+    from leicaexperiment.pixels import read, write
+    import numpy as np
+
+    # vignetted, noisy tiles over a dark field, some empty and some with
+    # bright objects
+    rng = np.random.RandomState(0)
+    vignette = np.linspace(0.5, 1, 32)[None, :] * np.ones((32, 1))
+    dark = 100 + np.linspace(0, 20, 32)[:, None] * np.ones((1, 32))
+    tiles = []
+    for i in range(240):
+        background = 0 if i % 4 == 0 else rng.uniform(900, 1100)
+        data = dark + background * vignette + rng.normal(0, 5, (32, 32))
+        if i % 3 == 0:
+            data[10:20, 10:20] += 2000
+        tiles.append(write(tmpdir.join('tile{}.png'.format(i)).strpath,
+                           data.round().astype(np.uint16)))
+
+    profile = estimate(tiles, smooth=0, n_jobs=2, seed=0)
+    assert np.abs(profile.dark - dark).mean() < 6
+    # a minimum is pulled down by noise
+    minimum = np.min([read(t) for t in tiles], axis=0)
+    assert np.abs(profile.dark - dark).mean() < \
+        np.abs(minimum - dark).mean() / 2
+    # objects in every third tile hardly show in flat field, they would
+    # double it with a mean
+    error = np.abs(profile.flat - vignette / vignette.mean())
+    assert error.mean() < 0.03
+    assert error[10:20, 10:20].max() < 0.15
+    corrected = profile.apply(read(tiles[1])).astype(float)
+    assert corrected.std() / corrected.mean() < 0.04
+
+    # less than five tiles, exact percentiles
+    profile = estimate(tiles[1:4], smooth=0, low=0)
+    assert np.all(profile.dark == np.min([read(t) for t in tiles[1:4]],
+                                         axis=0))
+
+    vignette = np.linspace(0.5, 1, 64)[None, :] * np.ones((64, 1))
+    for i, image in enumerate(experiment.images):
+        write(image, ((100 + 10 * i) * vignette + 5).round()
+              .astype(np.uint8))
+
+    cached = experiment.flatfield(channel=0, sample=2, seed=1)
+    assert path.local(experiment.path).join(
+        'AdditionalData', 'flatfield--C00.npz').check()
+    assert np.all(experiment.flatfield(channel=0).flat == cached.flat)
+    image = experiment.images[0]
+    assert (experiment.read(image, flatfield=True).shape ==
+            read(image).shape)
+
+
+@pytest.mark.parametrize('pipeline', [False, True])
+def test_qc(tmpdir, experiment, pipeline):
+    "It should save image statistics while compressing."
+    from leicaexperiment.pixels import read
+    import numpy as np
+
+    tifs = experiment.images
+    experiment.compress(folder=tmpdir.mkdir('pngs').strpath, qc=True,
+                        pipeline=pipeline)
+
+    records = experiment.qc()
+    assert [r['image'] for r in records] == tifs
+    for record in records:
+        data = read(record['image'])
+        assert record['max'] == data.max()
+        assert record['mean'] == pytest.approx(data.mean())
+        assert sum(record['histogram']) == data.size
+        assert record['saturated'] == np.mean(data == 255)
+    assert len(experiment.qc(C=1, Y=[0, 1])) == 2
+    assert experiment.qc(C=1, X=1) == []
+
+
+def test_to_zarr(tmpdir, experiment):
+    "It should export experiment as OME-Zarr plate."
+    import json, zlib
+    import numpy as np
+    from leicaexperiment.pixels import read, downsample
+
+    plate = tmpdir.join('plate.zarr')
+    experiment.to_zarr(plate.strpath, levels=2)
+
+    def attrs(*names):
+        return json.loads(plate.join(*names + ('.zattrs',)).read())
+
+    assert attrs()['plate']['wells'] == [
+        {'path': 'A/1', 'rowIndex': 0, 'columnIndex': 0}]
+    assert attrs('A', '1')['well']['images'] == [{'path': '0'},
+                                                 {'path': '1'}]
+    multiscale = attrs('A', '1', '1')['multiscales'][0]
+    assert [d['path'] for d in multiscale['datasets']] == ['0', '1']
+
+    # field --X00--Y01, channel 1
+    image = [i for i in experiment.images
+             if attribute(i, 'y') == 1 and attribute(i, 'c') == 1][0]
+    for level in range(2):
+        array = json.loads(plate.join('A', '1', '1', str(level),
+                                      '.zarray').read())
+        assert array['shape'] == [1, 2, 1] + [1024 // 2 ** level] * 2
+        chunk = plate.join('A', '1', '1', str(level), '0', '1', '0', '0', '0')
+        data = np.frombuffer(zlib.decompress(chunk.read_binary()),
+                             array['dtype']).reshape(array['chunks'][3:])
+        assert np.all(data == downsample(read(image), 2 ** level))
+
+
+def test_server(experiment):
+    "It should serve contrast adjusted tiles of fields."
+    import json, threading
+    from io import BytesIO
+    from PIL import Image
+    import numpy as np
+    from leicaexperiment.pixels import read, downsample
+    from leicaexperiment.server import TileServer
+    try:
+        from urllib.request import urlopen
+        from urllib.error import HTTPError
+    except ImportError:
+        from urllib2 import urlopen, HTTPError
+
+    server = TileServer(experiment, ('127.0.0.1', 0), tile_size=256,
+                        refresh=600)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        index = json.loads(urlopen(server.url + '/').read().decode())
+        assert index['fields'] == [[0, 0, 0, 0], [0, 0, 0, 1]]
+        assert index['channels'] == [0, 1]
+
+        # field --X00--Y01 channel 1, reduced 2 times, second tile column
+        url = server.url + '/field/0/0/0/1/1/0/1/1_0.png?min=0&max=255'
+        tile = np.array(Image.open(BytesIO(urlopen(url).read())))
+        image = [i for i in experiment.images
+                 if attribute(i, 'y') == 1 and attribute(i, 'c') == 1][0]
+        assert np.all(tile == downsample(read(image), 2)[:256, 256:512])
+
+        urlopen(url)
+        assert server.cache.hits >= 1
+        assert urlopen(server.url + '/field/0/0/0/1/1/0/0/0_0.png').read()
+
+        for missing in ['/field/9/0/0/1/1/0/0/0_0.png',
+                        '/field/0/0/0/1/1/0/1/9_9.png', '/nothing']:
+            with pytest.raises(HTTPError):
+                urlopen(server.url + missing)
+
+        # listed again when invalidated, not on every request
+        import shutil
+        copy = image.replace('--X00--Y01', '--X01--Y01')
+        path.local(copy).dirpath().ensure(dir=True)
+        shutil.copy(image, copy)
+        new = server.url + '/field/0/0/1/1/1/0/0/0_0.png'
+        with pytest.raises(HTTPError):
+            urlopen(new)
+        server.invalidate()
+        assert urlopen(new).read()
+        assert [1, 1] in [f[2:] for f in
+                          json.loads(urlopen(server.url + '/').read()
+                                     .decode())['fields']]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_select(experiment):
+    "It should select images by attributes."
+    images = experiment.images
+
+    assert experiment.select(C=1) == [i for i in images
+                                      if attribute(i, 'c') == 1]
+    assert experiment.select(Y=range(1, 5), C=[0]) == [
+        i for i in images if attribute(i, 'y') == 1 and
+                             attribute(i, 'c') == 0]
+    assert experiment.select(Y=slice(None, 1)) == [
+        i for i in images if attribute(i, 'y') == 0]
+    assert experiment.select(U=1) == []
+    assert len(experiment.select(table=True, T=0)) == 4
+
+    assert experiment.image(0, 0, 1, 0) == images[2]
+    assert experiment.well_images(0, 0) == images
+    assert experiment.field_rows(0, 0) == [0, 1]
+    assert experiment.field_columns(0, 0) == [0]
+    assert experiment.well_rows == experiment.well_columns == [0]
+
+    # index is only reused if asked for
+    experiment.compress()
+    assert len(experiment.select(C=0)) == 4
+    assert experiment.select(C=0, cache=True) == experiment.select(C=0)
+
+    # images added after first query are seen
+    import shutil
+    new = images[2].replace('--X00--Y01', '--X01--Y01')
+    path.local(new).dirpath().ensure(dir=True)
+    shutil.copy(images[2], new)
+    assert experiment.image(0, 0, 1, 1) == new
+    assert experiment.field_columns(0, 0) == [0, 1]
+    assert experiment.image(0, 0, 1, 1, timepoint=1) == ''
+
+
+def test_timepoints(experiment):
+    "It should index, stream and compress time points separately."
+    import shutil
+    for image in experiment.images:
+        shutil.copy(image, image.replace('--T00', '--T01'))
+    images = experiment.select()
+
+    assert experiment.timepoints == [0, 1]
+    assert experiment.image(0, 0, 1, 0, timepoint=1) == images[6]
+    assert len(experiment.well_images(0, 0, timepoint=0)) == 4
+
+    timepoints = list(experiment.iter_timepoints())
+    assert [t for t, _ in timepoints] == [0, 1]
+    assert timepoints[1][1] == [i for i in images if attribute(i, 't') == 1]
+    # last time point is complete when it has as many images as the first
+    assert len(list(experiment.iter_timepoints(poll=0.01,
+                                               timeout=0.05))) == 2
+
+    pngs = experiment.compress(timepoint=1)
+    assert len(pngs) == 4
+    assert all(attribute(png, 't') == 1 for png in pngs)
+
+    # LAS X has four digits in --T
+    las_x = images[0].replace('--T00', '--T0012')
+    assert attribute(las_x, 't') == 12
+    assert attribute_as_str(las_x, 'T') == '0012'
+    assert attribute_as_str(images[0], 'T') == '00'
+
+
+def test_compress_dedup(tmpdir, experiment):
+    "It should store identical planes and tags once and decompress them."
+    import os, shutil
+    from leicaexperiment.experiment import decompress
+    from PIL import Image
+    import numpy as np
+    # identical field
+    for image in experiment.select(Y=0):
+        copy = image.replace('--Y00', '--Y02')
+        if not os.path.isdir(os.path.dirname(copy)):
+            os.mkdir(os.path.dirname(copy))
+        shutil.copy(image, copy)
+    images = experiment.select()
+
+    folder = tmpdir.mkdir('pngs')
+    pngs = experiment.compress(folder=folder.strpath, dedup=True)
+    assert len(pngs) == 6
+    blobs = folder.join('blobs')
+    assert len(blobs.listdir('*.png')) == 4
+    assert os.stat(pngs[0]).st_ino == os.stat(pngs[4]).st_ino
+    assert experiment.stats.as_dict()['dedup']['count'] == 2
+
+    tifs = decompress(pngs, folder=tmpdir.mkdir('tifs').strpath)
+    for original, tif in zip(images, tifs):
+        a, b = Image.open(original), Image.open(tif)
+        assert np.all(np.array(a) == np.array(b))
+        assert a.getpalette() == b.getpalette()
+        assert a.tag[270] == b.tag[270]
+
+
+def test_stitch_cache(tmpdir, experiment):
+    "It should only stitch again when tiles of a stitched image change."
+    import os
+    from leicaexperiment.experiment import stitch_macro
+    well = experiment.wells[0]
+    folder = tmpdir.mkdir('stitched').strpath
+
+    files, macros = stitch_macro(well, folder)
+    assert len(files) == len(macros) == 2
+    # stitched by fiji
+    for f in files:
+        open(f, 'w').close()
+    files, macros = stitch_macro(well, folder)
+    assert macros == []
+
+    # acquired again
+    tile = experiment.select(C=1)[0]
+    os.utime(tile, (os.path.getmtime(tile) + 60,) * 2)
+    files, macros = stitch_macro(well, folder)
+    assert len(macros) == 1
+
+    # stitched before cache, older than tiles
+    os.remove(os.path.join(well, 'stitched.json'))
+    assert len(stitch_macro(well, folder)[1]) == 1
+
+
+def mean_by_channel(group):
+    "Mean intensity of each channel in group, used in test_map."
+    return dict((c, float(sum(d.mean() for d in group.select(C=c).read())))
+                for c in group.unique('c'))
+
+
+def test_map(experiment):
+    "It should map over wells, fields and images and memoize results."
+    import os
+
+    fields = experiment.map(mean_by_channel, by='field')
+    assert sorted(fields) == [(0, 0, 0, 0), (0, 0, 0, 1)]
+    wells = experiment.map(mean_by_channel, by='well')
+    assert list(wells) == [(0, 0)]
+    assert wells[0, 0][1] == pytest.approx(fields[0, 0, 0, 0][1] +
+                                           fields[0, 0, 0, 1][1])
+    images = experiment.map(mean_by_channel, by='image', reduce=len)
+    assert images == 4
+
+    # memoized, only changed field is computed
+    experiment.stats.reset()
+    assert experiment.map(mean_by_channel, by='field') == fields
+    assert 'map' not in experiment.stats.as_dict()
+    tile = experiment.select(X=0, Y=1)[0]
+    os.utime(tile, (os.path.getmtime(tile) + 60,) * 2)
+    assert experiment.map(mean_by_channel, by='field') == fields
+    assert experiment.stats.as_dict()['map']['count'] == 1
+
+
+def test_buffer_pool():
+    "It should reuse shared memory buffers when all references are released."
+    from leicaexperiment import shm
+    if not shm.available():
+        pytest.skip('multiprocessing.shared_memory not available')
+    with shm.BufferPool(2) as pool:
+        a = pool.acquire(10)
+        a.view[:] = b'0123456789'
+        assert bytes(shm.attach(a.name)[:a.length]) == b'0123456789'
+
+        a.retain()
+        a.release()
+        b = pool.acquire(10)
+        assert b.name != a.name
+        a.release()
+        c = pool.acquire(10)
+        assert c.name == a.name
+
+
+def test_buffer_pool_attached(monkeypatch):
+    "It should close blocks attached least recently, and destroyed blocks."
+    from leicaexperiment import shm
+    if not shm.available():
+        pytest.skip('multiprocessing.shared_memory not available')
+    monkeypatch.setattr(shm, '_max_attached', 2)
+    monkeypatch.setattr(shm, '_attached', shm.OrderedDict())
+    with shm.BufferPool(3) as pool:
+        buffers = [pool.acquire(10) for _ in range(3)]
+        for b in buffers:
+            shm.attach(b.name)
+        assert list(shm._attached) == [b.name for b in buffers[1:]]
+
+        # replaced by a larger block
+        buffers[1].release()
+        pool.acquire(2 * shm._granularity)
+        assert list(shm._attached) == [buffers[2].name]
+    assert not shm._attached
+
+
+@pytest.mark.parametrize('to', ['array', 'bytes'])
+def test_decompress_in_memory(tmpdir, experiment, ometif16bit, to):
+    "It should decompress to arrays or ome.tif bytes without writing files."
+    from io import BytesIO
+    from leicaexperiment import compress, decompress, iter_decompressed
+    from leicaexperiment.pixels import read
+    from PIL import Image
+    import numpy as np
+
+    tifs = experiment.images + [ometif16bit.strpath]
+    pngs = compress(tifs, folder=tmpdir.mkdir('pngs').strpath)
+    listing = tmpdir.join('pngs').listdir()
+
+    decompressed = list(iter_decompressed(pngs, to, read_ahead=2))
+    assert [png for png, _ in decompressed] == pngs
+    assert len(decompress(pngs, to=to)) == len(pngs)
+    for tif, (_, output) in zip(tifs, decompressed):
+        original = Image.open(tif)
+        if to == 'array':
+            data, tags = output
+            assert data.dtype == read(tif).dtype
+            assert tags[270] == original.tag[270]
+        else:
+            data = read(BytesIO(output))
+        assert np.all(data == read(tif))
+
+    assert tmpdir.join('pngs').listdir() == listing
+
+
+def test_stitch_preview(tmpdir, experiment):
+    "It should place reduced tiles at positions from TileConfiguration.txt."
+    import os
+    from leicaexperiment.pixels import read
+    folder = tmpdir.mkdir('preview')
+
+    previews = experiment.stitch(folder.strpath, preview=4)
+    assert previews == folder.listdir('preview--*.png', sort=True)
+    assert [os.path.basename(p) for p in previews] == [
+        'preview--U00--V00--C00--Z00.png', 'preview--U00--V00--C01--Z00.png']
+    # second field at y = 921 in tile configuration
+    data = read(previews[1])
+    assert data.shape == (round(921 / 4.) + 256, 256)
+    tile = read(experiment.select(C=1, Y=1)[0])[:4, :4].mean()
+    assert data[230, :1].mean() == pytest.approx(tile, abs=1)
+
+    # grid without tile configuration
+    os.remove(os.path.join(experiment.wells[0], 'TileConfiguration.txt'))
+    previews = experiment.stitch(folder.strpath, preview=4)
+    assert read(previews[1]).shape == (512, 256)
+
+
+def test_stitch_preview_four_digit_timepoints(tmpdir, experiment_las_x):
+    "It should name previews with --T as in files, like stitch_macro."
+    import os, shutil
+    for image in experiment_las_x.images:
+        shutil.copy(image, image.replace('--T0000', '--T0001'))
+    previews = experiment_las_x.stitch(tmpdir.strpath, preview=4)
+    assert [os.path.basename(p) for p in previews] == [
+        'preview--U00--V00--T{}--C{}--Z00.png'.format(t, c)
+        for t in ['0000', '0001'] for c in ['00', '01']]
+
+
+def test_archive(tmpdir, experiment):
+    "It should compress to destination, resume and delete verified sources."
+    import json, os
+    from leicaexperiment import Experiment
+    from leicaexperiment.pixels import read
+    dest = tmpdir.join('archive')
+    tifs = experiment.images
+
+    files = experiment.archive(dest.strpath)
+    archived = Experiment(dest.strpath)
+    assert len(archived.images) == len(tifs)
+    assert all(i.endswith('.png') for i in archived.images)
+    for tif, png in zip(tifs, archived.images):
+        assert (read(tif) == read(png)).all()
+    assert dest.join('slide--S00', 'chamber--U00--V00',
+                     'TileConfiguration.txt').check()
+    others = [f for f in path.local(experiment.path).visit()
+              if f.check(file=1) and f.ext != '.tif']
+    assert len(files) == 2 * len(tifs) + len(others)
+
+    # resume after interruption, one file lost and one not recorded
+    os.remove(archived.images[0])
+    lines = dest.join('archive.jsonl').readlines()
+    dest.join('archive.jsonl').write(''.join(
+        l for l in lines if 'TileConfiguration.txt' not in l))
+    experiment.stats.reset()
+    assert sorted(experiment.archive(dest.strpath)) == sorted(files)
+    timings = experiment.stats.as_dict()
+    assert timings['encode']['count'] == 1
+    assert timings['resumed']['count'] == len(lines) - 2
+
+    experiment.archive(dest.strpath, delete=True)
+    assert experiment.select() == []
+    entries = [json.loads(l) for l in dest.join('archive.jsonl').readlines()]
+    assert all(len(e['files'][name][0]) == 64
+               for e in entries for name in e['files'])
+
+
+def test_archive_corrupt(tmpdir, experiment):
+    "It should skip files which cannot be archived, and retry on resume."
+    dest = tmpdir.join('archive')
+    tifs = experiment.images
+    corrupt = path.local(tifs[0])
+    data = corrupt.read_binary()
+    corrupt.write_binary(data[:100])
+
+    files = experiment.archive(dest.strpath, delete=True)
+    assert len([f for f in files if f.endswith('.png')]) == len(tifs) - 1
+    assert corrupt.check()
+    assert experiment.stats.as_dict()['failed']['count'] == 1
+    assert not [f for f in dest.visit() if f.ext == '.tmp']
+
+    corrupt.write_binary(data)
+    files = experiment.archive(dest.strpath, delete=True)
+    assert [f for f in files if f.endswith('.png')] == [
+        dest.join(corrupt.relto(experiment.path)[:-8] + '.png').strpath]
+    assert len(list(dest.visit('*.png'))) == len(tifs)
+    assert not corrupt.check()
+
+
+def test_catalog(tmpdir, experiment):
+    "It should index experiments incrementally and query across them."
+    import shutil, time
+    from leicaexperiment import Experiment, ExperimentCatalog
+    root = tmpdir.mkdir('data')
+    for name in ['experiment--a', 'experiment--b']:
+        shutil.copytree(experiment.path, root.join(name).strpath)
+    catalog = ExperimentCatalog(tmpdir.join('catalog.db').strpath)
+
+    assert catalog.discover(root.strpath) == 8
+    assert catalog.update() == 0
+    images = catalog.query(C=1, U=0, V=0)
+    assert len(images) == 4
+    assert images[0]['experiment'] == root.join('experiment--a').strpath
+    assert images[0]['c'] == 1 and images[0]['compressed'] is False
+    assert len(catalog.query(experiment='*--b', Y=range(1, 3))) == 2
+    assert catalog.query(since=time.time() + 60) == []
+
+    Experiment(root.join('experiment--b').strpath).compress()
+    assert catalog.update() == 4
+    assert len(catalog.query(compressed=True)) == 4
+
+    with pytest.raises(ValueError):
+        catalog.update([tmpdir.join('experiment--c').strpath])
+    assert catalog.add(tmpdir.join('experiment--c').strpath) == 0
+
+    root.join('experiment--a').remove()
+    catalog.update()
+    assert catalog.experiments == [root.join('experiment--b').strpath]
+    assert len(catalog.query()) == 8
+
+
+def test_open_image(tmpdir, experiment, ometif16bit):
+    "It should memory map uncompressed ome.tifs, and decode other images."
+    from leicaexperiment import compress
+    from leicaexperiment.pixels import read
+    import numpy as np
+
+    for tif in [experiment.images[0], ometif16bit.strpath]:
+        data = experiment.open_image(tif)
+        assert isinstance(data, np.memmap)
+        assert data.dtype == read(tif).dtype
+        assert np.all(data == read(tif))
+        assert np.all(data[10:20, 30:40] == read(tif)[10:20, 30:40])
+        assert not isinstance(experiment.open_image(tif, mmap=False),
+                              np.memmap)
+
+    png, = compress([ometif16bit.strpath], folder=tmpdir.strpath)
+    data = experiment.open_image(png)
+    assert not isinstance(data, np.memmap)
+    assert np.all(data == read(ometif16bit.strpath))
+
+
+def test_render(tmpdir, experiment):
+    "It should render composites with plate wide contrast limits."
+    from leicaexperiment.pixels import read, write
+    from leicaexperiment.render import (contrast_limits, histogram, lut,
+                                        composite)
+    from PIL import Image
+    import numpy as np
+
+    counts = histogram(experiment.images, n_jobs=2)
+    assert counts.sum() == sum(read(i).size for i in experiment.images)
+    limits = experiment.contrast_limits(low=0, high=100)
+    assert sorted(limits) == [0, 1]
+    for c, (low, high) in limits.items():
+        values = np.concatenate([read(i).ravel() for i in
+                                 experiment.select(C=c)])
+        assert (low, high) == (values.min(), max(values.max(), low + 1))
+    assert path.local(experiment.path).join(
+        'AdditionalData', 'histogram--C00.npy').check()
+    assert contrast_limits(np.zeros(1 << 16, np.int64)) == (0, 1)
+
+    # big endian, like memory mapped TIFFs from other platforms
+    data = np.arange(0, 1 << 16, 257, dtype=np.uint16).reshape(16, 16)
+    raw = tmpdir.join('big-endian.raw')
+    data.astype('>u2').tofile(raw.strpath)
+    mapped = np.memmap(raw.strpath, '>u2', 'r', shape=data.shape)
+    table = lut((0, 1 << 16), (255, 255, 255))
+    assert np.all(composite([mapped], [table]) ==
+                  composite([data], [table]))
+    with pytest.raises(ValueError):
+        composite([data.astype(np.int16)], [table])
+
+    colors = {0: (255, 0, 0), 1: (0, 0, 255)}
+    composites = experiment.render(colors=colors, limits=limits,
+                                   folder=tmpdir.strpath)
+    assert len(composites) == len(experiment.fields)
+    rgb = np.array(Image.open(composites[0]))
+    assert rgb.shape == read(experiment.images[0]).shape + (3,)
+    assert rgb.dtype == np.uint8
+    assert np.all(rgb[..., 1] == 0)
+    low, high = limits[0]
+    red = np.clip((read(experiment.select(C=0)[0]) - float(low)) /
+                  (high - low), 0, 1) * 255
+    assert np.abs(rgb[..., 0] - red).max() <= 1
+
+    for c in [0, 1]:
+        write(path.local(experiment.path).join(
+            'stitched--U00--V00--C{:02d}--Z00.png'.format(c)).strpath,
+            read(experiment.select(C=c)[0]))
+    composite, = experiment.render(by='stitched', format='jpg',
+                                   folder=tmpdir.strpath)
+    assert path.local(composite).basename == 'composite--U00--V00--Z00.jpg'
+
+
+def test_plan_compress(tmpdir, experiment, capsys, monkeypatch):
+    "It should estimate compress from a calibration sample."
+    from leicaexperiment import experiment as module
+    from leicaexperiment.cli import main
+    from leicaexperiment.plan import plan_compress
+
+    # --workers sets number of workers for the rest of the process
+    monkeypatch.setattr(module, '_pools', module._pools)
+
+    listing = tmpdir.listdir()
+    plan = plan_compress(experiment.images, tmpdir.strpath, sample=2, seed=1,
+                         workers=[1, 2])
+    assert tmpdir.listdir() == listing
+    assert plan.items == len(experiment.images)
+    assert plan.input_bytes == sum(path.local(i).size()
+                                   for i in experiment.images)
+    assert plan.sample == 2
+    assert 0 < plan.output_bytes < plan.input_bytes
+    assert sorted(plan.seconds) == [1, 2]
+    assert 0 < plan.seconds[2] < plan.seconds[1]
+    assert plan.peak_memory[2] == 2 * plan.peak_memory[1]
+
+    pngs = experiment.compress(folder=tmpdir.strpath)
+    assert plan_compress(experiment.images, tmpdir.strpath).items == 0
+    plan = plan_compress(experiment.images, sample=0)
+    assert plan.output_bytes is None and plan.seconds == {}
+
+    assert main(['compress', experiment.path, '--dry-run', '--workers',
+                 '2']) == 0
+    out = capsys.readouterr()[0]
+    assert out.startswith('compress: {} items'.format(len(pngs)))
+    assert not [i for i in experiment.images if i.endswith('.png')]
+
+
+def test_plan_stitch(experiment):
+    "It should estimate stitch of wells from one stitched plane."
+    plan = experiment.plan('stitch', sample=0)
+    assert plan.items == 2
+    assert plan.input_bytes == sum(path.local(i).size()
+                                   for i in experiment.images)
+    assert plan.seconds == {}
+    assert not path.local(experiment.wells[0]).join('stitched.json').check()
+
+
+def test_retry_and_replay(tmpdir, experiment, monkeypatch):
+    "It should retry transient errors and replay images which failed."
+    import errno
+    from leicaexperiment import decompress
+    from leicaexperiment import experiment as module
+    from leicaexperiment.batch import FailureManifest
+
+    monkeypatch.setattr(module, '_pools', 1)
+    write = module._write_compressed
+    failures = {0: IOError(errno.EIO, 'Input/output error'),
+                1: IOError(errno.EACCES, 'Permission denied')}
+    tifs = experiment.images
+    def flaky(new_filename, png, tags, stats):
+        i = [module._compressed_filename(t, folder) for t in tifs].index(
+            new_filename)
+        if i in failures:
+            error = failures[i]
+            if error.errno == errno.EIO:
+                del failures[i]
+            raise error
+        write(new_filename, png, tags, stats)
+    monkeypatch.setattr(module, '_write_compressed', flaky)
+
+    folder = tmpdir.mkdir('pngs').strpath
+    manifest = tmpdir.join('failed.jsonl').strpath
+    results = module.compress(tifs, folder=folder, manifest=manifest,
+                              results=True)
+    assert [r.status for r in results] == ['ok', 'failed', 'ok', 'ok']
+    assert [r.attempts for r in results] == [2, 1, 1, 1]
+    assert 'Permission denied' in results[1].error
+    assert results[1].output == ''
+    assert results[0].bytes_in == path.local(tifs[0]).size()
+    assert results[0].bytes_out == (path.local(results[0].output).size() +
+        path.local(results[0].output[:-4] + '.json').size())
+    assert [e['item'] for e in FailureManifest(manifest).failed()] == \
+        [tifs[1]]
+    assert not tmpdir.join('pngs').listdir('*.tmp')
+
+    # replay with same options, once
+    del failures[1]
+    results = experiment.replay()
+    assert results == []
+    from leicaexperiment.batch import replay
+    results = replay(manifest)
+    assert [(r.item, r.status) for r in results] == [(tifs[1], 'ok')]
+    assert path.local(results[0].output).dirname == folder
+    assert replay(manifest) == []
+
+    # partial files are removed when a write fails
+    import os
+    with pytest.raises(TypeError):
+        module._write_atomic(tmpdir.join('partial.png').strpath, u'text')
+    assert not tmpdir.listdir('partial*')
+    rename = os.rename
+    def flaky_rename(src, dst):
+        if dst.endswith('.ome.tif') and not failures:
+            failures[dst] = True
+            raise IOError(errno.EIO, 'Input/output error')
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', flaky_rename)
+
+    pngs = tmpdir.join('pngs').listdir('*.png', sort=True)
+    results = decompress([p.strpath for p in pngs], results=True)
+    assert [r.status for r in results] == ['ok'] * len(pngs)
+    assert [r.attempts for r in results] == [2] + [1] * (len(pngs) - 1)
+    assert not tmpdir.join('pngs').listdir('*.tmp')
+    assert [r.status for r in decompress(pngs[0].strpath, results=True)] \
+        == ['skipped']
+
+
+def test_compress_twice(tmpdir, experiment, monkeypatch):
+    "It should skip PNGs of earlier compress, and record failures by output."
+    import errno
+    from leicaexperiment import experiment as module
+
+    monkeypatch.setattr(module, '_pools', 1)
+    manifest = path.local(experiment.path).join('AdditionalData',
+                                                'failed.jsonl')
+    experiment.compress()
+    experiment.compress()
+    assert not manifest.check()
+    assert experiment.replay() == []
+
+    folder = tmpdir.mkdir('pngs')
+    def denied(new_filename, png, tags, stats):
+        raise IOError(errno.EACCES, 'Permission denied')
+    monkeypatch.setattr(module, '_write_compressed', denied)
+    experiment.compress(folder=folder.strpath)
+    assert not manifest.check()
+    assert folder.join('failed.jsonl').check()
+    monkeypatch.undo()
+    results = experiment.replay(folder=folder.strpath)
+    assert [r.status for r in results] == ['ok'] * 4
+    assert experiment.replay(folder=folder.strpath) == []
+
+
+@pytest.fixture
+def experiment_las_x(experiment):
+    "Test experiment with four digit time points, like LAS X."
+    import os
+    for image in experiment.images:
+        os.rename(image, image.replace('--T00', '--T0000'))
+    experiment._table = None
+    return experiment
+
+
+def test_stitch_four_digit_timepoints(tmpdir, experiment_las_x, monkeypatch):
+    "It should build stitch patterns matching four digit time points."
+    import fijibin.macro, os
+    from glob import glob
+    from leicaexperiment.experiment import stitch_macro
+    patterns = []
+    def stitch(path, filenames, *args, **kwargs):
+        patterns.append(os.path.join(path, filenames))
+        return 'macro'
+    monkeypatch.setattr(fijibin.macro, 'stitch', stitch)
+
+    well = experiment_las_x.wells[0]
+    for timepoint in [None, 0]:
+        outputs, macros = stitch_macro(well, tmpdir.strpath, timepoint,
+                                       dry_run=True)
+        assert len(macros) == 2
+    for pattern in patterns:
+        assert '--T0000--' in pattern
+        assert len(glob(pattern.format(xx='*', yy='*'))) == 2
+    assert path.local(outputs[0]).basename == \
+        'stitched--U00--V00--T0000--C00--Z00.png'
+
+    plan = experiment_las_x.plan('stitch', timepoint=0, sample=0)
+    assert plan.input_bytes == sum(path.local(i).size()
+                                   for i in experiment_las_x.images)
+
+
+def test_compress_well_four_digit_timepoints(tmpdir, experiment_las_x):
+    "It should select images of a time point with four digit --T."
+    from leicaexperiment.workqueue import _compress_well
+    well = experiment_las_x.wells[0]
+    assert len(_compress_well(well, folder=tmpdir.strpath, timepoint=0)) == 4
+    assert _compress_well(well, folder=tmpdir.strpath, timepoint=1) == []
+    assert experiment_las_x.timepoints == [0]